@@ -1,27 +1,50 @@
+import abc
 import asyncio
+import base64
+import copy
 import json
 import logging
 import os
 import re
+import shutil
+import sqlite3
 import hashlib
+import heapq
 import hmac
+import itertools
 import time
 import math
+import mmap
+import random
+import struct
+import sys
+import tempfile
 import threading
-from typing import List, Optional, Dict, Any, Set, Literal, Tuple
+import zlib
+from contextlib import asynccontextmanager, contextmanager
+from typing import List, Optional, Dict, Any, Iterable, Set, Literal, Tuple
 
 import httpx
+import numpy as np
 from fastapi import FastAPI, HTTPException, Request, Depends, Header
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field, conlist
 from dotenv import load_dotenv
 
 load_dotenv()
 
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    yield
+    await asyncio.to_thread(_shutdown_vector_persistence)
+    await asyncio.to_thread(_persist_ann_indexes)
+
+
 logger = logging.getLogger("ai_service")
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI(title="Note Taker AI Service")
+app = FastAPI(title="Note Taker AI Service", lifespan=lifespan)
 
 
 class UpstreamStructuredError(Exception):
@@ -62,7 +85,57 @@ CONCEPT_NEXT_ACTIONS_MIN = 3
 CONCEPT_NEXT_ACTIONS_MAX = 8
 ENABLE_JSON_SCHEMA = os.getenv("HF_JSON_SCHEMA", "false").lower() == "true"
 HF_MODELS_CACHE_TTL_SEC = int(os.getenv("HF_MODELS_CACHE_TTL_SEC", "300"))
-VECTOR_STORE_PATH = os.getenv("AI_VECTOR_STORE_PATH", "/tmp/note_taker_ai_vectors.json")
+VECTOR_STORE_PATH = os.getenv("AI_VECTOR_STORE_PATH", "/tmp/note_taker_ai_vectors.bin")
+VECTOR_STORE_BACKEND = os.getenv("AI_VECTOR_STORE_BACKEND", "file").strip().lower()
+VECTOR_SQLITE_PATH = os.getenv("AI_VECTOR_SQLITE_PATH", "/tmp/note_taker_ai_vectors.sqlite3")
+VECTOR_WAL_FSYNC = os.getenv("AI_VECTOR_WAL_FSYNC", "interval").strip().lower()
+VECTOR_WAL_FSYNC_INTERVAL_MS = max(0, int(os.getenv("AI_VECTOR_WAL_FSYNC_INTERVAL_MS", "1000")))
+VECTOR_PERSIST_MAX_DELAY_MS = max(0, int(os.getenv("AI_VECTOR_PERSIST_MAX_DELAY_MS", "200")))
+VECTOR_PERSIST_MAX_PENDING_OPS = max(1, int(os.getenv("AI_VECTOR_PERSIST_MAX_PENDING_OPS", "512")))
+VECTOR_WAL_COMPACT_BYTES = max(1, int(os.getenv("AI_VECTOR_WAL_COMPACT_BYTES", str(32 * 1024 * 1024))))
+VECTOR_WAL_COMPACT_INTERVAL_S = max(0.0, float(os.getenv("AI_VECTOR_WAL_COMPACT_INTERVAL_S", "3600")))
+VECTOR_ANN_INDEX = os.getenv("AI_VECTOR_ANN_INDEX", "none").strip().lower()
+VECTOR_ANN_MIN_ROWS = max(1, int(os.getenv("AI_VECTOR_ANN_MIN_ROWS", "5000")))
+VECTOR_HNSW_M = max(2, int(os.getenv("AI_VECTOR_HNSW_M", "16")))
+VECTOR_HNSW_EF_CONSTRUCTION = max(1, int(os.getenv("AI_VECTOR_HNSW_EF_CONSTRUCTION", "100")))
+VECTOR_HNSW_EF_SEARCH = max(1, int(os.getenv("AI_VECTOR_HNSW_EF_SEARCH", "64")))
+VECTOR_IVF_NLIST = max(0, int(os.getenv("AI_VECTOR_IVF_NLIST", "0")))
+VECTOR_IVF_NPROBE = max(1, int(os.getenv("AI_VECTOR_IVF_NPROBE", "8")))
+VECTOR_IVF_REBALANCE_RATIO = max(1.0, float(os.getenv("AI_VECTOR_IVF_REBALANCE_RATIO", "4.0")))
+VECTOR_CODEC = os.getenv("AI_VECTOR_CODEC", "float32").strip().lower()
+VECTOR_CODEC_MIN_ROWS = max(1, int(os.getenv("AI_VECTOR_CODEC_MIN_ROWS", "1024")))
+VECTOR_RESCORE_FACTOR = (
+    max(0, int(os.environ["AI_VECTOR_RESCORE_FACTOR"]))
+    if os.getenv("AI_VECTOR_RESCORE_FACTOR", "").strip()
+    else None
+)
+VECTOR_PQ_SUBVECTORS = max(0, int(os.getenv("AI_VECTOR_PQ_SUBVECTORS", "0")))
+SEARCH_BATCH_MAX_QUERIES = max(1, int(os.getenv("AI_SEARCH_BATCH_MAX_QUERIES", "32")))
+SEARCH_RRF_K = max(1, int(os.getenv("AI_SEARCH_RRF_K", "60")))
+SIMILAR_MAX_SOURCES = max(1, int(os.getenv("AI_SIMILAR_MAX_SOURCES", "100")))
+SEARCH_CURSOR_TTL_SEC = max(1, int(os.getenv("AI_SEARCH_CURSOR_TTL_SEC", "300")))
+SEARCH_CURSOR_CACHE_SIZE = max(1, int(os.getenv("AI_SEARCH_CURSOR_CACHE_SIZE", "64")))
+SEARCH_STREAM_MAX_RESULTS = max(1, int(os.getenv("AI_SEARCH_STREAM_MAX_RESULTS", "10000")))
+SEARCH_MMR_FETCH_FACTOR = max(1, int(os.getenv("AI_SEARCH_MMR_FETCH_FACTOR", "4")))
+SEARCH_HYBRID_FETCH = max(1, int(os.getenv("AI_SEARCH_HYBRID_FETCH", "50")))
+SIMILAR_GRAPH_K = max(0, int(os.getenv("AI_SIMILAR_GRAPH_K", "50")))
+DEDUPE_BLOCK_ROWS = max(64, int(os.getenv("AI_DEDUPE_BLOCK_ROWS", "2048")))
+DEDUPE_LSH_MIN_ROWS = max(1, int(os.getenv("AI_DEDUPE_LSH_MIN_ROWS", "5000")))
+DEDUPE_LSH_TABLES = max(1, int(os.getenv("AI_DEDUPE_LSH_TABLES", "20")))
+DEDUPE_LSH_BITS = max(1, min(62, int(os.getenv("AI_DEDUPE_LSH_BITS", "16"))))
+CLUSTER_MAX_K = max(1, int(os.getenv("AI_CLUSTER_MAX_K", "64")))
+CLUSTER_BATCH_ROWS = max(16, int(os.getenv("AI_CLUSTER_BATCH_ROWS", "1024")))
+CLUSTER_REFIT_RATIO = max(0.0, float(os.getenv("AI_CLUSTER_REFIT_RATIO", "0.2")))
+CLUSTER_CACHE_SIZE = max(1, int(os.getenv("AI_CLUSTER_CACHE_SIZE", "32")))
+EMBED_BATCH_SIZE = max(1, int(os.getenv("AI_EMBED_BATCH_SIZE", "64")))
+EMBED_CHUNK_WORDS = max(8, int(os.getenv("AI_EMBED_CHUNK_WORDS", "150")))
+EMBED_CHUNK_OVERLAP = max(0, min(EMBED_CHUNK_WORDS - 1, int(os.getenv("AI_EMBED_CHUNK_OVERLAP", "30"))))
+SEARCH_CHUNK_MEAN_TOP = max(1, int(os.getenv("AI_SEARCH_CHUNK_MEAN_TOP", "3")))
+VECTOR_INDEXED_METADATA_KEYS = [
+    key.strip()
+    for key in os.getenv("AI_VECTOR_INDEXED_METADATA", "articleId,tags").split(",")
+    if key.strip()
+]
 
 
 def _secret_fp(secret: str) -> str:
@@ -177,6 +250,7 @@ class EmbeddingUpsertItem(BaseModel):
 
 class EmbedUpsertRequest(BaseModel):
     items: List[EmbeddingUpsertItem] = Field(default_factory=list)
+    chunk: bool = False
 
 
 class EmbedDeleteRequest(BaseModel):
@@ -185,20 +259,72 @@ class EmbedDeleteRequest(BaseModel):
 
 class EmbedGetRequest(BaseModel):
     ids: List[str] = Field(default_factory=list)
+    fields: Optional[List[str]] = None
+    snippet: Optional[int] = Field(default=None, ge=1)
 
 
 class SearchRequest(BaseModel):
     userId: str
     query: str
     types: Optional[List[str]] = None
+    filter: Optional[Dict[str, Any]] = None
+    limit: Optional[int] = None
+    mode: Literal["vector", "hybrid", "lexical"] = "vector"
+    minScore: Optional[float] = None
+    mmrLambda: Optional[float] = Field(default=None, ge=0.0, le=1.0)
+    collapse: bool = False
+    chunkScore: Optional[Literal["max", "mean"]] = None
+    quotas: Optional[Dict[str, int]] = None
+    fields: Optional[List[str]] = None
+    snippet: Optional[int] = Field(default=None, ge=1)
+    paginate: bool = False
+    cursor: Optional[str] = None
+    stream: bool = False
+
+
+class SearchBatchRequest(BaseModel):
+    userId: str
+    queries: List[str] = Field(default_factory=list)
+    types: Optional[List[str]] = None
+    filter: Optional[Dict[str, Any]] = None
     limit: Optional[int] = 12
+    minScore: Optional[float] = None
+    fuse: bool = False
 
 
 class SimilarRequest(BaseModel):
     userId: str
-    sourceId: str
+    sourceId: str = ""
+    sourceIds: List[str] = Field(default_factory=list)
+    mode: Literal["centroid", "union"] = "centroid"
     types: Optional[List[str]] = None
-    limit: Optional[int] = 12
+    filter: Optional[Dict[str, Any]] = None
+    limit: Optional[int] = None
+    minScore: Optional[float] = None
+    mmrLambda: Optional[float] = Field(default=None, ge=0.0, le=1.0)
+    fields: Optional[List[str]] = None
+    snippet: Optional[int] = Field(default=None, ge=1)
+    paginate: bool = False
+    cursor: Optional[str] = None
+    stream: bool = False
+
+
+class DedupeRequest(BaseModel):
+    userId: str
+    types: Optional[List[str]] = None
+    filter: Optional[Dict[str, Any]] = None
+    threshold: float = Field(default=0.95, gt=0.0, le=1.0)
+    method: Literal["auto", "exact", "lsh"] = "auto"
+    limit: Optional[int] = None
+
+
+class ClusterRequest(BaseModel):
+    userId: str
+    types: Optional[List[str]] = None
+    filter: Optional[Dict[str, Any]] = None
+    k: Optional[int] = Field(default=None, ge=1)
+    exemplars: int = Field(default=3, ge=0, le=20)
+    maxMembers: Optional[int] = None
 
 
 def _parse_model_fallbacks(value: str) -> List[str]:
@@ -1163,291 +1289,4453 @@ def _sanitize_concept_plan_payload(data: Any, req: ConceptPlanRequest) -> Dict[s
     }
 
 
+class _VectorRecord:
+    """One stored vector record.
+
+    Slotted instead of a dict, with ``userId``/``objectType``/``subId``
+    interned, so a record costs one small object plus its embedding view.
+    ``text``/``metadata`` are None when the document lives on disk, in which
+    case ``segment``/``segmentRow`` (or the backend) locate it. ``chunkOf`` is
+    the id a chunked text was upserted under, None otherwise. Supports the
+    read side of the mapping protocol so call sites can keep using
+    ``record["id"]``, ``record.get(...)`` and ``"text" in record``.
+    """
+
+    __slots__ = (
+        "id",
+        "userId",
+        "objectType",
+        "objectId",
+        "subId",
+        "updatedAtMs",
+        "embedding",
+        "text",
+        "metadata",
+        "segment",
+        "segmentRow",
+        "chunkOf",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        userId: str,
+        objectType: str,
+        objectId: str,
+        subId: str,
+        updatedAtMs: int,
+        embedding: np.ndarray,
+        text: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        segment: Any = None,
+        segmentRow: Optional[int] = None,
+        chunkOf: Optional[str] = None,
+    ):
+        self.id = id
+        self.userId = sys.intern(userId)
+        self.objectType = sys.intern(objectType)
+        self.objectId = objectId
+        self.subId = sys.intern(subId)
+        self.updatedAtMs = updatedAtMs
+        self.embedding = embedding
+        self.text = text
+        self.metadata = metadata
+        self.segment = segment
+        self.segmentRow = segmentRow
+        self.chunkOf = chunkOf
+
+    @classmethod
+    def from_document(cls, document: Dict[str, Any], embedding: np.ndarray, **extra: Any) -> "_VectorRecord":
+        """Build from a decoded JSON document (segment columns, WAL payload, legacy store)."""
+        metadata = document.get("metadata")
+        text = document.get("text")
+        chunk_of = document.get("chunkOf")
+        return cls(
+            str(document.get("id") or ""),
+            str(document.get("userId") or ""),
+            str(document.get("objectType") or ""),
+            str(document.get("objectId") or ""),
+            str(document.get("subId") or ""),
+            int(document.get("updatedAtMs") or 0),
+            embedding,
+            text=None if text is None else str(text),
+            metadata=metadata if isinstance(metadata, dict) or (metadata is None and text is None) else {},
+            chunkOf=None if chunk_of is None else str(chunk_of),
+            **extra,
+        )
+
+    def replace(self, **changes: Any) -> "_VectorRecord":
+        """A shallow copy with ``changes`` applied; shares the embedding."""
+        clone = _VectorRecord.__new__(_VectorRecord)
+        for name in self.__slots__:
+            setattr(clone, name, changes[name] if name in changes else getattr(self, name))
+        return clone
+
+    def __getitem__(self, key: str) -> Any:
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __repr__(self) -> str:
+        return f"_VectorRecord(id={self.id!r}, userId={self.userId!r}, objectType={self.objectType!r})"
+
+
 _VECTOR_STORE_LOCK = threading.RLock()
-_VECTOR_STORE: Dict[str, Dict[str, Any]] = {}
+_VECTOR_STORE: Dict[str, _VectorRecord] = {}
 _VECTOR_STORE_LOADED = False
+_VECTOR_MATRIX_MIN_CAPACITY = 64
 
 
-def _safe_float_vector(values: Any) -> Optional[List[float]]:
-    if not isinstance(values, list) or not values:
-        return None
-    out: List[float] = []
-    for value in values:
-        if not isinstance(value, (int, float)):
+_EMPTY_ROWS = np.empty(0, dtype=np.int64)
+_VECTOR_CODEC_TRAIN_ROWS = 16384
+
+
+def _posting_values(value: Any) -> List[Any]:
+    values = value if isinstance(value, list) else [value]
+    return [v for v in values if isinstance(v, (str, int, float, bool))]
+
+
+_OBJECT_CODES: Dict[Tuple[str, str], int] = {}
+
+
+def _object_code(record: Dict[str, Any]) -> int:
+    """A process-wide integer for the record's ``(objectType, objectId)``; codes
+    are only ever added, so every partition version can share them."""
+    key = (str(record.get("objectType") or "").lower(), str(record.get("objectId") or ""))
+    code = _OBJECT_CODES.get(key)
+    if code is None:
+        code = _OBJECT_CODES.setdefault(key, len(_OBJECT_CODES))
+    return code
+
+
+def _record_posting_terms(record: Dict[str, Any]) -> List[Tuple[str, Any]]:
+    terms: List[Tuple[str, Any]] = [("objectType", str(record.get("objectType") or "").lower())]
+    metadata = record.get("metadata")
+    if metadata is None and record.get("segment") is not None:
+        # Segment metadata is decoded only when an indexed key shows up in its raw bytes.
+        raw = record.segment.raw_metadata(record.segmentRow)
+        if any(_encode_json(key) + b":" in raw for key in VECTOR_INDEXED_METADATA_KEYS):
+            metadata = json.loads(raw)
+    if isinstance(metadata, dict):
+        for key in VECTOR_INDEXED_METADATA_KEYS:
+            if key in metadata:
+                for value in _posting_values(metadata[key]):
+                    terms.append((f"metadata.{key}", value))
+    return list(dict.fromkeys(terms))
+
+
+class _Float32Codec:
+    """Uncompressed unit rows; scoring is a plain matrix-vector product."""
+
+    name = "float32"
+    lossy = False
+    rescore_factor = 0
+    dtype = np.float32
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.row_shape: Tuple[int, ...] = (dim,)
+        self.trained_rows = 0
+
+    def train(self, block: np.ndarray) -> None:
+        self.trained_rows = block.shape[0]
+
+    def encode(self, block: np.ndarray) -> np.ndarray:
+        return block.astype(np.float32, copy=False)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return codes @ query
+
+    def batch_scores(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """``(queries, rows)`` scores; one matrix-matrix product where the codec allows."""
+        return queries @ codes.T
+
+
+class _ChunkedCodec(_Float32Codec, abc.ABC):
+    """Lossy codecs score in chunks so no full float32 copy of the matrix is made."""
+
+    lossy = True
+    _CHUNK = 8192
+
+    @abc.abstractmethod
+    def _chunk_scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Scores of one chunk of ``codes`` against the (codec-prepared) query."""
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        if codes.ndim == 1:
+            return self._chunk_scores(codes[None], query)[0]
+        out = np.empty(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], self._CHUNK):
+            out[start : start + self._CHUNK] = self._chunk_scores(codes[start : start + self._CHUNK], query)
+        return out
+
+    def batch_scores(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        return np.stack([self.scores(codes, query) for query in queries])
+
+
+class _Float16Codec(_ChunkedCodec):
+    name = "float16"
+    rescore_factor = 2
+    dtype = np.float16
+
+    def encode(self, block: np.ndarray) -> np.ndarray:
+        return block.astype(np.float16)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32)
+
+    def _chunk_scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) @ query
+
+    def batch_scores(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        out = np.empty((queries.shape[0], codes.shape[0]), dtype=np.float32)
+        for start in range(0, codes.shape[0], self._CHUNK):
+            out[:, start : start + self._CHUNK] = queries @ codes[start : start + self._CHUNK].astype(np.float32).T
+        return out
+
+
+class _Int8Codec(_ChunkedCodec):
+    """Per-dimension scalar quantization to 256 levels over the trained min/max
+    (widened 5% so rows added before the next retrain rarely clip)."""
+
+    name = "int8"
+    rescore_factor = 4
+    dtype = np.uint8
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.low = np.full(dim, -1.0, dtype=np.float32)
+        self.step = np.full(dim, 2.0 / 255.0, dtype=np.float32)
+
+    def train(self, block: np.ndarray) -> None:
+        super().train(block)
+        low, high = block.min(axis=0), block.max(axis=0)
+        margin = 0.05 * (high - low)
+        low, high = low - margin, high + margin
+        self.low = low.astype(np.float32)
+        self.step = np.maximum((high - low) / 255.0, 1e-8).astype(np.float32)
+
+    def encode(self, block: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((block - self.low) / self.step), 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.low + codes.astype(np.float32) * self.step
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return super().scores(codes, query * self.step) + float(self.low @ query)
+
+    def _chunk_scores(self, codes: np.ndarray, scaled_query: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) @ scaled_query
+
+    def batch_scores(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        scaled = queries * self.step
+        out = np.empty((queries.shape[0], codes.shape[0]), dtype=np.float32)
+        for start in range(0, codes.shape[0], self._CHUNK):
+            out[:, start : start + self._CHUNK] = scaled @ codes[start : start + self._CHUNK].astype(np.float32).T
+        return out + (queries @ self.low)[:, None]
+
+
+class _PQCodec(_ChunkedCodec):
+    """Product quantization: ``m`` sub-vectors, each coded as one of 256 k-means
+    centroids. Scoring sums a per-query lookup table over the codes (ADC)."""
+
+    name = "pq"
+    rescore_factor = 20
+    dtype = np.uint8
+    _CENTROIDS = 256
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        wanted = VECTOR_PQ_SUBVECTORS or max(1, dim // 8)
+        self.m = max(d for d in range(1, min(wanted, dim) + 1) if dim % d == 0)
+        self.sub = dim // self.m
+        self.row_shape = (self.m,)
+        self.codebooks = np.zeros((self.m, self._CENTROIDS, self.sub), dtype=np.float32)
+        self.offsets = np.arange(self.m, dtype=np.int64) * self._CENTROIDS
+
+    def _split(self, block: np.ndarray) -> np.ndarray:
+        return block.reshape(block.shape[0], self.m, self.sub)
+
+    def train(self, block: np.ndarray) -> None:
+        super().train(block)
+        rng = np.random.default_rng(self.dim)
+        parts = self._split(block)
+        for j in range(self.m):
+            centroids = _kmeans(parts[:, j, :], self._CENTROIDS, rng, spherical=False)
+            self.codebooks[j, : centroids.shape[0]] = centroids
+            self.codebooks[j, centroids.shape[0] :] = centroids[0]
+
+    def encode(self, block: np.ndarray) -> np.ndarray:
+        parts = self._split(block)
+        codes = np.empty((block.shape[0], self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = _nearest_centroids(parts[:, j, :], self.codebooks[j], euclidean=True)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        single = codes.ndim == 1
+        codes = np.atleast_2d(codes)
+        out = self.codebooks[np.arange(self.m), codes].reshape(codes.shape[0], self.dim)
+        return out[0] if single else out
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        table = np.einsum("mcs,ms->mc", self.codebooks, query.reshape(self.m, self.sub)).ravel()
+        return super().scores(codes, table)
+
+    def _chunk_scores(self, codes: np.ndarray, table: np.ndarray) -> np.ndarray:
+        return table[codes + self.offsets].sum(axis=1, dtype=np.float32)
+
+
+class _SignCodec(_ChunkedCodec):
+    """One sign bit per dimension (relative to the trained mean, so a shared
+    embedding offset does not make every bit equal), packed into 64-bit words.
+
+    The first stage ranks rows by Hamming distance to the query's sketch
+    (XOR + popcount, 1 bit instead of 32 per dimension). Scores are the
+    sketch agreement ``1 - 2 * hamming / dim``, which is only good for
+    ordering. That makes it a prefilter, and re-scoring the survivors
+    exactly is what produces the returned scores.
+    """
+
+    name = "sign"
+    rescore_factor = 30
+    dtype = np.uint8
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.words = (dim + 63) // 64
+        self.row_shape = (self.words * 8,)
+        self.center = np.zeros(dim, dtype=np.float32)
+
+    def train(self, block: np.ndarray) -> None:
+        super().train(block)
+        self.center = block.mean(axis=0).astype(np.float32)
+
+    def encode(self, block: np.ndarray) -> np.ndarray:
+        bits = np.packbits(block > self.center, axis=1)
+        codes = np.zeros((block.shape[0], self.words * 8), dtype=np.uint8)
+        codes[:, : bits.shape[1]] = bits
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        signs = np.unpackbits(codes, axis=-1)[..., : self.dim].astype(np.float32)
+        return _unit_rows(np.atleast_2d(self.center + (2.0 * signs - 1.0) / math.sqrt(self.dim))).reshape(signs.shape)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return super().scores(codes, self.encode(query[None]).view(np.uint64)[0])
+
+    def _chunk_scores(self, codes: np.ndarray, sketch: np.ndarray) -> np.ndarray:
+        words = np.ascontiguousarray(codes).view(np.uint64)
+        hamming = np.bitwise_count(words ^ sketch).sum(axis=1, dtype=np.int32)
+        return 1.0 - 2.0 * hamming.astype(np.float32) / self.dim
+
+
+_VECTOR_CODECS = {
+    codec.name: codec for codec in (_Float32Codec, _Float16Codec, _Int8Codec, _PQCodec, _SignCodec)
+}
+
+
+_VECTOR_BUILDS: Set[threading.Thread] = set()
+_VECTOR_BUILDS_LOCK = threading.Lock()
+
+
+def _start_vector_build(target: Any, name: str) -> threading.Thread:
+    """Run an index or codec build on a daemon thread tracked by ``_join_vector_builds``."""
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    with _VECTOR_BUILDS_LOCK:
+        _VECTOR_BUILDS.difference_update([t for t in _VECTOR_BUILDS if not t.is_alive()])
+        _VECTOR_BUILDS.add(thread)
+    thread.start()
+    return thread
+
+
+def _join_vector_builds(timeout: Optional[float] = None) -> None:
+    """Wait for background builds, including any they start, to finish."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        with _VECTOR_BUILDS_LOCK:
+            running = [thread for thread in _VECTOR_BUILDS if thread.is_alive()]
+        if not running:
+            return
+        for thread in running:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0.0))
+        if deadline is not None and time.monotonic() >= deadline:
+            return
+
+
+class _HNSWIndex:
+    """Hierarchical navigable small-world graph over one partition's rows.
+
+    Nodes are append-only ids mapped to partition rows (``node_row`` /
+    ``row_node``) so the partition's swap-on-delete only relabels one node.
+    Vectors are read through ``partition.row_vectors`` and similarity is the dot
+    product of unit rows. Deletes unlink the node and reconnect its neighbours
+    from each other's lists; dead node ids are compacted away once they
+    outnumber live ones. ``candidates`` only proposes rows: the partition
+    re-scores them exactly before taking the top ``limit``.
+
+    A new index starts empty and not ``ready``: ``start_build`` builds the graph
+    on a background thread from the published version and installs it into a
+    new one, catching up the rows written meanwhile (recorded in ``touched``).
+    Until then the partition scans exactly.
+    """
+
+    kind = "hnsw"
+
+    def __init__(self, partition: "_VectorPartition", m: int, ef_construction: int):
+        self.partition = partition
+        self.m = max(2, m)
+        self.m0 = 2 * self.m
+        self.ef_construction = max(self.m, ef_construction)
+        self.level_mult = 1.0 / math.log(self.m)
+        self.rng = random.Random(f"{partition.user_id}:{partition.dim}")
+        self.node_row: List[int] = []
+        self.row_node: List[int] = []
+        self.levels: List[int] = []
+        self.links: List[List[List[int]]] = []
+        self.entry = -1
+        self.max_level = -1
+        self.live = 0
+        self.ready = False
+        self.build_thread: Optional[threading.Thread] = None
+        self.touched: Set[str] = set()
+        self.lineage = object()
+        self._owned: Optional[Set[int]] = None
+
+    def clone(self, partition: "_VectorPartition") -> "_HNSWIndex":
+        """Copy for a new partition version. Node lists are shared until a node's
+        links are first changed (see ``_own``), so this is O(nodes) pointers."""
+        index = copy.copy(self)
+        index.partition = partition
+        index.node_row = list(self.node_row)
+        index.row_node = list(self.row_node)
+        index.levels = list(self.levels)
+        index.links = list(self.links)
+        index._owned = set()
+        return index
+
+    def _own(self, node: int) -> List[List[int]]:
+        """``links[node]``, copied first if it is still shared with an older version."""
+        if self._owned is not None and node not in self._owned:
+            self.links[node] = [list(neighbors) for neighbors in self.links[node]]
+            self._owned.add(node)
+        return self.links[node]
+
+    def _similarities(self, nodes: List[int], query: np.ndarray) -> List[float]:
+        node_row = self.node_row
+        return (self.partition.row_vectors([node_row[n] for n in nodes]) @ query).tolist()
+
+    def _search_layer(
+        self,
+        query: np.ndarray,
+        entries: List[int],
+        ef: int,
+        level: int,
+        allowed: Optional[np.ndarray] = None,
+    ) -> Tuple[List[Tuple[float, int]], List[Tuple[float, int]]]:
+        """Best ``ef`` (sim, node) reached from ``entries``, and the best allowed ones."""
+        node_row = self.node_row
+        links = self.links
+        visited = set(entries)
+        sims = self._similarities(entries, query)
+        candidates = [(-sim, node) for sim, node in zip(sims, entries)]
+        heapq.heapify(candidates)
+        best = sorted(zip(sims, entries))[-ef:]
+        heapq.heapify(best)
+        found: List[Tuple[float, int]] = []
+        if allowed is not None:
+            for sim, node in zip(sims, entries):
+                if allowed[node_row[node]]:
+                    heapq.heappush(found, (sim, node))
+        while candidates:
+            neg_sim, node = heapq.heappop(candidates)
+            if -neg_sim < best[0][0] and len(best) >= ef:
+                break
+            fresh = [n for n in links[node][level] if n not in visited and node_row[n] >= 0]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            for sim, neighbor in zip(self._similarities(fresh, query), fresh):
+                if allowed is not None and allowed[node_row[neighbor]]:
+                    if len(found) < ef:
+                        heapq.heappush(found, (sim, neighbor))
+                    elif sim > found[0][0]:
+                        heapq.heapreplace(found, (sim, neighbor))
+                if len(best) < ef or sim > best[0][0]:
+                    heapq.heappush(candidates, (-sim, neighbor))
+                    heapq.heappush(best, (sim, neighbor))
+                    if len(best) > ef:
+                        heapq.heappop(best)
+        return best, found
+
+    def _select(self, scored: List[Tuple[float, int]], cap: int) -> List[int]:
+        """Neighbour-selection heuristic: keep a candidate only if it is closer to
+        the base than to any already kept one, then top up with the nearest."""
+        scored = sorted(scored, reverse=True)
+        if len(scored) <= cap:
+            return [node for _, node in scored]
+        nodes = [node for _, node in scored]
+        vectors = self.partition.row_vectors([self.node_row[n] for n in nodes])
+        pairwise = vectors @ vectors.T
+        closest_row = np.full(len(nodes), -np.inf, dtype=np.float32)
+        closest = closest_row.tolist()
+        chosen: List[int] = []
+        for i, (sim, _) in enumerate(scored):
+            if closest[i] < sim:
+                chosen.append(i)
+                if len(chosen) == cap:
+                    break
+                np.maximum(closest_row, pairwise[i], out=closest_row)
+                closest = closest_row.tolist()
+        if len(chosen) < cap:
+            kept = set(chosen)
+            chosen.extend([i for i in range(len(nodes)) if i not in kept][: cap - len(chosen)])
+        return [nodes[i] for i in chosen]
+
+    def _shrink(self, node: int, level: int, cap: int) -> None:
+        neighbors = [n for n in self.links[node][level] if self.node_row[n] >= 0]
+        if len(neighbors) > cap:
+            base = self.partition.row_vectors(self.node_row[node])
+            neighbors = self._select(list(zip(self._similarities(neighbors, base), neighbors)), cap)
+        self._own(node)[level] = neighbors
+
+    def build(self) -> None:
+        self.ready = True
+        for row in range(self.partition.size):
+            self.add(row)
+
+    def start_build(self) -> None:
+        if self.ready or (self.build_thread is not None and self.build_thread.is_alive()):
+            return
+        self.build_thread = _start_vector_build(self._build_in_background, "vector-hnsw-build")
+
+    def _current(self, partition: Optional["_VectorPartition"]) -> Optional["_HNSWIndex"]:
+        """``partition``'s index if it is still an unbuilt version of this one."""
+        ann = partition.ann if partition is not None else None
+        return ann if isinstance(ann, _HNSWIndex) and ann.lineage is self.lineage and not ann.ready else None
+
+    def _build_in_background(self) -> None:
+        """Build the graph off-lock on the published version, then move it onto
+        the current one (see ``adopt``). A failed build leaves the partition
+        without an index, so the next write starts another."""
+        key = (self.partition.user_id, self.partition.dim)
+        try:
+            with _VECTOR_STORE_LOCK:
+                published = _VECTOR_PARTITIONS.get(key)
+                if self._current(published) is None:
+                    return
+            started = time.perf_counter()
+            graph = _HNSWIndex(published, self.m, self.ef_construction)
+            graph.build()
+            with _vector_write():
+                partition = _draft_partition(key)
+                current = self._current(partition)
+                if current is None:
+                    return
+                graph.adopt(partition, current.touched)
+                partition.ann = graph
+            logger.info(
+                "[AI] built hnsw index for %s rows (user=%s dim=%s) in %.1fs",
+                published.size,
+                published.user_id,
+                published.dim,
+                time.perf_counter() - started,
+            )
+        except Exception as exc:
+            logger.warning("[AI] HNSW build failed: %s", exc)
+            with _vector_write():
+                if self._current(_VECTOR_PARTITIONS.get(key)) is not None:
+                    _draft_partition(key).ann = None
+
+    def adopt(self, partition: "_VectorPartition", touched: Set[str]) -> None:
+        """Move a graph built on an older version onto ``partition``. Nodes are
+        matched to rows by id; records in ``touched`` are re-linked, records gone
+        since are unlinked, and rows the graph never saw are added."""
+        ids = self.partition.ids
+        self.partition = partition
+        self.row_node = [-1] * partition.size
+        stale: List[int] = []
+        dead: List[int] = []
+        for node, old_row in enumerate(self.node_row):
+            record_id = ids[old_row]
+            row = partition.rows.get(record_id, -1)
+            if row >= 0 and self.row_node[row] < 0:
+                self.row_node[row] = node
+                if record_id in touched:
+                    stale.append(row)
+            else:
+                row = -1
+                dead.append(node)
+            self.node_row[node] = row
+        self.live -= len(dead)
+        for node in dead:
+            self._unlink(node)
+        if dead:
+            self._compact()
+        for row in stale:
+            self.replace(row)
+        for row in range(partition.size):
+            if self.row_node[row] < 0:
+                self.add(row)
+
+    def add(self, row: int) -> None:
+        if not self.ready:
+            self.touched.add(self.partition.ids[row])
+            return
+        node = len(self.node_row)
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+        self.node_row.append(row)
+        if row == len(self.row_node):
+            self.row_node.append(node)
+        else:
+            self.row_node[row] = node
+        self.levels.append(level)
+        self.links.append([[] for _ in range(level + 1)])
+        if self._owned is not None:
+            self._owned.add(node)
+        self.live += 1
+        if self.entry < 0:
+            self.entry, self.max_level = node, level
+            return
+        query = self.partition.row_vectors(row)
+        entries = [self.entry]
+        for lvl in range(self.max_level, level, -1):
+            best, _ = self._search_layer(query, entries, 1, lvl)
+            entries = [max(best)[1]]
+        for lvl in range(min(level, self.max_level), -1, -1):
+            best, _ = self._search_layer(query, entries, self.ef_construction, lvl)
+            neighbors = self._select(best, self.m)
+            self.links[node][lvl] = neighbors
+            cap = self.m0 if lvl == 0 else self.m
+            for neighbor in neighbors:
+                self._own(neighbor)[lvl].append(node)
+                if len(self.links[neighbor][lvl]) > cap:
+                    self._shrink(neighbor, lvl, cap)
+            entries = [n for _, n in best]
+        if level > self.max_level:
+            self.entry, self.max_level = node, level
+
+    def _unlink(self, node: int) -> None:
+        for lvl, neighbors in enumerate(self.links[node]):
+            cap = self.m0 if lvl == 0 else self.m
+            for neighbor in neighbors:
+                if self.node_row[neighbor] < 0 or node not in self.links[neighbor][lvl]:
+                    continue
+                their = self._own(neighbor)[lvl]
+                their.remove(node)
+                seen = set(their)
+                seen.add(neighbor)
+                their.extend(n for n in neighbors if n not in seen and self.node_row[n] >= 0)
+                if len(their) > cap:
+                    self._shrink(neighbor, lvl, cap)
+        self.links[node] = []
+        if node == self.entry:
+            self.entry, self.max_level = -1, -1
+            for candidate, level in enumerate(self.levels):
+                if self.node_row[candidate] >= 0 and level > self.max_level:
+                    self.entry, self.max_level = candidate, level
+
+    def _detach(self, node: int) -> None:
+        self.node_row[node] = -1
+        self.live -= 1
+        self._unlink(node)
+        if len(self.node_row) - self.live > max(self.live, 1024):
+            self._compact()
+
+    def replace(self, row: int) -> None:
+        """Re-link ``row`` after its vector changed in place."""
+        if not self.ready:
+            self.touched.add(self.partition.ids[row])
+            return
+        self._detach(self.row_node[row])
+        self.add(row)
+
+    def remove_row(self, row: int, last: int) -> None:
+        """Drop ``row``; the partition is about to move ``last`` into it."""
+        if not self.ready:
+            return
+        self._detach(self.row_node[row])
+        if row != last:
+            moved = self.row_node[last]
+            self.node_row[moved] = row
+            self.row_node[row] = moved
+        self.row_node.pop()
+
+    def _compact(self) -> None:
+        remap = {}
+        for node, row in enumerate(self.node_row):
+            if row >= 0:
+                remap[node] = len(remap)
+        self.links = [
+            [[remap[n] for n in neighbors if n in remap] for neighbors in self.links[node]]
+            for node in remap
+        ]
+        self.levels = [self.levels[node] for node in remap]
+        self.node_row = [self.node_row[node] for node in remap]
+        for node, row in enumerate(self.node_row):
+            self.row_node[row] = node
+        self.entry = remap.get(self.entry, -1)
+        self._owned = None
+
+    def candidates(
+        self,
+        query: np.ndarray,
+        limit: int,
+        allowed: Optional[np.ndarray] = None,
+        selectivity: float = 1.0,
+    ) -> np.ndarray:
+        """Sorted rows worth scoring exactly for the top ``limit``.
+
+        With ``allowed`` the walk still crosses every node but only allowed
+        rows are collected, and ``ef`` is widened by ``1 / selectivity``.
+        """
+        if self.entry < 0:
+            return _EMPTY_ROWS
+        ef = min(max(int(VECTOR_HNSW_EF_SEARCH / selectivity), limit), max(self.live, 1))
+        entries = [self.entry]
+        for lvl in range(self.max_level, 0, -1):
+            best, _ = self._search_layer(query, entries, 1, lvl)
+            entries = [max(best)[1]]
+        best, found = self._search_layer(query, entries, ef, 0, allowed)
+        picked = best if allowed is None else found
+        rows = np.fromiter((self.node_row[n] for _, n in picked), dtype=np.int64, count=len(picked))
+        rows.sort()
+        return rows
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        graph = self.clone(self.partition)
+        graph._compact()
+        ids = self.partition.ids
+        offsets = [0]
+        flat: List[int] = []
+        for node_links in graph.links:
+            for neighbors in node_links:
+                flat.extend(neighbors)
+                offsets.append(len(flat))
+        return {
+            "ids": np.asarray([ids[row] for row in graph.node_row], dtype=str),
+            "updated": self.partition.updated_at[np.asarray(graph.node_row, dtype=np.int64)],
+            "levels": np.asarray(graph.levels, dtype=np.int32),
+            "links": np.asarray(flat, dtype=np.int32),
+            "offsets": np.asarray(offsets, dtype=np.int64),
+            "meta": np.asarray([graph.m, graph.entry, graph.max_level], dtype=np.int64),
+        }
+
+    @classmethod
+    def restore(cls, partition: "_VectorPartition", arrays: Dict[str, np.ndarray]) -> Optional["_HNSWIndex"]:
+        """Rebuild a saved graph, then catch it up with the partition's current rows."""
+        m, entry, max_level = (int(v) for v in arrays["meta"])
+        if m != VECTOR_HNSW_M:
             return None
-        out.append(float(value))
+        index = cls(partition, m, VECTOR_HNSW_EF_CONSTRUCTION)
+        index.ready = True
+        index.levels = arrays["levels"].tolist()
+        flat = arrays["links"].tolist()
+        offsets = arrays["offsets"].tolist()
+        cursor = 0
+        for level in index.levels:
+            index.links.append(
+                [flat[offsets[cursor + lvl] : offsets[cursor + lvl + 1]] for lvl in range(level + 1)]
+            )
+            cursor += level + 1
+        index.row_node = [-1] * partition.size
+        stale: List[int] = []
+        for node, (record_id, updated) in enumerate(zip(arrays["ids"].tolist(), arrays["updated"].tolist())):
+            row = partition.rows.get(record_id, -1)
+            if row >= 0 and index.row_node[row] >= 0:
+                row = -1
+            index.node_row.append(row)
+            if row >= 0:
+                index.row_node[row] = node
+                index.live += 1
+                if int(partition.updated_at[row]) != updated:
+                    stale.append(row)
+        index.entry, index.max_level = entry, max_level
+        for node, row in enumerate(index.node_row):
+            if row < 0:
+                index._unlink(node)
+        index._compact()
+        for row in stale:
+            index.replace(row)
+        for row in range(partition.size):
+            if index.row_node[row] < 0:
+                index.add(row)
+        return index
+
+
+def _nearest_centroids(
+    block: np.ndarray, centroids: np.ndarray, chunk: int = 4096, euclidean: bool = False
+) -> np.ndarray:
+    """Index of the best centroid per row: highest dot product, or lowest L2 distance."""
+    bias = -0.5 * np.einsum("ij,ij->i", centroids, centroids) if euclidean else 0.0
+    out = np.empty(block.shape[0], dtype=np.int32)
+    for start in range(0, block.shape[0], chunk):
+        out[start : start + chunk] = np.argmax(block[start : start + chunk] @ centroids.T + bias, axis=1)
     return out
 
 
-def _load_vector_store_if_needed() -> None:
-    global _VECTOR_STORE_LOADED, _VECTOR_STORE
-    if _VECTOR_STORE_LOADED:
-        return
-    with _VECTOR_STORE_LOCK:
-        if _VECTOR_STORE_LOADED:
+def _kmeans(
+    sample: np.ndarray, k: int, rng: np.random.Generator, iterations: int = 10, spherical: bool = True
+) -> np.ndarray:
+    """Lloyd's k-means. ``spherical`` keeps unit centroids and assigns by dot product."""
+    k = max(1, min(k, sample.shape[0]))
+    centroids = sample[rng.choice(sample.shape[0], k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assign = _nearest_centroids(sample, centroids, euclidean=not spherical)
+        counts = np.bincount(assign, minlength=k)
+        order = np.argsort(assign, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        filled = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[filled] = np.add.reduceat(sample[order], starts[filled], axis=0)
+        if spherical:
+            sums = _unit_rows(sums)
+        else:
+            sums[filled] /= counts[filled, None]
+        empty = int((~filled).sum())
+        if empty:
+            sums[~filled] = sample[rng.choice(sample.shape[0], empty, replace=False)]
+        centroids = sums
+    return centroids
+
+
+def _kmeans_plus_plus(sample: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    """k-means++ seeding over unit rows: each next seed is drawn with probability
+    proportional to its cosine distance from the closest seed so far."""
+    picks = [int(rng.integers(sample.shape[0]))]
+    closest = np.maximum(1.0 - sample @ sample[picks[0]], 0.0)
+    for _ in range(1, k):
+        total = float(closest.sum())
+        if total > 0:
+            pick = int(rng.choice(sample.shape[0], p=closest / total))
+        else:
+            pick = int(rng.integers(sample.shape[0]))
+        picks.append(pick)
+        np.minimum(closest, np.maximum(1.0 - sample @ sample[pick], 0.0), out=closest)
+    return sample[picks].astype(np.float32)
+
+
+def _minibatch_kmeans(
+    block: np.ndarray,
+    k: int,
+    rng: np.random.Generator,
+    *,
+    batch: int,
+    steps: int,
+    centroids: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Spherical mini-batch k-means (Sculley, 2010) over unit rows.
+
+    Each step assigns ``batch`` random rows and moves every centroid toward the
+    mean of its batch members with a per-centroid rate of 1 / rows absorbed so
+    far, so cost per step is independent of ``block`` size. ``centroids`` warm
+    starts the fit; otherwise k-means++ seeds it.
+    """
+    size = block.shape[0]
+    k = max(1, min(k, size))
+    if centroids is None or centroids.shape[0] != k:
+        seed_rows = rng.choice(size, min(size, max(4096, 16 * k)), replace=False)
+        centroids = _kmeans_plus_plus(block[seed_rows], k, rng)
+    else:
+        centroids = centroids.astype(np.float32, copy=True)
+    counts = np.zeros(k, dtype=np.float32)
+    for _ in range(steps):
+        sample = block if size <= batch else block[rng.integers(0, size, batch)]
+        assign = _nearest_centroids(sample, centroids)
+        members = np.zeros((k, sample.shape[0]), dtype=np.float32)
+        members[assign, np.arange(sample.shape[0])] = 1.0
+        hits = members.sum(axis=1)
+        counts += hits
+        moved = hits > 0
+        step = members[moved] @ sample - hits[moved, None] * centroids[moved]
+        centroids[moved] += step / counts[moved, None]
+        centroids = _unit_rows(centroids)
+    return centroids
+
+
+class _IVFIndex:
+    """Inverted-file index: k-means centroids, each row filed under its nearest one.
+
+    A search scores the centroids, gathers the rows of the ``nprobe`` closest
+    lists and hands them back for exact scoring. Maintenance is one centroid
+    lookup per upsert. Every ``_CHECK_EVERY`` changes the list sizes are
+    checked. If the largest list is ``AI_VECTOR_IVF_REBALANCE_RATIO`` times
+    the mean, or the partition has grown 4x since training, the centroids are
+    retrained on a background thread. That thread trains on the published
+    version and installs the result into a new one, re-filing only rows that
+    changed in the meantime. A new index is trained the same way; until then
+    it has no lists, is not ``ready`` and the partition scans exactly.
+    """
+
+    kind = "ivf"
+    _CHECK_EVERY = 256
+    _SAMPLE_PER_LIST = 64
+
+    def __init__(self, partition: "_VectorPartition"):
+        self.partition = partition
+        self.rng = np.random.default_rng(zlib.crc32(f"{partition.user_id}:{partition.dim}".encode("utf-8")))
+        self.centroids = np.zeros((0, partition.dim), dtype=np.float32)
+        self.lists: List[Set[int]] = []
+        self.row_list: List[int] = []
+        self.trained_rows = 0
+        self.changes = 0
+        self.retrain_thread: Optional[threading.Thread] = None
+        self.touched: Optional[Set[str]] = None
+        self.lineage = object()
+        self._owned: Optional[Set[int]] = None
+
+    def clone(self, partition: "_VectorPartition") -> "_IVFIndex":
+        """Copy for a new partition version; list sets are copied when first changed."""
+        index = copy.copy(self)
+        index.partition = partition
+        index.lists = list(self.lists)
+        index.row_list = list(self.row_list)
+        index._owned = set()
+        return index
+
+    def _own(self, list_id: int) -> Set[int]:
+        if self._owned is not None and list_id not in self._owned:
+            self.lists[list_id] = set(self.lists[list_id])
+            self._owned.add(list_id)
+        return self.lists[list_id]
+
+    def _nlist(self, rows: int) -> int:
+        return VECTOR_IVF_NLIST or max(1, int(4 * math.sqrt(rows)))
+
+    def _install(self, centroids: np.ndarray, assign: np.ndarray) -> None:
+        self.centroids = centroids
+        self.lists = [set() for _ in range(centroids.shape[0])]
+        self.row_list = assign.tolist()
+        for row, list_id in enumerate(self.row_list):
+            self.lists[list_id].add(row)
+        self.trained_rows = self.partition.size
+        self.changes = 0
+        self._owned = None
+
+    def _train(self, vectors: np.ndarray) -> np.ndarray:
+        nlist = self._nlist(vectors.shape[0])
+        sample_size = min(vectors.shape[0], nlist * self._SAMPLE_PER_LIST)
+        sample = vectors[self.rng.choice(vectors.shape[0], sample_size, replace=False)]
+        return _kmeans(sample, nlist, self.rng)
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.lists)
+
+    def build(self) -> None:
+        vectors = self.partition.row_vectors(slice(0, self.partition.size))
+        centroids = self._train(vectors)
+        self._install(centroids, _nearest_centroids(vectors, centroids))
+
+    def start_build(self) -> None:
+        self.start_retrain()
+
+    def _note_change(self, row: int) -> None:
+        if self.touched is not None:
+            self.touched.add(self.partition.ids[row])
+        self.changes += 1
+        if self.changes % self._CHECK_EVERY == 0 and self.needs_retrain():
+            self.start_retrain()
+
+    def needs_retrain(self) -> bool:
+        size = self.partition.size
+        if size >= 4 * max(self.trained_rows, 1):
+            return True
+        mean = size / max(len(self.lists), 1)
+        return bool(self.lists) and max(len(rows) for rows in self.lists) > VECTOR_IVF_REBALANCE_RATIO * max(mean, 1.0)
+
+    def add(self, row: int) -> None:
+        if not self.lists:
+            self._note_change(row)
             return
+        list_id = int(np.argmax(self.centroids @ self.partition.row_vectors(row)))
+        if row == len(self.row_list):
+            self.row_list.append(list_id)
+        else:
+            self.row_list[row] = list_id
+        self._own(list_id).add(row)
+        self._note_change(row)
+
+    def replace(self, row: int) -> None:
+        if self.lists:
+            self._own(self.row_list[row]).discard(row)
+        self.add(row)
+
+    def remove_row(self, row: int, last: int) -> None:
+        if not self.lists:
+            self.changes += 1
+            return
+        self._own(self.row_list[row]).discard(row)
+        if row != last:
+            moved = self.row_list[last]
+            self._own(moved).discard(last)
+            self.lists[moved].add(row)
+            self.row_list[row] = moved
+        self.row_list.pop()
+        self.changes += 1
+
+    def candidates(
+        self,
+        query: np.ndarray,
+        limit: int,
+        allowed: Optional[np.ndarray] = None,
+        selectivity: float = 1.0,
+    ) -> np.ndarray:
+        """Sorted rows of the closest lists: at least ``nprobe`` of them (widened by
+        ``1 / selectivity``), and enough to hold ``limit`` rows."""
+        if not self.lists:
+            return _EMPTY_ROWS
+        nprobe = min(len(self.lists), math.ceil(VECTOR_IVF_NPROBE / selectivity))
+        order = np.argsort(-(self.centroids @ query))
+        gathered: List[int] = []
+        for probed, list_id in enumerate(order.tolist()):
+            if probed >= nprobe and len(gathered) >= limit:
+                break
+            gathered.extend(self.lists[list_id])
+        rows = np.fromiter(gathered, dtype=np.int64, count=len(gathered))
+        if allowed is not None:
+            rows = rows[allowed[rows]]
+        rows.sort()
+        return rows
+
+    def start_retrain(self) -> None:
+        if self.retrain_thread is not None and self.retrain_thread.is_alive():
+            return
+        self.retrain_thread = _start_vector_build(self.retrain, "vector-ivf-retrain")
+
+    def _current(self, partition: Optional["_VectorPartition"]) -> Optional["_IVFIndex"]:
+        """``partition``'s index if it is still a version of this one."""
+        ann = partition.ann if partition is not None else None
+        return ann if isinstance(ann, _IVFIndex) and ann.lineage is self.lineage else None
+
+    def retrain(self) -> None:
+        """Retrain centroids off-lock on the published version, then install them
+        into a new version, re-filing rows changed meanwhile."""
+        key = (self.partition.user_id, self.partition.dim)
+        touched: Set[str] = set()
         try:
-            if os.path.exists(VECTOR_STORE_PATH):
-                with open(VECTOR_STORE_PATH, "r", encoding="utf-8") as fh:
-                    raw = json.load(fh)
-                if isinstance(raw, dict):
-                    loaded: Dict[str, Dict[str, Any]] = {}
-                    for key, value in raw.items():
-                        if not isinstance(key, str) or not isinstance(value, dict):
-                            continue
-                        vec = _safe_float_vector(value.get("embedding"))
-                        if not vec:
-                            continue
-                        loaded[key] = {
-                            "id": str(value.get("id") or key),
-                            "userId": str(value.get("userId") or ""),
-                            "objectType": str(value.get("objectType") or ""),
-                            "objectId": str(value.get("objectId") or ""),
-                            "subId": str(value.get("subId") or ""),
-                            "text": str(value.get("text") or ""),
-                            "metadata": value.get("metadata") if isinstance(value.get("metadata"), dict) else {},
-                            "embedding": vec,
-                            "updatedAtMs": int(value.get("updatedAtMs") or int(time.time() * 1000)),
-                        }
-                    _VECTOR_STORE = loaded
+            with _VECTOR_STORE_LOCK:
+                published = _VECTOR_PARTITIONS.get(key)
+                current = self._current(published)
+                if current is None:
+                    return
+                current.touched = touched
+            ids = list(published.ids)
+            vectors = published.row_vectors(slice(0, published.size))
+            centroids = self._train(vectors)
+            assigned = dict(zip(ids, _nearest_centroids(vectors, centroids).tolist()))
+            with _vector_write():
+                partition = _draft_partition(key)
+                current = self._current(partition)
+                if current is None:
+                    return
+                assign = np.asarray(
+                    [-1 if record_id in touched else assigned.get(record_id, -1) for record_id in partition.ids],
+                    dtype=np.int32,
+                )
+                stale = np.flatnonzero(assign < 0)
+                if stale.size:
+                    assign[stale] = _nearest_centroids(partition.row_vectors(stale), centroids)
+                trained = current.ready
+                current._install(centroids, assign)
+                current.touched = None
+                logger.info(
+                    "[AI] %s IVF index (user=%s rows=%s lists=%s)",
+                    "retrained" if trained else "trained",
+                    partition.user_id,
+                    partition.size,
+                    centroids.shape[0],
+                )
         except Exception as exc:
-            logger.warning("[AI] failed to load vector store from %s: %s", VECTOR_STORE_PATH, exc)
-            _VECTOR_STORE = {}
-        finally:
-            _VECTOR_STORE_LOADED = True
-
+            logger.warning("[AI] IVF retrain failed: %s", exc)
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        return {
+            "ids": np.asarray(self.partition.ids, dtype=str),
+            "updated": self.partition.updated_at[: self.partition.size].copy(),
+            "lists": np.asarray(self.row_list, dtype=np.int32),
+            "centroids": self.centroids,
+            "meta": np.asarray([self.trained_rows], dtype=np.int64),
+        }
 
-def _persist_vector_store() -> None:
-    _load_vector_store_if_needed()
-    directory = os.path.dirname(VECTOR_STORE_PATH) or "."
-    os.makedirs(directory, exist_ok=True)
-    tmp_path = f"{VECTOR_STORE_PATH}.tmp"
-    with _VECTOR_STORE_LOCK:
-        serializable = {
-            key: {
-                **value,
-                "embedding": list(value.get("embedding") or []),
-            }
-            for key, value in _VECTOR_STORE.items()
+    @classmethod
+    def restore(cls, partition: "_VectorPartition", arrays: Dict[str, np.ndarray]) -> Optional["_IVFIndex"]:
+        centroids = np.asarray(arrays["centroids"], dtype=np.float32)
+        if centroids.ndim != 2 or centroids.shape[1] != partition.dim:
+            return None
+        index = cls(partition)
+        assigned = {
+            record_id: (list_id, updated)
+            for record_id, list_id, updated in zip(
+                arrays["ids"].tolist(), arrays["lists"].tolist(), arrays["updated"].tolist()
+            )
         }
-    with open(tmp_path, "w", encoding="utf-8") as fh:
-        json.dump(serializable, fh)
-    os.replace(tmp_path, VECTOR_STORE_PATH)
+        assign = np.full(partition.size, -1, dtype=np.int32)
+        for row, record_id in enumerate(partition.ids):
+            list_id, updated = assigned.get(record_id, (-1, None))
+            if updated == int(partition.updated_at[row]):
+                assign[row] = list_id
+        stale = np.flatnonzero(assign < 0)
+        if stale.size:
+            assign[stale] = _nearest_centroids(partition.row_vectors(stale), centroids)
+        index._install(centroids, assign)
+        index.trained_rows = int(arrays["meta"][0])
+        return index
 
 
-def _normalize_types(types: Optional[List[str]]) -> Optional[Set[str]]:
-    if not types:
-        return None
-    normalized = {
-        str(t or "").strip().lower()
-        for t in types
-        if str(t or "").strip()
-    }
-    return normalized or None
+_LEXICAL_TOKEN = re.compile(r"[^\W_]+")
+_BM25_K1 = 1.2
+_BM25_B = 0.75
 
 
-def _clamp_limit(value: Optional[int], default: int = 12, max_limit: int = 50) -> int:
-    try:
-        parsed = int(value if value is not None else default)
-    except Exception:
-        parsed = default
-    if parsed < 1:
-        return 1
-    return min(parsed, max_limit)
+def _lexical_terms(text: str) -> List[str]:
+    """Lower-cased word tokens, interned so postings and row term lists share them."""
+    return [sys.intern(token) for token in _LEXICAL_TOKEN.findall(str(text or "").lower()) if len(token) <= 64]
 
 
-def _cosine_similarity(a: List[float], b: List[float]) -> float:
-    if not a or not b or len(a) != len(b):
-        return 0.0
-    dot = 0.0
-    norm_a = 0.0
-    norm_b = 0.0
-    for i in range(len(a)):
-        av = float(a[i])
-        bv = float(b[i])
-        dot += av * bv
-        norm_a += av * av
-        norm_b += bv * bv
-    if norm_a <= 0 or norm_b <= 0:
-        return 0.0
-    return dot / (math.sqrt(norm_a) * math.sqrt(norm_b))
-
-
-def _vector_result(record: Dict[str, Any], score: Optional[float] = None) -> Dict[str, Any]:
-    out = {
-        "id": record.get("id", ""),
-        "objectType": record.get("objectType", ""),
-        "objectId": record.get("objectId", ""),
-        "subId": record.get("subId", ""),
-        "metadata": record.get("metadata", {}) if isinstance(record.get("metadata"), dict) else {},
-        "document": record.get("text", ""),
-    }
-    if score is not None:
-        out["score"] = score
+def _record_texts(records: List[Optional[_VectorRecord]]) -> List[str]:
+    """Each record's ``text``, read from its segment or the backend when not resident."""
+    missing = [record.id for record in records if record is not None and record.text is None and record.segment is None]
+    documents = _VECTOR_BACKEND.fetch_documents(missing) if missing else {}
+    out: List[str] = []
+    for record in records:
+        if record is None:
+            out.append("")
+        elif record.text is not None:
+            out.append(record.text)
+        elif record.segment is not None:
+            out.append(record.segment.raw_text(record.segmentRow).decode("utf-8"))
+        else:
+            out.append(documents.get(record.id, {}).get("text") or "")
     return out
 
 
-async def _hf_embed_texts(texts: List[str], config: Optional[Dict[str, Any]] = None) -> List[List[float]]:
-    if not texts:
-        return []
-    cfg = config or get_hf_config()
-    if not cfg["token"]:
-        raise HTTPException(status_code=500, detail="HF_TOKEN not configured")
-    try:
-        url = build_models_inference_url(
-            cfg["models_base_url"],
-            cfg["embedding_model"],
-            "pipeline/feature-extraction"
+class _LexicalIndex:
+    """BM25 postings over one partition's record ``text``: term -> {row: term frequency}.
+
+    Rows follow the partition's rows, including the swap-last move on delete.
+    Cloned with the partition; a term's postings are copied the first time a
+    clone changes them, as with the partition's filter postings.
+    """
+
+    def __init__(self, capacity: int = _VECTOR_MATRIX_MIN_CAPACITY):
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.row_terms: List[Tuple[str, ...]] = []
+        self.lengths = np.zeros(max(capacity, 1), dtype=np.int32)
+        self.total_length = 0
+        self._owned: Optional[Set[str]] = None
+
+    @classmethod
+    def build(cls, records: List[Optional[_VectorRecord]]) -> "_LexicalIndex":
+        """An index over ``records``, one row each, in order."""
+        index = cls(len(records))
+        for row, text in enumerate(_record_texts(records)):
+            index.set_row(row, text)
+        return index
+
+    def catch_up(self, partition: "_VectorPartition", records: List[Optional[_VectorRecord]]) -> None:
+        """Move an index built from ``records`` onto ``partition``: rows now
+        holding a different record are re-indexed and rows past its end dropped.
+        Call inside ``_vector_write``, with ``partition`` a draft."""
+        store = _VECTOR_STORE
+        changed = [
+            row
+            for row, record_id in enumerate(partition.ids)
+            if row >= len(records) or store.get(record_id) is not records[row]
+        ]
+        for row, text in zip(changed, _record_texts([store.get(partition.ids[row]) for row in changed])):
+            self.set_row(row, text)
+        while len(self.row_terms) > partition.size:
+            self._clear(len(self.row_terms) - 1)
+            self.row_terms.pop()
+
+    def clone(self) -> "_LexicalIndex":
+        index = copy.copy(self)
+        index.postings = dict(self.postings)
+        index.row_terms = list(self.row_terms)
+        index.lengths = self.lengths.copy()
+        index._owned = set()
+        return index
+
+    def _rows(self, term: str) -> Dict[int, int]:
+        """``term``'s postings for writing, copied first if an older version shares them."""
+        rows = self.postings.get(term)
+        if rows is None:
+            rows = self.postings[term] = {}
+        elif self._owned is not None and term not in self._owned:
+            rows = self.postings[term] = dict(rows)
+        else:
+            return rows
+        if self._owned is not None:
+            self._owned.add(term)
+        return rows
+
+    def set_row(self, row: int, text: str) -> None:
+        """Index ``text`` as ``row``, replacing what the row held; a new row is the next one."""
+        if row < len(self.row_terms):
+            self._clear(row)
+        else:
+            self.row_terms.append(())
+            if row >= self.lengths.size:
+                lengths = np.zeros(self.lengths.size * 2, dtype=np.int32)
+                lengths[: self.lengths.size] = self.lengths
+                self.lengths = lengths
+        terms = _lexical_terms(text)
+        counts: Dict[str, int] = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            self._rows(term)[row] = count
+        self.row_terms[row] = tuple(counts)
+        self.lengths[row] = len(terms)
+        self.total_length += len(terms)
+
+    def _clear(self, row: int) -> None:
+        for term in self.row_terms[row]:
+            rows = self._rows(term)
+            del rows[row]
+            if not rows:
+                del self.postings[term]
+        self.total_length -= int(self.lengths[row])
+        self.row_terms[row] = ()
+        self.lengths[row] = 0
+
+    def remove(self, row: int, last: int) -> None:
+        """Drop ``row`` and move ``last`` into it, as ``_VectorPartition.remove`` does."""
+        self._clear(row)
+        if row != last:
+            terms = self.row_terms[last]
+            for term in terms:
+                rows = self._rows(term)
+                rows[row] = rows.pop(last)
+            self.row_terms[row] = terms
+            self.lengths[row] = self.lengths[last]
+            self.lengths[last] = 0
+        self.row_terms.pop()
+
+    def scores(self, terms: List[str], size: int) -> np.ndarray:
+        """BM25 score of every row for the query ``terms``; rows matching none score 0."""
+        out = np.zeros(size, dtype=np.float32)
+        if size == 0:
+            return out
+        average = max(self.total_length / size, 1e-9)
+        norm = _BM25_K1 * (1.0 - _BM25_B + _BM25_B * self.lengths[:size].astype(np.float32) / average)
+        for term in dict.fromkeys(terms):
+            rows = self.postings.get(term)
+            if not rows:
+                continue
+            idf = math.log(1.0 + (size - len(rows) + 0.5) / (len(rows) + 0.5))
+            at = np.fromiter(rows.keys(), dtype=np.int64, count=len(rows))
+            tf = np.fromiter(rows.values(), dtype=np.float32, count=len(rows))
+            out[at] += idf * tf * (_BM25_K1 + 1.0) / (tf + norm[at])
+        return out
+
+
+class _NeighborGraph:
+    """Cached ``/similar`` neighbour lists of one partition, kept exact under writes.
+
+    ``lists`` maps a source id to its top ``k`` neighbours ``(ids, scores,
+    complete)``, best first; a list is filled by an exact scan the first time
+    the source is asked for (see ``_similar_neighbors``). ``complete`` means every positively scored row is in
+    the list. ``holders`` maps a neighbour id to the sources listing it, and
+    ``floor`` holds, per source row, the score a new row must beat to enter that
+    source's list (``inf`` for rows without one), so a write is one scan of the
+    partition against the floors. Lists only shrink on delete, which keeps them
+    an exact prefix; one too short for a request is filled again.
+
+    Cloned with the partition and, like it, only changed on a draft; holder
+    sets are copied the first time the clone changes them.
+    """
+
+    def __init__(self, k: int, capacity: int = _VECTOR_MATRIX_MIN_CAPACITY):
+        self.k = k
+        self.lists: Dict[str, Tuple[Tuple[str, ...], np.ndarray, bool]] = {}
+        self.holders: Dict[str, Set[str]] = {}
+        self.floor = np.full(max(capacity, 1), np.inf, dtype=np.float32)
+        self._owned: Set[str] = set()
+
+    def clone(self) -> "_NeighborGraph":
+        graph = copy.copy(self)
+        graph.lists = dict(self.lists)
+        graph.holders = dict(self.holders)
+        graph.floor = self.floor.copy()
+        graph._owned = set()
+        return graph
+
+    def _holder(self, record_id: str) -> Set[str]:
+        """The sources listing ``record_id``, for writing; copied first if shared."""
+        sources = self.holders.get(record_id)
+        if sources is None:
+            sources = self.holders[record_id] = set()
+        elif record_id not in self._owned:
+            sources = self.holders[record_id] = set(sources)
+        self._owned.add(record_id)
+        return sources
+
+    def _set(self, source_id: str, row: int, ids: Tuple[str, ...], scores: np.ndarray, complete: bool) -> None:
+        old = self.lists.get(source_id)
+        if old is not None:
+            for record_id in set(old[0]) - set(ids):
+                self._holder(record_id).discard(source_id)
+        for record_id in ids:
+            self._holder(record_id).add(source_id)
+        self.lists[source_id] = (ids, scores, complete)
+        self.floor[row] = 0.0 if complete else (scores[-1] if len(ids) else np.inf)
+
+    def _drop(self, source_id: str, row: int) -> None:
+        old = self.lists.pop(source_id, None)
+        if old is not None:
+            for record_id in old[0]:
+                self._holder(record_id).discard(source_id)
+        self.floor[row] = np.inf
+
+    def neighbors(self, source_id: str, limit: int) -> Optional[List[Tuple[float, str]]]:
+        """Top ``limit`` (score, id) neighbours of ``source_id``; None when the
+        cached list is missing or too short and a scan has to fill it."""
+        entry = self.lists.get(source_id)
+        if entry is None or (len(entry[0]) < limit and not entry[2]):
+            return None
+        ids, scores, _ = entry
+        return [(float(score), record_id) for score, record_id in zip(scores[:limit].tolist(), ids[:limit])]
+
+    def fill(self, partition: "_VectorPartition", source_id: str, hits: List[Tuple[float, str]]) -> None:
+        """Cache ``hits``, an exact top ``k`` scan of ``partition``, as ``source_id``'s list."""
+        ids = tuple(record_id for _, record_id in hits)
+        scores = np.asarray([score for score, _ in hits], dtype=np.float32)
+        self._set(source_id, partition.rows[source_id], ids, scores, len(hits) < self.k)
+
+    def detach(self, partition: "_VectorPartition", row: int) -> None:
+        """Forget row ``row``'s list and remove it from every list holding it."""
+        record_id = partition.ids[row]
+        self._drop(record_id, row)
+        for source_id in self.holders.pop(record_id, ()):
+            entry = self.lists.get(source_id)
+            if entry is None or record_id not in entry[0]:
+                continue
+            keep = [pos for pos, other in enumerate(entry[0]) if other != record_id]
+            ids, scores = tuple(entry[0][pos] for pos in keep), entry[1][keep]
+            self.lists[source_id] = (ids, scores, entry[2])
+            source_row = partition.rows.get(source_id)
+            if source_row is not None and not entry[2]:
+                self.floor[source_row] = scores[-1] if len(ids) else np.inf
+        self._owned.discard(record_id)
+
+    def add(self, partition: "_VectorPartition", row: int) -> None:
+        """Enter the (new or re-embedded) row into every list whose floor it beats.
+        Few cached lists are scored directly; otherwise the whole partition is."""
+        size = partition.size
+        if self.floor.shape[0] < size:
+            floor = np.full(max(size, 2 * self.floor.shape[0]), np.inf, dtype=np.float32)
+            floor[: self.floor.shape[0]] = self.floor
+            self.floor = floor
+        self.floor[row] = np.inf
+        if not self.lists:
+            return
+        record_id = partition.ids[row]
+        query = partition.row_vectors(row)
+        rows: Optional[np.ndarray] = np.flatnonzero(self.floor[:size] < np.inf)
+        if 4 * rows.size < size:
+            scores = partition.codec.scores(partition.vectors[rows], query)
+            entered = np.flatnonzero(scores > self.floor[rows])
+        else:
+            rows = None
+            scores = partition.codec.scores(partition.vectors[:size], query)
+            entered = np.flatnonzero(scores > self.floor[:size])
+        for pos in entered.tolist():
+            source_row = pos if rows is None else int(rows[pos])
+            source_id = partition.ids[source_row]
+            ids, old_scores, complete = self.lists[source_id]
+            score = scores[pos]
+            at = int(np.searchsorted(-old_scores, -score, side="right"))
+            ids = ids[:at] + (record_id,) + ids[at:]
+            new_scores = np.insert(old_scores, at, score)
+            if len(ids) > self.k:
+                self._holder(ids[-1]).discard(source_id)
+                ids, new_scores, complete = ids[: self.k], new_scores[: self.k], False
+            self._holder(record_id).add(source_id)
+            self.lists[source_id] = (ids, new_scores, complete)
+            self.floor[source_row] = 0.0 if complete else new_scores[-1]
+
+    def move(self, row: int, last: int) -> None:
+        """Follow the partition's swap-last delete: ``last``'s floor moves to ``row``."""
+        self.floor[row] = self.floor[last]
+        self.floor[last] = np.inf
+
+
+class _VectorPartition:
+    """One tenant's embeddings of a single dimension, packed into a float32 matrix.
+
+    Rows are L2-normalized and contiguous: deleting a record moves the last row
+    into the hole so a scan is always a single ``vectors[:size] @ query``
+    product over the caller's rows only. ``objectType`` and the metadata keys in
+    ``AI_VECTOR_INDEXED_METADATA`` are kept as posting lists (value -> rows) and
+    ``updatedAtMs`` as an int64 column, so filters pick rows before scoring;
+    ``objects`` codes each row's ``(objectType, objectId)`` for grouped search.
+    Once a partition reaches ``AI_VECTOR_ANN_MIN_ROWS`` rows and
+    ``AI_VECTOR_ANN_INDEX`` is set, ``ann`` proposes candidate rows and only
+    those are scored; it is built in the background, and exact scans serve
+    until it is ready. ``vectors`` holds ``codec`` codes; with a lossy codec the
+    best candidates are re-scored from the full-precision record embeddings.
+    ``lexical`` is the BM25 index over record text, built on the first lexical
+    query and maintained by every later write; ``knn`` caches ``/similar``
+    neighbour lists the same way (see ``_NeighborGraph``).
+
+    A partition is immutable once published in ``_VECTOR_PARTITIONS``: writers
+    change a ``clone`` and publish that (see ``_vector_write``).
+    """
+
+    def __init__(self, user_id: str, dim: int):
+        self.user_id = user_id
+        self.dim = dim
+        self.size = 0
+        self.codec: _Float32Codec = _Float32Codec(dim)
+        self.vectors = np.zeros((_VECTOR_MATRIX_MIN_CAPACITY, dim), dtype=np.float32)
+        self.updated_at = np.zeros(_VECTOR_MATRIX_MIN_CAPACITY, dtype=np.int64)
+        self.objects = np.zeros(_VECTOR_MATRIX_MIN_CAPACITY, dtype=np.int64)
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.postings: Dict[str, Dict[Any, Set[int]]] = {}
+        self.row_terms: List[List[Tuple[str, Any]]] = []
+        self.ann: Optional[Any] = None
+        self.codec_touched: Optional[Set[str]] = None
+        self.lexical: Optional[_LexicalIndex] = None
+        self.knn: Optional[_NeighborGraph] = None
+        self._owned_postings: Optional[Set[int]] = None
+        self._shared_rows = 0
+
+    def clone(self) -> "_VectorPartition":
+        """A writable copy for the next version. Row maps are copied; the
+        ``vectors``/``updated_at`` arrays are shared, and only copied when a row
+        an older version can still see is overwritten (see ``_writable``), so
+        appends cost nothing extra. Posting sets are shared until first changed."""
+        partition = copy.copy(self)
+        partition._shared_rows = max(self._shared_rows, self.size)
+        partition.ids = list(self.ids)
+        partition.rows = dict(self.rows)
+        partition.row_terms = list(self.row_terms)
+        partition.postings = {field: dict(values) for field, values in self.postings.items()}
+        partition._owned_postings = set()
+        partition.ann = self.ann.clone(partition) if self.ann is not None else None
+        partition.lexical = self.lexical.clone() if self.lexical is not None else None
+        partition.knn = self.knn.clone() if self.knn is not None else None
+        return partition
+
+    def _posting(self, field: str, value: Any, create: bool) -> Optional[Set[int]]:
+        """The row set for ``field == value``, copied first if an older version shares it."""
+        values = self.postings.setdefault(field, {}) if create else self.postings.get(field, {})
+        rows = values.get(value)
+        if rows is None:
+            if not create:
+                return None
+            rows = values[value] = set()
+        elif self._owned_postings is not None and id(rows) not in self._owned_postings:
+            rows = values[value] = set(rows)
+        else:
+            return rows
+        if self._owned_postings is not None:
+            self._owned_postings.add(id(rows))
+        return rows
+
+    def _ensure_capacity(self, needed: int) -> None:
+        capacity = self.vectors.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        self._reallocate(capacity)
+
+    def _reallocate(self, capacity: int) -> None:
+        vectors = np.zeros((capacity, *self.codec.row_shape), dtype=self.codec.dtype)
+        vectors[: self.size] = self.vectors[: self.size]
+        updated_at = np.zeros(capacity, dtype=np.int64)
+        updated_at[: self.size] = self.updated_at[: self.size]
+        objects = np.zeros(capacity, dtype=np.int64)
+        objects[: self.size] = self.objects[: self.size]
+        self.vectors, self.updated_at, self.objects = vectors, updated_at, objects
+        self._shared_rows = 0
+
+    def _writable(self, row: int) -> None:
+        """Copy the arrays before writing ``row`` if a published version can read it."""
+        if row < self._shared_rows:
+            self._reallocate(self.vectors.shape[0])
+
+    def _post(self, row: int, terms: List[Tuple[str, Any]]) -> None:
+        for field, value in terms:
+            self._posting(field, value, True).add(row)
+
+    def _unpost(self, row: int, terms: List[Tuple[str, Any]]) -> None:
+        for field, value in terms:
+            rows = self._posting(field, value, False)
+            if rows is None:
+                continue
+            rows.discard(row)
+            if not rows:
+                del self.postings[field][value]
+
+    def upsert(self, record: Dict[str, Any], embedding: np.ndarray) -> None:
+        record_id = record["id"]
+        row = self.rows.get(record_id)
+        added = row is None
+        if added:
+            self._ensure_capacity(self.size + 1)
+            row = self.size
+            self.size += 1
+            self.rows[record_id] = row
+            self.ids.append(record_id)
+            self.row_terms.append([])
+        self._writable(row)
+        self.vectors[row] = self.codec.encode(embedding[None])[0]
+        if self.codec_touched is not None:
+            self.codec_touched.add(record_id)
+        self.updated_at[row] = int(record.get("updatedAtMs") or 0)
+        self.objects[row] = _object_code(record)
+        self._unpost(row, self.row_terms[row])
+        self.row_terms[row] = _record_posting_terms(record)
+        self._post(row, self.row_terms[row])
+        if self.lexical is not None:
+            self.lexical.set_row(row, _record_texts([record])[0])
+        self.ensure_codec()
+        if self.knn is not None and self.codec.lossy:
+            self.knn = None
+        elif self.knn is not None:
+            if not added:
+                self.knn.detach(self, row)
+            self.knn.add(self, row)
+        if self.ann is None:
+            self.ensure_ann()
+        elif added:
+            self.ann.add(row)
+        else:
+            self.ann.replace(row)
+
+    def extend(self, records: List[Dict[str, Any]]) -> None:
+        """Bulk-append records that are not yet in the partition (boot path)."""
+        if not records:
+            return
+        start = self.size
+        self._ensure_capacity(start + len(records))
+        self._writable(start)
+        block = np.vstack([record["embedding"] for record in records]).astype(np.float32)
+        self.vectors[start : start + len(records)] = self.codec.encode(_unit_rows(block))
+        if self.codec_touched is not None:
+            self.codec_touched.update(record["id"] for record in records)
+        for offset, record in enumerate(records):
+            row = start + offset
+            self.rows[record["id"]] = row
+            self.ids.append(record["id"])
+            self.updated_at[row] = int(record.get("updatedAtMs") or 0)
+            self.objects[row] = _object_code(record)
+            terms = _record_posting_terms(record)
+            self.row_terms.append(terms)
+            self._post(row, terms)
+        if self.lexical is not None:
+            for row, text in enumerate(_record_texts(records), start=start):
+                self.lexical.set_row(row, text)
+        self.size = start + len(records)
+        self.ensure_codec()
+        if self.knn is not None and self.codec.lossy:
+            self.knn = None
+        elif self.knn is not None:
+            for row in range(start, self.size):
+                self.knn.add(self, row)
+        if self.ann is not None:
+            for row in range(start, self.size):
+                self.ann.add(row)
+
+    def remove(self, record_id: str) -> bool:
+        row = self.rows.pop(record_id, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if self.ann is not None:
+            self.ann.remove_row(row, last)
+        if self.lexical is not None:
+            self.lexical.remove(row, last)
+        if self.knn is not None:
+            self.knn.detach(self, row)
+            self.knn.move(row, last)
+        self._unpost(row, self.row_terms[row])
+        if row != last:
+            moved_id = self.ids[last]
+            moved_terms = self.row_terms[last]
+            self._unpost(last, moved_terms)
+            self._post(row, moved_terms)
+            self._writable(row)
+            self.vectors[row] = self.vectors[last]
+            self.updated_at[row] = self.updated_at[last]
+            self.objects[row] = self.objects[last]
+            self.ids[row] = moved_id
+            self.row_terms[row] = moved_terms
+            self.rows[moved_id] = row
+        self.ids.pop()
+        self.row_terms.pop()
+        self.size = last
+        return True
+
+    def row_vectors(self, rows: Any) -> np.ndarray:
+        """Unit float32 vectors for ``rows`` (an index, slice or index array)."""
+        return self.codec.decode(self.vectors[rows])
+
+    def full_precision(self, rows: np.ndarray) -> np.ndarray:
+        """Unit rows rebuilt from the records' stored float32 embeddings."""
+        if len(rows) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        zero = np.zeros(self.dim, dtype=np.float32)
+        ids = self.ids
+        block = np.stack(
+            [_VECTOR_STORE.get(ids[row], {}).get("embedding", zero) for row in rows.tolist()]
         )
-        res = await _post_hf(
-            url,
-            cfg["token"],
-            {"inputs": texts},
-            cfg["timeout_ms"],
+        return _unit_rows(block.astype(np.float32, copy=False))
+
+    def ensure_codec(self) -> None:
+        """Start re-encoding into ``AI_VECTOR_CODEC`` once the partition reaches
+        ``AI_VECTOR_CODEC_MIN_ROWS``, and retraining it after 4x growth. Both run
+        on a background thread (see ``_train_vector_codec``); until the new codec
+        lands, rows are written with the current one and their ids are collected
+        in ``codec_touched``."""
+        if self.codec_touched is not None:
+            return
+        wanted = _VECTOR_CODECS.get(VECTOR_CODEC, _Float32Codec)
+        if type(self.codec) is wanted:
+            if not self.codec.lossy or self.size < 4 * max(self.codec.trained_rows, 1):
+                return
+        elif wanted is not _Float32Codec and self.size < VECTOR_CODEC_MIN_ROWS:
+            return
+        key, touched = (self.user_id, self.dim), set()
+        self.codec_touched = touched
+        _start_vector_build(lambda: _train_vector_codec(key, wanted, touched), "vector-codec-train")
+
+    def train_codec(self, wanted: type) -> Tuple[_Float32Codec, np.ndarray]:
+        """A ``wanted`` codec trained on this version's rows, and their codes."""
+        block = self.full_precision(np.arange(self.size))
+        codec = wanted(self.dim)
+        if self.size > _VECTOR_CODEC_TRAIN_ROWS:
+            rng = np.random.default_rng(self.size)
+            codec.train(block[rng.choice(self.size, _VECTOR_CODEC_TRAIN_ROWS, replace=False)])
+        else:
+            codec.train(block)
+        codec.trained_rows = self.size
+        return codec, codec.encode(block)
+
+    def install_codec(
+        self, codec: _Float32Codec, source: "_VectorPartition", codes: np.ndarray, touched: Set[str]
+    ) -> None:
+        """Switch to ``codec``. ``codes`` are ``source``'s rows encoded with it; rows
+        written since (in ``touched``) or missing from ``source`` are encoded here."""
+        positions = np.fromiter(
+            (-1 if record_id in touched else source.rows.get(record_id, -1) for record_id in self.ids),
+            dtype=np.int64,
+            count=self.size,
         )
-        body = _parse_json_or_text(res)
-        if res.status_code < 200 or res.status_code >= 300:
-            _raise_hf_response_error("embeddings", body, cfg["provider"])
-        return _normalize_embeddings(body, expected_count=len(texts))
-    except Exception as exc:
-        if isinstance(exc, (HTTPException, UpstreamStructuredError)):
-            raise
-        _raise_hf_error("embeddings", exc)
-
-
-def _upsert_vector_records(items: List[EmbeddingUpsertItem], embeddings: List[List[float]]) -> int:
-    if len(items) != len(embeddings):
-        raise HTTPException(status_code=500, detail="embedding count mismatch")
-    _load_vector_store_if_needed()
-    now_ms = int(time.time() * 1000)
-    with _VECTOR_STORE_LOCK:
-        for item, embedding in zip(items, embeddings):
-            clean_id = str(item.id or "").strip()
-            clean_user = str(item.userId or "").strip()
-            clean_type = str(item.objectType or "").strip()
-            clean_object_id = str(item.objectId or "").strip()
-            clean_text = str(item.text or "").strip()
-            if not clean_id or not clean_user or not clean_type or not clean_object_id or not clean_text:
-                raise HTTPException(status_code=400, detail="embedding item missing required fields")
-            _VECTOR_STORE[clean_id] = {
-                "id": clean_id,
-                "userId": clean_user,
-                "objectType": clean_type,
-                "objectId": clean_object_id,
-                "subId": str(item.subId or ""),
-                "text": clean_text,
-                "metadata": item.metadata if isinstance(item.metadata, dict) else {},
-                "embedding": [float(v) for v in embedding],
-                "updatedAtMs": now_ms,
-            }
-    _persist_vector_store()
-    return len(items)
+        vectors = np.zeros((self.vectors.shape[0], *codec.row_shape), dtype=codec.dtype)
+        have = np.flatnonzero(positions >= 0)
+        vectors[have] = codes[positions[have]]
+        missing = np.flatnonzero(positions < 0)
+        if missing.size:
+            vectors[missing] = codec.encode(self.full_precision(missing))
+        self.codec, self.vectors = codec, vectors
+        self.codec_touched = None
+        if self.knn is not None and codec.lossy:
+            self.knn = None
+
+    def ensure_ann(self) -> None:
+        """Attach the configured ANN index once the partition is large enough and
+        start building it; searches scan exactly until it is ``ready``."""
+        if self.ann is not None or self.size < VECTOR_ANN_MIN_ROWS:
+            return
+        index = _new_ann_index(self)
+        if index is None:
+            return
+        self.ann = index
+        index.start_build()
+
+    def _ann_rows(self, query: np.ndarray, limit: int, rows: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """Candidate rows from ``ann``, or ``rows`` unchanged when a scan is cheaper."""
+        if rows is None:
+            return self.ann.candidates(query, limit)
+        selectivity = rows.size / max(self.size, 1)
+        if rows.size < VECTOR_ANN_MIN_ROWS or selectivity < 0.1:
+            return rows
+        allowed = np.zeros(self.size, dtype=bool)
+        allowed[rows] = True
+        return self.ann.candidates(query, limit, allowed, selectivity)
+
+    def posting_rows(self, field: str, values: List[Any]) -> np.ndarray:
+        postings = self.postings.get(field, {})
+        matched: Set[int] = set()
+        for value in values:
+            matched.update(postings.get(value, ()))
+        if not matched:
+            return _EMPTY_ROWS
+        rows = np.fromiter(matched, dtype=np.int64, count=len(matched))
+        rows.sort()
+        return rows
+
+    def search(
+        self,
+        query: np.ndarray,
+        limit: int,
+        rows: Optional[np.ndarray] = None,
+        exclude: Tuple[str, ...] = (),
+        min_score: float = 0.0,
+        exact: bool = False,
+    ) -> List[Tuple[float, str]]:
+        """Top ``limit`` (score, id) pairs among ``rows`` (sorted; None = all), skipping
+        ``exclude`` ids and scores under ``min_score``. ``exact`` scans past the ANN index."""
+        if self.size == 0:
+            return []
+        if self.ann is not None and self.ann.ready and not exact:
+            rows = self._ann_rows(query, limit + len(exclude), rows)
+        if rows is None:
+            scores = self.codec.scores(self.vectors[: self.size], query)
+        elif rows.size == 0:
+            return []
+        else:
+            scores = self.codec.scores(self.vectors[rows], query)
+        return self._top_hits(query, scores, rows, limit, exclude, min_score)
+
+    def search_batch(
+        self,
+        queries: np.ndarray,
+        limit: int,
+        rows: Optional[np.ndarray] = None,
+        exclude: Tuple[str, ...] = (),
+        min_score: float = 0.0,
+    ) -> List[List[Tuple[float, str]]]:
+        """``search`` for each row of ``queries``. Without an ANN index the block is
+        scored for every query in one ``codec.batch_scores`` product."""
+        if self.size == 0 or (rows is not None and rows.size == 0):
+            return [[] for _ in range(queries.shape[0])]
+        if self.ann is not None and self.ann.ready:
+            return [self.search(query, limit, rows, exclude, min_score) for query in queries]
+        block = self.vectors[: self.size] if rows is None else self.vectors[rows]
+        scores = self.codec.batch_scores(block, queries)
+        return [
+            self._top_hits(query, scores[i], rows, limit, exclude, min_score) for i, query in enumerate(queries)
+        ]
 
+    def grouped_search(
+        self,
+        query: np.ndarray,
+        limit: int,
+        rows: Optional[np.ndarray] = None,
+        exclude: Tuple[str, ...] = (),
+        min_score: float = 0.0,
+        collapse: bool = False,
+        quotas: Optional[Dict[str, int]] = None,
+        top: int = 1,
+    ) -> List[Tuple[float, str, int]]:
+        """``search`` with results grouped: ``(score, id, hits)`` triples.
+
+        ``collapse`` keeps the best row of each ``(objectType, objectId)``,
+        scores it by the mean of the group's ``top`` best rows, and counts the
+        rows that matched it in ``hits``; ``quotas`` caps results per
+        ``objectType`` (lower-case) and leaves other types out. Groups are cut
+        from the scores of one exact scan (see ``_top_k_groups``), so the store
+        is never queried twice; an ANN index is not used.
+        """
+        if self.size == 0 or (rows is not None and rows.size == 0):
+            return []
+        scores = self.codec.scores(self.vectors[: self.size] if rows is None else self.vectors[rows], query)
+        self._zero_excluded(scores, rows, exclude)
+        matched = np.flatnonzero(scores >= min_score if min_score > 0 else scores > 0)
+        matched_rows = matched if rows is None else rows[matched]
+        matched_scores = scores[matched]
+        out: List[Tuple[float, str, int]] = []
+        for object_type, quota in (quotas or {None: limit}).items():
+            part_rows, part_scores = matched_rows, matched_scores
+            if object_type is not None:
+                typed = np.zeros(self.size, dtype=bool)
+                typed[self.posting_rows("objectType", [object_type])] = True
+                typed = typed[part_rows]
+                part_rows, part_scores = part_rows[typed], part_scores[typed]
+            count = min(quota, limit)
+            if not collapse:
+                best = _top_k_rows(part_scores, count)
+                if self.codec.lossy and best.size:
+                    part_scores = part_scores.copy()
+                    part_scores[best] = self.full_precision(part_rows[best]) @ query
+                out.extend((float(part_scores[pos]), self.ids[int(part_rows[pos])], 1) for pos in best)
+                continue
+            codes = self.objects[part_rows]
+            best, hits, values = _top_k_groups(part_scores, codes, count, top)
+            if self.codec.lossy and best.size:
+                # Re-score every row of the kept groups, then rank them again on exact scores.
+                members = np.flatnonzero(np.isin(codes, codes[best]))
+                exact = self.full_precision(part_rows[members]) @ query
+                best, hits, values = _top_k_groups(exact, codes[members], count, top)
+                best = members[best]
+            out.extend(
+                (float(value), self.ids[int(part_rows[pos])], int(size))
+                for pos, size, value in zip(best, hits, values)
+            )
+        out.sort(key=lambda hit: hit[0], reverse=True)
+        return out
+
+    def lexical_search(
+        self,
+        terms: List[str],
+        limit: int,
+        rows: Optional[np.ndarray] = None,
+        exclude: Tuple[str, ...] = (),
+        min_score: float = 0.0,
+    ) -> List[Tuple[float, str]]:
+        """Top ``limit`` (BM25 score, id) pairs among ``rows``; none until
+        ``lexical`` is attached (see ``_lexical_partition``)."""
+        if self.size == 0 or self.lexical is None or (rows is not None and rows.size == 0):
+            return []
+        scores = self.lexical.scores(terms, self.size)
+        if rows is not None:
+            scores = scores[rows]
+        self._zero_excluded(scores, rows, exclude)
+        matched = np.flatnonzero(scores >= min_score if min_score > 0 else scores > 0)
+        return [
+            (float(scores[pos]), self.ids[int(pos if rows is None else rows[pos])])
+            for pos in matched[_top_k_rows(scores[matched], limit)]
+        ]
 
-def _get_vector_records(ids: List[str]) -> List[Dict[str, Any]]:
-    _load_vector_store_if_needed()
-    with _VECTOR_STORE_LOCK:
+    def _zero_excluded(self, scores: np.ndarray, rows: Optional[np.ndarray], exclude: Tuple[str, ...]) -> None:
+        excluded = [self.rows[record_id] for record_id in exclude if record_id in self.rows]
+        if not excluded:
+            return
+        excluded = np.asarray(excluded, dtype=np.int64)
+        if rows is None:
+            scores[excluded] = 0.0
+        else:
+            pos = np.minimum(np.searchsorted(rows, excluded), rows.size - 1)
+            scores[pos[rows[pos] == excluded]] = 0.0
+
+    def _top_hits(
+        self,
+        query: np.ndarray,
+        scores: np.ndarray,
+        rows: Optional[np.ndarray],
+        limit: int,
+        exclude: Tuple[str, ...],
+        min_score: float = 0.0,
+    ) -> List[Tuple[float, str]]:
+        """Rescore (lossy codecs), drop ``exclude`` ids, non-positive scores and scores
+        under ``min_score``, take the top ``limit``."""
+        factor = self.codec.rescore_factor if VECTOR_RESCORE_FACTOR is None else VECTOR_RESCORE_FACTOR
+        if self.codec.lossy and factor:
+            keep = _top_k_rows(scores, (limit + max(len(exclude), 1)) * factor)
+            keep.sort()
+            rows = keep if rows is None else rows[keep]
+            scores = self.full_precision(rows) @ query
+        self._zero_excluded(scores, rows, exclude)
+        positive = np.flatnonzero(scores >= min_score if min_score > 0 else scores > 0)
+        if positive.size < scores.size:
+            scores = scores[positive]
+            rows = positive if rows is None else rows[positive]
         return [
-            {
-                "id": rec["id"],
-                "userId": rec.get("userId", ""),
-                "embedding": list(rec.get("embedding") or []),
-                "objectType": rec.get("objectType", ""),
-                "objectId": rec.get("objectId", ""),
-                "subId": rec.get("subId", ""),
-                "metadata": rec.get("metadata", {}),
-                "document": rec.get("text", ""),
-            }
-            for key in ids
-            if isinstance(key, str) and key in _VECTOR_STORE
-            for rec in [_VECTOR_STORE[key]]
+            (float(scores[pos]), self.ids[int(pos if rows is None else rows[pos])])
+            for pos in _top_k_rows(scores, limit)
         ]
 
 
-def _delete_vector_records(ids: List[str]) -> int:
-    _load_vector_store_if_needed()
-    deleted = 0
-    with _VECTOR_STORE_LOCK:
-        for raw_id in ids:
-            key = str(raw_id or "").strip()
-            if key and key in _VECTOR_STORE:
-                del _VECTOR_STORE[key]
-                deleted += 1
-    if deleted:
-        _persist_vector_store()
-    return deleted
+class _PartitionMap(dict):
+    """A published ``(userId, dim) -> _VectorPartition`` map and its version.
 
+    Never changed once published. Readers take ``_VECTOR_PARTITIONS`` once and
+    search it without a lock or a copy; writers publish a successor with a
+    higher ``version`` in one assignment. A superseded map, and partitions only
+    it references, are freed when its last reader lets go.
+    """
 
-def _search_vectors(
-    query_vector: List[float],
-    *,
-    user_id: str,
-    types: Optional[List[str]],
-    limit: int,
-    exclude_id: Optional[str] = None,
-) -> List[Dict[str, Any]]:
-    _load_vector_store_if_needed()
-    types_filter = _normalize_types(types)
-    safe_user_id = str(user_id or "").strip()
-    safe_exclude = str(exclude_id or "").strip()
-    scored: List[Dict[str, Any]] = []
-    with _VECTOR_STORE_LOCK:
-        values = list(_VECTOR_STORE.values())
-    for record in values:
-        if safe_user_id and str(record.get("userId") or "") != safe_user_id:
-            continue
-        if safe_exclude and str(record.get("id") or "") == safe_exclude:
-            continue
-        rec_type = str(record.get("objectType") or "").lower()
-        if types_filter and rec_type not in types_filter:
-            continue
-        embedding = record.get("embedding")
-        if not isinstance(embedding, list):
-            continue
-        score = _cosine_similarity(query_vector, embedding)
-        if score <= 0:
-            continue
-        scored.append(_vector_result(record, score=score))
-    scored.sort(key=lambda item: float(item.get("score") or 0.0), reverse=True)
-    return scored[:limit]
+    def __init__(self, partitions: Any = (), version: int = 0):
+        super().__init__(partitions)
+        self.version = version
 
 
-def _build_synthesis_schema() -> Dict[str, Any]:
-    return {
-        "type": "json_schema",
-        "json_schema": {
-            "name": "Synthesis",
-            "schema": {
-                "type": "object",
-                "additionalProperties": False,
-                "properties": {
-                    "themes": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "minItems": 3,
-                        "maxItems": 3,
-                    },
-                    "connections": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "minItems": 3,
-                        "maxItems": 3,
-                    },
-                    "questions": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "minItems": 3,
-                        "maxItems": 3,
-                    },
-                },
-                "required": ["themes", "connections", "questions"],
-            },
-        },
-    }
+_VECTOR_PARTITIONS: _PartitionMap = _PartitionMap()
+_VECTOR_DRAFT: Dict[Tuple[str, int], _VectorPartition] = {}
+_VECTOR_WRITE_DEPTH = 0
 
 
-async def hf_chat_complete(
-    prompt: str,
+@contextmanager
+def _vector_write():
+    """Writer section: holds ``_VECTOR_STORE_LOCK`` and, when the outermost
+    section exits, publishes the partitions it cloned as a new version."""
+    global _VECTOR_WRITE_DEPTH
+    with _VECTOR_STORE_LOCK:
+        _VECTOR_WRITE_DEPTH += 1
+        try:
+            yield
+        finally:
+            _VECTOR_WRITE_DEPTH -= 1
+            if not _VECTOR_WRITE_DEPTH:
+                _publish_vector_partitions()
+
+
+def _draft_partition(key: Tuple[str, int], create: bool = False) -> Optional[_VectorPartition]:
+    """This write's private copy of the partition at ``key``. Call inside ``_vector_write``."""
+    partition = _VECTOR_DRAFT.get(key)
+    if partition is None:
+        published = _VECTOR_PARTITIONS.get(key)
+        if published is not None:
+            partition = published.clone()
+        elif create:
+            partition = _VectorPartition(*key)
+        else:
+            return None
+        _VECTOR_DRAFT[key] = partition
+    return partition
+
+
+def _publish_vector_partitions(partitions: Optional[Dict[Tuple[str, int], _VectorPartition]] = None) -> None:
+    """Publish the drafts (or a whole new set of ``partitions``) as the next version."""
+    global _VECTOR_PARTITIONS
+    if partitions is None:
+        if not _VECTOR_DRAFT:
+            return
+        partitions = dict(_VECTOR_PARTITIONS)
+        for key, partition in _VECTOR_DRAFT.items():
+            if partition.size:
+                partitions[key] = partition
+            else:
+                partitions.pop(key, None)
+        _VECTOR_DRAFT.clear()
+    _VECTOR_PARTITIONS = _PartitionMap(partitions, _VECTOR_PARTITIONS.version + 1)
+
+
+def _unit_vector(values: Any) -> np.ndarray:
+    vec = np.asarray(values, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    if norm > 0 and math.isfinite(norm):
+        vec = vec / norm
+    else:
+        vec = np.zeros_like(vec)
+    return vec
+
+
+def _unit_rows(block: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    valid = (norms > 0) & np.isfinite(norms)
+    return np.where(valid, block / np.where(valid, norms, 1.0), 0.0).astype(np.float32)
+
+
+def _partition_key(record: Dict[str, Any]) -> Tuple[str, int]:
+    embedding = record.get("embedding")
+    return str(record.get("userId") or ""), 0 if embedding is None else len(embedding)
+
+
+def _index_vector_record(record: Dict[str, Any]) -> None:
+    key = _partition_key(record)
+    if not key[1]:
+        return
+    with _vector_write():
+        _draft_partition(key, create=True).upsert(record, _unit_vector(record["embedding"]))
+
+
+def _unindex_vector_record(record: Dict[str, Any]) -> None:
+    with _vector_write():
+        partition = _draft_partition(_partition_key(record))
+        if partition is not None:
+            partition.remove(record["id"])
+
+
+def _train_vector_codec(key: Tuple[str, int], wanted: type, touched: Set[str]) -> None:
+    """Train and encode off-lock on the published version of ``key``, then switch
+    a new version to the codec (see ``_VectorPartition.install_codec``). A failed
+    run clears ``codec_touched`` so the next write starts another."""
+    try:
+        with _VECTOR_STORE_LOCK:
+            published = _VECTOR_PARTITIONS.get(key)
+        if published is None or published.codec_touched is not touched:
+            return
+        started = time.perf_counter()
+        codec, codes = published.train_codec(wanted)
+        with _vector_write():
+            partition = _draft_partition(key)
+            if partition is None or partition.codec_touched is not touched:
+                return
+            partition.install_codec(codec, published, codes, touched)
+        logger.info(
+            "[AI] trained %s codec for %s rows (user=%s dim=%s) in %.1fs",
+            codec.name,
+            published.size,
+            key[0],
+            key[1],
+            time.perf_counter() - started,
+        )
+    except Exception as exc:
+        logger.warning("[AI] vector codec training failed: %s", exc)
+        with _vector_write():
+            published = _VECTOR_PARTITIONS.get(key)
+            if published is not None and published.codec_touched is touched:
+                _draft_partition(key).codec_touched = None
+
+
+def _new_ann_index(partition: _VectorPartition) -> Optional[Any]:
+    if VECTOR_ANN_INDEX == "hnsw":
+        return _HNSWIndex(partition, VECTOR_HNSW_M, VECTOR_HNSW_EF_CONSTRUCTION)
+    if VECTOR_ANN_INDEX == "ivf":
+        return _IVFIndex(partition)
+    return None
+
+
+_ANN_INDEX_TYPES = {"hnsw": _HNSWIndex, "ivf": _IVFIndex}
+
+
+def _vector_ann_path() -> str:
+    return f"{VECTOR_STORE_PATH}.ann"
+
+
+def _load_ann_snapshots() -> Dict[Tuple[str, int], Dict[str, np.ndarray]]:
+    """Saved ANN graphs keyed by partition, if they were built with the current mode."""
+    path = _vector_ann_path()
+    if VECTOR_ANN_INDEX not in _ANN_INDEX_TYPES or not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            header = json.loads(str(data["header"]))
+            if header.get("kind") != VECTOR_ANN_INDEX:
+                return {}
+            return {
+                (user_id, int(dim)): {
+                    name.split(".", 1)[1]: data[name] for name in data.files if name.startswith(f"{i}.")
+                }
+                for i, (user_id, dim) in enumerate(header.get("partitions") or [])
+            }
+    except Exception as exc:
+        logger.warning("[AI] ignoring unreadable ANN index %s: %s", path, exc)
+        return {}
+
+
+def _persist_ann_indexes() -> None:
+    """Save every partition's ANN index next to the store so boot can skip rebuilding."""
+    if VECTOR_ANN_INDEX not in _ANN_INDEX_TYPES or not _VECTOR_STORE_LOADED:
+        return
+    arrays: Dict[str, np.ndarray] = {}
+    keys: List[List[Any]] = []
+    for partition in _VECTOR_PARTITIONS.values():
+        if partition.ann is None or partition.ann.kind != VECTOR_ANN_INDEX or not partition.ann.ready:
+            continue
+        for name, value in partition.ann.snapshot().items():
+            arrays[f"{len(keys)}.{name}"] = value
+        keys.append([partition.user_id, partition.dim])
+    arrays["header"] = np.asarray(json.dumps({"kind": VECTOR_ANN_INDEX, "partitions": keys}))
+    path = _vector_ann_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        np.savez(fh, **arrays)
+    os.replace(tmp_path, path)
+
+
+def _attach_ann_index(partition: _VectorPartition, saved: Optional[Dict[str, np.ndarray]]) -> None:
+    if saved and partition.size >= VECTOR_ANN_MIN_ROWS:
+        try:
+            partition.ann = _ANN_INDEX_TYPES[VECTOR_ANN_INDEX].restore(partition, saved)
+        except Exception as exc:
+            logger.warning("[AI] rebuilding ANN index for user=%s: %s", partition.user_id, exc)
+            partition.ann = None
+    partition.ensure_ann()
+
+
+def _rebuild_vector_partitions() -> None:
+    partitions: Dict[Tuple[str, int], _VectorPartition] = {}
+    saved = _load_ann_snapshots()
+    groups: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+    for record in _VECTOR_STORE.values():
+        key = _partition_key(record)
+        if key[1]:
+            groups.setdefault(key, []).append(record)
+    for key, records in groups.items():
+        partition = _VectorPartition(*key)
+        partition.extend(records)
+        _attach_ann_index(partition, saved.get(key))
+        partitions[key] = partition
+    _VECTOR_DRAFT.clear()
+    _publish_vector_partitions(partitions)
+    with _CLUSTER_MODELS_LOCK:
+        _CLUSTER_MODELS.clear()
+
+
+def _top_k_rows(scores: np.ndarray, limit: int) -> np.ndarray:
+    """Row positions of the ``limit`` highest scores, best first."""
+    if scores.size == 0 or limit <= 0:
+        return np.empty(0, dtype=np.int64)
+    if scores.size > limit:
+        candidates = np.argpartition(-scores, limit - 1)[:limit]
+    else:
+        candidates = np.arange(scores.size)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order]
+
+
+def _top_k_groups(
+    scores: np.ndarray, codes: np.ndarray, limit: int, top: int = 1
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The ``limit`` best groups in ``codes``: position of each one's best score, its size, and its
+    score, the mean of its ``top`` best scores (of all of them when it has fewer).
+
+    Only a prefix of the ranking is sorted. A group with no row in the prefix
+    scores at most the prefix's last score, and one seen in part at most its
+    partial sum topped up with that score, so the prefix grows until the best
+    ``limit`` groups are complete and nothing unseen can pass them.
+    """
+    if scores.size == 0 or limit <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    fetch = limit * top * 4
+    while True:
+        prefix = _top_k_rows(scores, fetch)
+        groups, first, slot = np.unique(codes[prefix], return_index=True, return_inverse=True)
+        order = np.argsort(slot, kind="stable")
+        rank = np.empty(prefix.size, dtype=np.int64)
+        rank[order] = np.arange(prefix.size) - np.searchsorted(slot[order], slot[order])
+        kept = rank < top
+        sums = np.bincount(slot[kept], weights=scores[prefix[kept]], minlength=groups.size)
+        seen = np.bincount(slot[kept], minlength=groups.size)
+        member = np.minimum(np.searchsorted(groups, codes), groups.size - 1)
+        member = member[groups[member] == codes]
+        sizes = np.bincount(member, minlength=groups.size)
+        counted = np.minimum(sizes, top)
+        values = sums / counted
+        best = _top_k_rows(values, limit)
+        if prefix.size == scores.size:
+            break
+        floor = float(scores[prefix[-1]])
+        if best.size == limit and (seen[best] == counted[best]).all() and values[best[-1]] >= floor:
+            others = np.ones(groups.size, dtype=bool)
+            others[best] = False
+            upper = (sums + (counted - seen) * floor) / counted
+            if not (upper[others] > values[best[-1]]).any():
+                break
+        fetch *= 4
+    return prefix[first[best]], sizes[best], values[best]
+
+
+def _safe_float_vector(values: Any) -> Optional[List[float]]:
+    if not isinstance(values, list) or not values:
+        return None
+    out: List[float] = []
+    for value in values:
+        if not isinstance(value, (int, float)):
+            return None
+        out.append(float(value))
+    return out
+
+
+# Segment layout (little-endian): header, then one fixed-size table entry per
+# record, then a 64-byte aligned float32 block holding every embedding back to
+# back, then the UTF-8 JSON documents (record fields minus the embedding).
+# Table entries locate each record's vector (in floats) and document (in bytes),
+# so a boot maps the file and reads vectors in place instead of parsing text.
+_VECTOR_SEGMENT_MAGIC = b"NTVSEG01"
+_VECTOR_SEGMENT_VERSION = 2
+_VECTOR_SEGMENT_HEADER_V1 = struct.Struct("<8sIIQQQQ")
+_VECTOR_SEGMENT_HEADER = struct.Struct("<8sIIQQQQQQ")
+_VECTOR_SEGMENT_TABLE_DTYPE_V1 = np.dtype(
+    [
+        ("vector_offset", "<u8"),
+        ("dim", "<u4"),
+        ("doc_length", "<u4"),
+        ("doc_offset", "<u8"),
+    ]
+)
+_VECTOR_SEGMENT_TABLE_DTYPE = np.dtype(
+    [
+        ("vector_offset", "<u8"),
+        ("dim", "<u4"),
+        ("doc_length", "<u4"),
+        ("doc_offset", "<u8"),
+        ("metadata_offset", "<u8"),
+        ("metadata_length", "<u4"),
+        ("text_length", "<u4"),
+        ("text_offset", "<u8"),
+    ]
+)
+_VECTOR_DOCUMENT_FIELDS = (
+    "id", "userId", "objectType", "objectId", "subId", "text", "metadata", "updatedAtMs", "chunkOf"
+)
+_VECTOR_COLUMN_FIELDS = ("id", "userId", "objectType", "objectId", "subId", "updatedAtMs", "chunkOf")
+
+
+def _align64(offset: int) -> int:
+    return (offset + 63) // 64 * 64
+
+
+def _encode_vector_document(record: Dict[str, Any]) -> bytes:
+    return json.dumps(
+        {field: record.get(field) for field in _VECTOR_DOCUMENT_FIELDS},
+        separators=(",", ":"),
+        ensure_ascii=False,
+    ).encode("utf-8")
+
+
+def _encode_json(value: Any) -> bytes:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class _VectorSegment:
+    """A mapped v2 segment: header, offset table, then float32 vectors, column
+    documents, metadata JSON and raw UTF-8 text as separate sections.
+
+    Boot decodes only the columns, in one pass. ``text`` and ``metadata`` stay
+    as offsets and are decoded on read (metadata also when an indexed key needs
+    posting), so a resident record holds just its columns, an embedding view
+    and its row here.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as fh:
+            self.mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            _flags,
+            count,
+            table_offset,
+            vectors_offset,
+            self.docs_offset,
+            self.metadata_offset,
+            self.text_offset,
+        ) = _VECTOR_SEGMENT_HEADER.unpack_from(self.mapped, 0)
+        if magic != _VECTOR_SEGMENT_MAGIC or version != _VECTOR_SEGMENT_VERSION:
+            raise ValueError(f"unsupported vector segment version {version}")
+        self.table = np.frombuffer(self.mapped, dtype=_VECTOR_SEGMENT_TABLE_DTYPE, count=count, offset=table_offset)
+        self.vectors = np.frombuffer(
+            self.mapped,
+            dtype="<f4",
+            count=int(self.table["dim"].sum()) if count else 0,
+            offset=vectors_offset,
+        )
+
+    def _slice(self, base: int, offset: int, length: int) -> bytes:
+        return self.mapped[base + offset : base + offset + length]
+
+    def raw_metadata(self, row: int) -> bytes:
+        entry = self.table[row]
+        return self._slice(self.metadata_offset, int(entry["metadata_offset"]), int(entry["metadata_length"]))
+
+    def raw_text(self, row: int) -> bytes:
+        entry = self.table[row]
+        return self._slice(self.text_offset, int(entry["text_offset"]), int(entry["text_length"]))
+
+    def document(self, row: int) -> Dict[str, Any]:
+        _, _, _, _, meta_offset, meta_length, text_length, text_offset = self.table[row].tolist()
+        return {
+            "text": self._slice(self.text_offset, text_offset, text_length).decode("utf-8"),
+            "metadata": json.loads(self._slice(self.metadata_offset, meta_offset, meta_length)),
+        }
+
+    def records(self) -> List[_VectorRecord]:
+        """Resident records in segment order, without ``text`` or ``metadata``."""
+        table = self.table.tolist()
+        columns = json.loads(
+            b"["
+            + b",".join(self._slice(self.docs_offset, doc_offset, doc_length) for _, _, doc_length, doc_offset, *_ in table)
+            + b"]"
+        )
+        return [
+            _VectorRecord.from_document(
+                document,
+                self.vectors[vector_offset : vector_offset + dim],
+                segment=self,
+                segmentRow=row,
+            )
+            for row, (document, (vector_offset, dim, *_)) in enumerate(zip(columns, table))
+        ]
+
+
+def _record_raw_document(record: Dict[str, Any]) -> Tuple[bytes, bytes]:
+    """(metadata JSON, UTF-8 text) for a resident or segment-backed record."""
+    if "text" in record:
+        return _encode_json(record.get("metadata") or {}), str(record.get("text") or "").encode("utf-8")
+    return record.segment.raw_metadata(record.segmentRow), record.segment.raw_text(record.segmentRow)
+
+
+def _raw_vector_documents(records: List[Dict[str, Any]], batch: int = 500) -> Iterable[Tuple[bytes, bytes]]:
+    """``_record_raw_document`` per record; documents only the backend holds are fetched a batch at a time."""
+    for start in range(0, len(records), batch):
+        chunk = records[start : start + batch]
+        missing = [record.id for record in chunk if record.text is None and record.segment is None]
+        documents = _VECTOR_BACKEND.fetch_documents(missing) if missing else {}
+        for record in chunk:
+            if record.text is None and record.segment is None:
+                record = documents.get(record.id, {"text": "", "metadata": {}})
+            yield _record_raw_document(record)
+
+
+def _write_vector_segment(path: str, records: List[Dict[str, Any]]) -> None:
+    """Stream ``records`` into a v2 segment, section by section, without holding
+    every document in memory; segment-backed documents are copied as raw bytes.
+    Text is spooled to a temporary file while metadata is written, so each
+    document is read once."""
+    count = len(records)
+    table = np.zeros(count, dtype=_VECTOR_SEGMENT_TABLE_DTYPE)
+    if records:
+        dims = np.fromiter((len(r["embedding"]) for r in records), dtype=np.uint64, count=count)
+        table["dim"] = dims
+        table["vector_offset"][1:] = np.cumsum(dims)[:-1]
+    table_offset = _VECTOR_SEGMENT_HEADER.size
+    vectors_offset = _align64(table_offset + table.nbytes)
+    doc_lengths = np.zeros(count, dtype=np.uint64)
+    meta_lengths = np.zeros(count, dtype=np.uint64)
+    text_lengths = np.zeros(count, dtype=np.uint64)
+    with open(path, "wb") as fh, tempfile.TemporaryFile(dir=os.path.dirname(path) or ".") as texts:
+        fh.seek(vectors_offset)
+        for record in records:
+            fh.write(np.asarray(record["embedding"], dtype="<f4").tobytes())
+        docs_offset = fh.tell()
+        for row, record in enumerate(records):
+            doc_lengths[row] = fh.write(_encode_json({field: record.get(field) for field in _VECTOR_COLUMN_FIELDS}))
+        metadata_offset = fh.tell()
+        for row, (metadata, text) in enumerate(_raw_vector_documents(records)):
+            meta_lengths[row] = fh.write(metadata)
+            text_lengths[row] = texts.write(text)
+        text_offset = fh.tell()
+        texts.seek(0)
+        shutil.copyfileobj(texts, fh)
+        for column, lengths in (("doc", doc_lengths), ("metadata", meta_lengths), ("text", text_lengths)):
+            table[f"{column}_length"] = lengths
+            if count:
+                table[f"{column}_offset"][1:] = np.cumsum(lengths)[:-1]
+        fh.seek(0)
+        fh.write(
+            _VECTOR_SEGMENT_HEADER.pack(
+                _VECTOR_SEGMENT_MAGIC,
+                _VECTOR_SEGMENT_VERSION,
+                0,
+                count,
+                table_offset,
+                vectors_offset,
+                docs_offset,
+                metadata_offset,
+                text_offset,
+            )
+        )
+        fh.write(table.tobytes())
+
+
+def _is_vector_segment(path: str) -> bool:
+    with open(path, "rb") as fh:
+        return fh.read(len(_VECTOR_SEGMENT_MAGIC)) == _VECTOR_SEGMENT_MAGIC
+
+
+def _read_vector_segment_v1(mapped: mmap.mmap) -> Dict[str, Dict[str, Any]]:
+    """Version 1 segments kept whole JSON documents; they load fully resident
+    and are rewritten as v2 by the next compaction."""
+    magic, version, _flags, count, table_offset, vectors_offset, docs_offset = (
+        _VECTOR_SEGMENT_HEADER_V1.unpack_from(mapped, 0)
+    )
+    table = np.frombuffer(mapped, dtype=_VECTOR_SEGMENT_TABLE_DTYPE_V1, count=count, offset=table_offset)
+    vectors = np.frombuffer(
+        mapped,
+        dtype="<f4",
+        count=int(table["dim"].sum()) if count else 0,
+        offset=vectors_offset,
+    )
+    loaded: Dict[str, _VectorRecord] = {}
+    for vector_offset, dim, doc_length, doc_offset in table.tolist():
+        start = docs_offset + doc_offset
+        record = _VectorRecord.from_document(
+            json.loads(mapped[start : start + doc_length]), vectors[vector_offset : vector_offset + dim]
+        )
+        loaded[record.id] = record
+    return loaded
+
+
+def _read_vector_segment(path: str) -> Dict[str, Dict[str, Any]]:
+    """Map a segment file; embeddings are read-only float32 views into the mapping."""
+    with open(path, "rb") as fh:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version = struct.unpack_from("<8sI", mapped, 0)
+    if magic == _VECTOR_SEGMENT_MAGIC and version == 1:
+        return _read_vector_segment_v1(mapped)
+    mapped.close()
+    return {record["id"]: record for record in _VectorSegment(path).records()}
+
+
+def _read_legacy_json_store(path: str) -> Dict[str, Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as fh:
+        raw = json.load(fh)
+    loaded: Dict[str, Dict[str, Any]] = {}
+    if not isinstance(raw, dict):
+        return loaded
+    for key, value in raw.items():
+        if not isinstance(key, str) or not isinstance(value, dict):
+            continue
+        vec = _safe_float_vector(value.get("embedding"))
+        if not vec:
+            continue
+        loaded[key] = _VectorRecord(
+            str(value.get("id") or key),
+            str(value.get("userId") or ""),
+            str(value.get("objectType") or ""),
+            str(value.get("objectId") or ""),
+            str(value.get("subId") or ""),
+            int(value.get("updatedAtMs") or int(time.time() * 1000)),
+            np.asarray(vec, dtype=np.float32),
+            text=str(value.get("text") or ""),
+            metadata=value.get("metadata") if isinstance(value.get("metadata"), dict) else {},
+        )
+    return loaded
+
+
+def _convert_json_vector_store(json_path: str, segment_path: str) -> int:
+    """One-time conversion of a legacy JSON store into a binary segment.
+
+    The segment is written next to the JSON store and read back before it is
+    moved into place; the JSON file itself is kept, or copied to
+    ``<json_path>.bak`` first when the segment takes over its path.
+    """
+    records = list(_read_legacy_json_store(json_path).values())
+    directory = os.path.dirname(segment_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{segment_path}.tmp"
+    _write_vector_segment(tmp_path, records)
+    converted = _VectorSegment(tmp_path).records()
+    if [r.id for r in converted] != [r.id for r in records] or not all(
+        np.array_equal(new.embedding, old.embedding) for new, old in zip(converted, records)
+    ):
+        os.remove(tmp_path)
+        raise ValueError(f"converted segment {tmp_path} does not match {json_path}")
+    if os.path.abspath(json_path) == os.path.abspath(segment_path):
+        shutil.copyfile(json_path, f"{json_path}.bak")
+    os.replace(tmp_path, segment_path)
+    return len(records)
+
+
+def _legacy_vector_store_path() -> Optional[str]:
+    """Where a pre-segment JSON store may still live for ``VECTOR_STORE_PATH``."""
+    if os.path.exists(VECTOR_STORE_PATH):
+        return None if _is_vector_segment(VECTOR_STORE_PATH) else VECTOR_STORE_PATH
+    legacy = f"{os.path.splitext(VECTOR_STORE_PATH)[0]}.json"
+    if legacy != VECTOR_STORE_PATH and os.path.exists(legacy):
+        return legacy
+    return None
+
+
+# Write-ahead log: every upsert/delete is appended as a CRC-checked frame
+# (u32 payload length, u32 crc32, payload) so a write costs O(change). Payloads
+# are b"U" + u32 document length + document + float32 embedding, or
+# b"D" + JSON list of ids. Boot replays the log on top of the segment; a torn
+# tail frame is dropped. Compaction rotates the log aside, snapshots the store
+# into a new segment, then removes the rotated log.
+#
+# Mutations never touch storage themselves: they queue ("upsert", record) and
+# ("delete", ids) ops (in apply order, under _VECTOR_STORE_LOCK) and a
+# persistence worker group-commits everything queued within
+# AI_VECTOR_PERSIST_MAX_DELAY_MS, or as soon as AI_VECTOR_PERSIST_MAX_PENDING_OPS
+# are waiting, through the active backend in one write. Lock order is
+# _VECTOR_STORE_LOCK -> _VECTOR_COMMIT_LOCK -> _VECTOR_PENDING_COND.
+#
+# Compaction starts once the WAL reaches AI_VECTOR_WAL_COMPACT_BYTES, or once
+# it has been open for AI_VECTOR_WAL_COMPACT_INTERVAL_S; the idle worker wakes
+# up for the latter, so a quiet store still folds its log into the segment.
+_VECTOR_WAL_FRAME = struct.Struct("<II")
+_VECTOR_WAL_DOC_LENGTH = struct.Struct("<I")
+_VECTOR_COMMIT_LOCK = threading.Lock()
+_VECTOR_WAL_FH: Optional[Any] = None
+_VECTOR_WAL_OPENED_AT: Optional[float] = None
+_VECTOR_WAL_LAST_FSYNC = 0.0
+_VECTOR_WAL_UNSYNCED = False
+_VECTOR_PENDING_COND = threading.Condition()
+_VECTOR_PENDING_OPS: List[Tuple[str, Any]] = []
+_VECTOR_PENDING_SINCE = 0.0
+_VECTOR_PERSIST_THREAD: Optional[threading.Thread] = None
+_VECTOR_PERSIST_STOP = False
+_VECTOR_PERSIST_STATS: Dict[str, Any] = {
+    "flushes": 0,
+    "ops_written": 0,
+    "last_flush_ops": 0,
+    "last_flush_ms": 0.0,
+    "last_error": "",
+}
+_VECTOR_COMPACTION_THREAD: Optional[threading.Thread] = None
+_VECTOR_COMPACTION_STARTED_AT = 0.0
+
+
+def _vector_wal_path() -> str:
+    return f"{VECTOR_STORE_PATH}.wal"
+
+
+def _vector_wal_rotated_path() -> str:
+    return f"{VECTOR_STORE_PATH}.wal.compacting"
+
+
+def _encode_wal_upsert(record: Dict[str, Any]) -> bytes:
+    doc = _encode_vector_document(record)
+    vector = np.asarray(record["embedding"], dtype="<f4").tobytes()
+    return b"U" + _VECTOR_WAL_DOC_LENGTH.pack(len(doc)) + doc + vector
+
+
+def _encode_wal_delete(ids: List[str]) -> bytes:
+    return b"D" + json.dumps(ids, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _wal_frame(payload: bytes) -> bytes:
+    return _VECTOR_WAL_FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _replay_vector_wal(path: str, store: Dict[str, Dict[str, Any]]) -> int:
+    """Apply the frames in ``path`` to ``store``; truncates a torn tail. Returns ops applied."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb") as fh:
+        data = fh.read()
+    offset = 0
+    applied = 0
+    while offset + _VECTOR_WAL_FRAME.size <= len(data):
+        length, crc = _VECTOR_WAL_FRAME.unpack_from(data, offset)
+        start = offset + _VECTOR_WAL_FRAME.size
+        payload = data[start : start + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            break
+        if payload[:1] == b"U":
+            (doc_length,) = _VECTOR_WAL_DOC_LENGTH.unpack_from(payload, 1)
+            doc_end = 1 + _VECTOR_WAL_DOC_LENGTH.size + doc_length
+            record = _VectorRecord.from_document(
+                json.loads(payload[1 + _VECTOR_WAL_DOC_LENGTH.size : doc_end]),
+                np.frombuffer(payload, dtype="<f4", offset=doc_end),
+            )
+            store[record.id] = record
+        elif payload[:1] == b"D":
+            for record_id in json.loads(payload[1:]):
+                store.pop(record_id, None)
+        applied += 1
+        offset = start + length
+    if offset < len(data):
+        logger.warning("[AI] dropping %s torn bytes at the end of %s", len(data) - offset, path)
+        with open(path, "r+b") as fh:
+            fh.truncate(offset)
+    return applied
+
+
+def _fsync_vector_wal_locked(force: bool = False) -> None:
+    global _VECTOR_WAL_LAST_FSYNC, _VECTOR_WAL_UNSYNCED
+    if _VECTOR_WAL_FH is None or not _VECTOR_WAL_UNSYNCED:
+        return
+    now = time.monotonic()
+    if force or VECTOR_WAL_FSYNC == "always" or (
+        VECTOR_WAL_FSYNC == "interval"
+        and (now - _VECTOR_WAL_LAST_FSYNC) * 1000 >= VECTOR_WAL_FSYNC_INTERVAL_MS
+    ):
+        os.fsync(_VECTOR_WAL_FH.fileno())
+        _VECTOR_WAL_LAST_FSYNC = now
+        _VECTOR_WAL_UNSYNCED = False
+
+
+def _append_vector_wal_locked(ops: List[Tuple[str, Any]]) -> None:
+    """Append ops to the WAL in one write. Call with ``_VECTOR_COMMIT_LOCK`` held."""
+    global _VECTOR_WAL_FH, _VECTOR_WAL_UNSYNCED, _VECTOR_WAL_OPENED_AT
+    if _VECTOR_WAL_FH is None:
+        os.makedirs(os.path.dirname(VECTOR_STORE_PATH) or ".", exist_ok=True)
+        _VECTOR_WAL_FH = open(_vector_wal_path(), "ab")
+        _VECTOR_WAL_OPENED_AT = time.monotonic()
+    _VECTOR_WAL_FH.write(
+        b"".join(
+            _wal_frame(_encode_wal_upsert(arg) if kind == "upsert" else _encode_wal_delete(arg))
+            for kind, arg in ops
+        )
+    )
+    _VECTOR_WAL_FH.flush()
+    _VECTOR_WAL_UNSYNCED = True
+    _fsync_vector_wal_locked()
+
+
+def _close_vector_wal() -> None:
+    global _VECTOR_WAL_FH, _VECTOR_WAL_UNSYNCED, _VECTOR_WAL_OPENED_AT
+    with _VECTOR_COMMIT_LOCK:
+        if _VECTOR_WAL_FH is not None:
+            _VECTOR_WAL_FH.flush()
+            os.fsync(_VECTOR_WAL_FH.fileno())
+            _VECTOR_WAL_FH.close()
+            _VECTOR_WAL_FH = None
+            _VECTOR_WAL_UNSYNCED = False
+            _VECTOR_WAL_OPENED_AT = None
+
+
+def _load_file_vector_store() -> Dict[str, Dict[str, Any]]:
+    legacy_path = _legacy_vector_store_path()
+    if legacy_path:
+        converted = _convert_json_vector_store(legacy_path, VECTOR_STORE_PATH)
+        logger.info(
+            "[AI] converted %s vector records from %s to segment %s (original kept at %s)",
+            converted,
+            legacy_path,
+            VECTOR_STORE_PATH,
+            f"{legacy_path}.bak" if legacy_path == VECTOR_STORE_PATH else legacy_path,
+        )
+    loaded: Dict[str, Dict[str, Any]] = {}
+    if os.path.exists(VECTOR_STORE_PATH):
+        loaded = _read_vector_segment(VECTOR_STORE_PATH)
+    replayed = _replay_vector_wal(_vector_wal_rotated_path(), loaded)
+    replayed += _replay_vector_wal(_vector_wal_path(), loaded)
+    if replayed:
+        logger.info("[AI] replayed %s vector WAL ops", replayed)
+    return loaded
+
+
+class _FileVectorBackend:
+    """Segment + WAL on disk.
+
+    Records loaded from the segment read ``text`` and ``metadata`` lazily by
+    offset; only records written since the last compaction keep them resident
+    in ``_VECTOR_STORE``."""
+
+    name = "file"
+    keeps_documents = True
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        return _load_file_vector_store()
+
+    def commit(self, ops: List[Tuple[str, Any]]) -> None:
+        _append_vector_wal_locked(ops)
+
+    def sync(self, force: bool = False) -> None:
+        _fsync_vector_wal_locked(force=force)
+
+    def needs_sync(self) -> bool:
+        return _VECTOR_WAL_UNSYNCED
+
+    def needs_compaction(self) -> bool:
+        if _VECTOR_WAL_FH is None:
+            return False
+        due = self.compaction_due_in()
+        return _VECTOR_WAL_FH.tell() >= VECTOR_WAL_COMPACT_BYTES or (due is not None and due <= 0)
+
+    def compaction_due_in(self) -> Optional[float]:
+        """Seconds until the open WAL is due a timed compaction; None when no WAL is open.
+        Counted from the later of the WAL opening and the last compaction started."""
+        opened = _VECTOR_WAL_OPENED_AT
+        if not VECTOR_WAL_COMPACT_INTERVAL_S or opened is None:
+            return None
+        return max(opened, _VECTOR_COMPACTION_STARTED_AT) + VECTOR_WAL_COMPACT_INTERVAL_S - time.monotonic()
+
+    def fetch_documents(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        return {}
+
+    def close(self) -> None:
+        _close_vector_wal()
+
+
+class _SQLiteVectorBackend:
+    """SQLite table with float32 BLOB embeddings, in WAL journal mode.
+
+    Only ids, filter columns and embeddings stay in ``_VECTOR_STORE``; ``text``
+    and ``metadata`` are read back by id for returned rows and residual
+    metadata filters. An empty database imports an existing file store once.
+    """
+
+    name = "sqlite"
+    keeps_documents = False
+    _SYNCHRONOUS = {"always": "FULL", "interval": "NORMAL", "never": "OFF"}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self._SYNCHRONOUS.get(VECTOR_WAL_FSYNC, 'NORMAL')}")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS vectors (
+                    id TEXT PRIMARY KEY,
+                    userId TEXT NOT NULL,
+                    objectType TEXT NOT NULL,
+                    objectId TEXT NOT NULL,
+                    subId TEXT NOT NULL DEFAULT '',
+                    text TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    updatedAtMs INTEGER NOT NULL,
+                    embedding BLOB NOT NULL,
+                    chunkOf TEXT
+                );
+                CREATE INDEX IF NOT EXISTS vectors_user_type ON vectors (userId, objectType);
+                CREATE INDEX IF NOT EXISTS vectors_user_object ON vectors (userId, objectId);
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(vectors)")}
+            if "chunkOf" not in columns:
+                conn.execute("ALTER TABLE vectors ADD COLUMN chunkOf TEXT")
+            self._conn = conn
+        return self._conn
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            conn = self._connection()
+            empty = conn.execute("SELECT 1 FROM vectors LIMIT 1").fetchone() is None
+        if empty and (os.path.exists(VECTOR_STORE_PATH) or _legacy_vector_store_path()):
+            imported = _load_file_vector_store()
+            if imported:
+                imported = {record["id"]: record for record in _with_documents(list(imported.values()))}
+                with self._lock:
+                    self._write(list(("upsert", record) for record in imported.values()))
+                logger.info("[AI] imported %s vector records into %s", len(imported), self.path)
+        loaded: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT id, userId, objectType, objectId, subId, metadata, updatedAtMs, embedding, chunkOf FROM vectors"
+            )
+            for record_id, user_id, object_type, object_id, sub_id, metadata, updated_at, blob, chunk_of in rows:
+                loaded[record_id] = _VectorRecord(
+                    record_id,
+                    user_id,
+                    object_type,
+                    object_id,
+                    sub_id,
+                    updated_at,
+                    np.frombuffer(blob, dtype="<f4"),
+                    metadata=json.loads(metadata),
+                    chunkOf=chunk_of,
+                )
+        return loaded
+
+    def _write(self, ops: List[Tuple[str, Any]]) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            for kind, arg in ops:
+                if kind == "upsert":
+                    conn.execute(
+                        "INSERT OR REPLACE INTO vectors "
+                        "(id, userId, objectType, objectId, subId, text, metadata, updatedAtMs, embedding, chunkOf) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            arg["id"],
+                            arg["userId"],
+                            arg["objectType"],
+                            arg["objectId"],
+                            arg.get("subId") or "",
+                            arg.get("text") or "",
+                            json.dumps(arg.get("metadata") or {}, separators=(",", ":"), ensure_ascii=False),
+                            int(arg.get("updatedAtMs") or 0),
+                            np.asarray(arg["embedding"], dtype="<f4").tobytes(),
+                            arg.get("chunkOf"),
+                        ),
+                    )
+                else:
+                    conn.executemany("DELETE FROM vectors WHERE id = ?", [(record_id,) for record_id in arg])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def commit(self, ops: List[Tuple[str, Any]]) -> None:
+        with self._lock:
+            self._write(ops)
+
+    def sync(self, force: bool = False) -> None:
+        if force and self._conn is not None:
+            with self._lock:
+                self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def needs_sync(self) -> bool:
+        return False
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    def compaction_due_in(self) -> Optional[float]:
+        return None
+
+    def fetch_documents(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        out: Dict[str, Dict[str, Any]] = {}
+        if not ids:
+            return out
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(ids), 500):
+                chunk = ids[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for record_id, text, metadata in conn.execute(
+                    f"SELECT id, text, metadata FROM vectors WHERE id IN ({placeholders})", chunk
+                ):
+                    out[record_id] = {"text": text, "metadata": json.loads(metadata)}
+        return out
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def _make_vector_backend() -> Any:
+    if VECTOR_STORE_BACKEND == "sqlite":
+        return _SQLiteVectorBackend(VECTOR_SQLITE_PATH)
+    if VECTOR_STORE_BACKEND != "file":
+        logger.warning("[AI] unknown AI_VECTOR_STORE_BACKEND=%s, using file", VECTOR_STORE_BACKEND)
+    return _FileVectorBackend()
+
+
+_VECTOR_BACKEND = _make_vector_backend()
+
+
+def _resident_vector_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """The copy of ``record`` kept in ``_VECTOR_STORE`` once it is durable.
+
+    Segment-backed records and records held by a backend that does not keep
+    documents drop ``text``/``metadata``; they are read back on demand.
+    """
+    if _VECTOR_BACKEND.keeps_documents and record.segment is None:
+        return record
+    return record.replace(text=None, metadata=None)
+
+
+def _with_documents(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """``records`` with ``text``/``metadata`` filled in from the segment or backend where not resident."""
+    if all("text" in record for record in records):
+        return records
+    missing = [record.id for record in records if record.text is None and record.segment is None]
+    documents = _VECTOR_BACKEND.fetch_documents(missing) if missing else {}
+    out = []
+    for record in records:
+        if "text" in record:
+            out.append(record)
+        elif record.segment is not None:
+            out.append(record.replace(**record.segment.document(record.segmentRow)))
+        else:
+            out.append(record.replace(**documents.get(record.id, {"text": "", "metadata": {}})))
+    return out
+
+
+def _commit_pending_vector_writes_locked() -> List[Tuple[str, Any]]:
+    """Drain the queue into the backend in one commit. Call with ``_VECTOR_COMMIT_LOCK`` held."""
+    global _VECTOR_PENDING_OPS
+    with _VECTOR_PENDING_COND:
+        ops, _VECTOR_PENDING_OPS = _VECTOR_PENDING_OPS, []
+    if not ops:
+        return ops
+    started = time.perf_counter()
+    try:
+        _VECTOR_BACKEND.commit(ops)
+    except Exception:
+        with _VECTOR_PENDING_COND:
+            _VECTOR_PENDING_OPS = ops + _VECTOR_PENDING_OPS
+        raise
+    _VECTOR_PERSIST_STATS["flushes"] += 1
+    _VECTOR_PERSIST_STATS["ops_written"] += len(ops)
+    _VECTOR_PERSIST_STATS["last_flush_ops"] = len(ops)
+    _VECTOR_PERSIST_STATS["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    return ops
+
+
+def _release_committed_documents(ops: List[Tuple[str, Any]]) -> None:
+    if _VECTOR_BACKEND.keeps_documents:
+        return
+    with _VECTOR_STORE_LOCK:
+        for kind, record in ops:
+            if kind == "upsert" and _VECTOR_STORE.get(record["id"]) is record:
+                _VECTOR_STORE[record["id"]] = _resident_vector_record(record)
+
+
+def _flush_vector_writes(force_sync: bool = False) -> int:
+    """Commit every queued op now; returns how many were written."""
+    with _VECTOR_COMMIT_LOCK:
+        ops = _commit_pending_vector_writes_locked()
+        _VECTOR_BACKEND.sync(force=force_sync)
+        compact = _VECTOR_BACKEND.needs_compaction()
+    _release_committed_documents(ops)
+    if compact:
+        _start_vector_compaction()
+    return len(ops)
+
+
+def _vector_persistence_idle_timeout() -> Optional[float]:
+    """How long the idle worker may sleep before an interval fsync or a timed
+    compaction is due; None to sleep until woken."""
+    waits = [_VECTOR_BACKEND.compaction_due_in()]
+    if _VECTOR_BACKEND.needs_sync() and VECTOR_WAL_FSYNC == "interval":
+        waits.append(VECTOR_WAL_FSYNC_INTERVAL_MS / 1000.0)
+    waits = [wait for wait in waits if wait is not None]
+    return min(waits) if waits else None
+
+
+def _vector_persistence_loop() -> None:
+    while True:
+        with _VECTOR_PENDING_COND:
+            while not _VECTOR_PENDING_OPS and not _VECTOR_PERSIST_STOP:
+                timeout = _vector_persistence_idle_timeout()
+                if timeout is None:
+                    _VECTOR_PENDING_COND.wait()
+                elif not _VECTOR_PENDING_COND.wait(max(timeout, 0.0)):
+                    break
+            while (
+                _VECTOR_PENDING_OPS
+                and not _VECTOR_PERSIST_STOP
+                and len(_VECTOR_PENDING_OPS) < VECTOR_PERSIST_MAX_PENDING_OPS
+            ):
+                remaining = _VECTOR_PENDING_SINCE + VECTOR_PERSIST_MAX_DELAY_MS / 1000.0 - time.monotonic()
+                if remaining <= 0:
+                    break
+                _VECTOR_PENDING_COND.wait(remaining)
+            if _VECTOR_PERSIST_STOP:
+                return
+        try:
+            _flush_vector_writes()
+            _VECTOR_PERSIST_STATS["last_error"] = ""
+        except Exception as exc:
+            _VECTOR_PERSIST_STATS["last_error"] = str(exc)
+            logger.warning("[AI] vector store flush failed: %s", exc)
+            time.sleep(max(VECTOR_PERSIST_MAX_DELAY_MS, 100) / 1000.0)
+
+
+def _enqueue_vector_writes(ops: List[Tuple[str, Any]]) -> None:
+    """Queue ops for the persistence worker. Call with ``_VECTOR_STORE_LOCK`` held."""
+    global _VECTOR_PENDING_SINCE, _VECTOR_PERSIST_THREAD, _VECTOR_PERSIST_STOP
+    if not ops:
+        return
+    with _VECTOR_PENDING_COND:
+        if not _VECTOR_PENDING_OPS:
+            _VECTOR_PENDING_SINCE = time.monotonic()
+        _VECTOR_PENDING_OPS.extend(ops)
+        if _VECTOR_PERSIST_THREAD is None or not _VECTOR_PERSIST_THREAD.is_alive():
+            _VECTOR_PERSIST_STOP = False
+            _VECTOR_PERSIST_THREAD = threading.Thread(
+                target=_vector_persistence_loop, name="vector-persistence", daemon=True
+            )
+            _VECTOR_PERSIST_THREAD.start()
+        _VECTOR_PENDING_COND.notify()
+
+
+def _shutdown_vector_persistence() -> None:
+    """Stop the worker, then commit and sync anything still queued."""
+    global _VECTOR_PERSIST_STOP
+    with _VECTOR_PENDING_COND:
+        _VECTOR_PERSIST_STOP = True
+        _VECTOR_PENDING_COND.notify_all()
+        thread = _VECTOR_PERSIST_THREAD
+    if thread is not None:
+        thread.join()
+    _flush_vector_writes(force_sync=True)
+    _VECTOR_BACKEND.close()
+
+
+def _vector_persistence_stats() -> Dict[str, Any]:
+    with _VECTOR_PENDING_COND:
+        pending_ops = len(_VECTOR_PENDING_OPS)
+        pending_age_ms = (
+            round((time.monotonic() - _VECTOR_PENDING_SINCE) * 1000, 1) if pending_ops else 0.0
+        )
+    return {
+        "backend": _VECTOR_BACKEND.name,
+        "pending_ops": pending_ops,
+        "pending_age_ms": pending_age_ms,
+        "worker_alive": bool(_VECTOR_PERSIST_THREAD is not None and _VECTOR_PERSIST_THREAD.is_alive()),
+        **_VECTOR_PERSIST_STATS,
+    }
+
+
+def _load_vector_store_if_needed() -> None:
+    global _VECTOR_STORE_LOADED, _VECTOR_STORE
+    if _VECTOR_STORE_LOADED:
+        return
+    with _VECTOR_STORE_LOCK:
+        if _VECTOR_STORE_LOADED:
+            return
+        try:
+            _VECTOR_STORE = _VECTOR_BACKEND.load()
+        except Exception as exc:
+            logger.warning("[AI] failed to load %s vector store: %s", _VECTOR_BACKEND.name, exc)
+            _VECTOR_STORE = {}
+        finally:
+            _rebuild_vector_partitions()
+            _rebuild_chunk_families()
+            for key, record in list(_VECTOR_STORE.items()):
+                _VECTOR_STORE[key] = _resident_vector_record(record)
+            _VECTOR_STORE_LOADED = True
+
+
+def _rotate_vector_wal() -> List[Dict[str, Any]]:
+    """Move the live WAL aside and return the records it leaves covered by a snapshot."""
+    global _VECTOR_WAL_FH, _VECTOR_WAL_UNSYNCED, _VECTOR_WAL_OPENED_AT
+    with _VECTOR_STORE_LOCK:
+        with _VECTOR_COMMIT_LOCK:
+            _commit_pending_vector_writes_locked()
+            if _VECTOR_WAL_FH is not None:
+                _VECTOR_WAL_FH.close()
+                _VECTOR_WAL_FH = None
+                _VECTOR_WAL_UNSYNCED = False
+                _VECTOR_WAL_OPENED_AT = None
+            if os.path.exists(_vector_wal_path()):
+                rotated = _vector_wal_rotated_path()
+                if os.path.exists(rotated):
+                    with open(rotated, "ab") as dst, open(_vector_wal_path(), "rb") as src:
+                        dst.write(src.read())
+                    os.remove(_vector_wal_path())
+                else:
+                    os.replace(_vector_wal_path(), rotated)
+        return list(_VECTOR_STORE.values())
+
+
+def _persist_vector_store() -> None:
+    """Snapshot the whole store into a new segment and retire the WAL it covers."""
+    _load_vector_store_if_needed()
+    directory = os.path.dirname(VECTOR_STORE_PATH) or "."
+    os.makedirs(directory, exist_ok=True)
+    records = _rotate_vector_wal()
+    tmp_path = f"{VECTOR_STORE_PATH}.tmp"
+    _write_vector_segment(tmp_path, records)
+    os.replace(tmp_path, VECTOR_STORE_PATH)
+    rotated = _vector_wal_rotated_path()
+    if os.path.exists(rotated):
+        os.remove(rotated)
+    _remap_vector_segment(records)
+    _persist_ann_indexes()
+
+
+def _remap_vector_segment(records: List[Dict[str, Any]]) -> None:
+    """Point the snapshotted records at the segment just written, dropping their
+    resident documents and the previous mapping. Records replaced or deleted
+    since the snapshot are left alone."""
+    segment = _VectorSegment(VECTOR_STORE_PATH)
+    remapped = segment.records()
+    with _VECTOR_STORE_LOCK:
+        for old, new in zip(records, remapped):
+            if _VECTOR_STORE.get(old["id"]) is old:
+                _VECTOR_STORE[old["id"]] = new
+
+
+def _compact_vector_store() -> None:
+    try:
+        _persist_vector_store()
+    except Exception as exc:
+        logger.warning("[AI] vector store compaction failed: %s", exc)
+
+
+def _start_vector_compaction() -> None:
+    global _VECTOR_COMPACTION_THREAD, _VECTOR_COMPACTION_STARTED_AT
+    with _VECTOR_COMMIT_LOCK:
+        if _VECTOR_COMPACTION_THREAD is not None and _VECTOR_COMPACTION_THREAD.is_alive():
+            return
+        _VECTOR_COMPACTION_STARTED_AT = time.monotonic()
+        _VECTOR_COMPACTION_THREAD = threading.Thread(
+            target=_compact_vector_store, name="vector-compaction", daemon=True
+        )
+        _VECTOR_COMPACTION_THREAD.start()
+
+
+def _normalize_types(types: Optional[List[str]]) -> Optional[Set[str]]:
+    if not types:
+        return None
+    normalized = {
+        str(t or "").strip().lower()
+        for t in types
+        if str(t or "").strip()
+    }
+    return normalized or None
+
+
+_VECTOR_FILTER_FIELDS = {"id", "objectType", "objectId", "subId", "updatedAtMs"}
+_VECTOR_FILTER_OPS = {"$eq", "$ne", "$in", "$nin", "$gt", "$gte", "$lt", "$lte", "$exists"}
+
+
+def _invalid_filter(reason: str) -> HTTPException:
+    return HTTPException(status_code=400, detail=f"invalid filter: {reason}")
+
+
+def _is_filter_scalar(value: Any) -> bool:
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+def _compile_vector_filter(expr: Any) -> Optional[Tuple[Any, ...]]:
+    """Validate a Mongo-style filter into a predicate tree, or None to match all.
+
+    Supports ``{field: value}``, ``{field: {"$op": operand}}`` with the
+    operators in ``_VECTOR_FILTER_OPS``, and ``$and``/``$or`` lists. Fields are
+    ``id``, ``objectType``, ``objectId``, ``subId``, ``updatedAtMs`` or
+    ``metadata.<key>``; list-valued metadata matches when any element does.
+    """
+    if expr is None:
+        return None
+    if not isinstance(expr, dict):
+        raise _invalid_filter("expected an object")
+    clauses: List[Tuple[Any, ...]] = []
+    for key, value in expr.items():
+        if key in ("$and", "$or"):
+            if not isinstance(value, list) or not value:
+                raise _invalid_filter(f"{key} expects a non-empty list")
+            children = [_compile_vector_filter(child) for child in value]
+            if key == "$or":
+                if any(child is None for child in children):
+                    continue
+                clauses.append(("or", children))
+            else:
+                clauses.extend(child for child in children if child is not None)
+            continue
+        if key not in _VECTOR_FILTER_FIELDS and not (
+            key.startswith("metadata.") and len(key) > len("metadata.")
+        ):
+            raise _invalid_filter(f"unsupported field {key!r}")
+        if isinstance(value, dict) and value and all(str(op).startswith("$") for op in value):
+            ops = list(value.items())
+        else:
+            ops = [("$eq", value)]
+        for op, operand in ops:
+            if op not in _VECTOR_FILTER_OPS:
+                raise _invalid_filter(f"unsupported operator {op!r}")
+            if op in ("$in", "$nin") and not isinstance(operand, list):
+                raise _invalid_filter(f"{op} expects a list")
+            if op in ("$eq", "$ne", "$in", "$nin") and not all(
+                _is_filter_scalar(v) for v in (operand if op in ("$in", "$nin") else [operand])
+            ):
+                raise _invalid_filter(f"{op} on {key!r} expects strings, numbers, booleans or null")
+            if op == "$exists" and not isinstance(operand, bool):
+                raise _invalid_filter("$exists expects a boolean")
+            if key == "objectType" and op != "$exists":
+                if isinstance(operand, list):
+                    operand = [str(v or "").lower() for v in operand]
+                else:
+                    operand = str(operand or "").lower()
+            clauses.append(("cmp", key, op, operand))
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else ("and", clauses)
+
+
+def _is_posting_field(field: str) -> bool:
+    return field == "objectType" or (
+        field.startswith("metadata.") and field[len("metadata."):] in VECTOR_INDEXED_METADATA_KEYS
+    )
+
+
+def _filter_cost(node: Tuple[Any, ...]) -> int:
+    if node[0] != "cmp":
+        return max(_filter_cost(child) for child in node[1])
+    _, field, op, _ = node
+    if _is_posting_field(field) and op in ("$eq", "$in", "$ne", "$nin"):
+        return 0
+    if field == "updatedAtMs":
+        return 1
+    return 2
+
+
+def _record_filter_values(record: Dict[str, Any], field: str) -> List[Any]:
+    if field.startswith("metadata."):
+        metadata = record.get("metadata")
+        if not isinstance(metadata, dict) or field[len("metadata."):] not in metadata:
+            return []
+        value = metadata[field[len("metadata."):]]
+    else:
+        value = record.get(field)
+        if field == "objectType":
+            value = str(value or "").lower()
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _match_filter_values(values: List[Any], op: str, operand: Any) -> bool:
+    if op == "$exists":
+        return bool(values) == operand
+    if op == "$eq":
+        return operand in values
+    if op == "$ne":
+        return operand not in values
+    if op == "$in":
+        return any(v in operand for v in values)
+    if op == "$nin":
+        return not any(v in operand for v in values)
+    for value in values:
+        try:
+            if (
+                (op == "$gt" and value > operand)
+                or (op == "$gte" and value >= operand)
+                or (op == "$lt" and value < operand)
+                or (op == "$lte" and value <= operand)
+            ):
+                return True
+        except TypeError:
+            continue
+    return False
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _filter_column_rows(
+    column: np.ndarray, rows: np.ndarray, op: str, operand: Any
+) -> Optional[np.ndarray]:
+    values = column[rows]
+    if op in ("$in", "$nin"):
+        if not all(_is_number(v) for v in operand):
+            return None
+        hit = np.isin(values, operand)
+        return rows[hit if op == "$in" else ~hit]
+    if not _is_number(operand):
+        return None
+    if op == "$eq":
+        return rows[values == operand]
+    if op == "$ne":
+        return rows[values != operand]
+    if op == "$gt":
+        return rows[values > operand]
+    if op == "$gte":
+        return rows[values >= operand]
+    if op == "$lt":
+        return rows[values < operand]
+    if op == "$lte":
+        return rows[values <= operand]
+    return None
+
+
+def _filter_partition_rows(
+    partition: "_VectorPartition",
+    node: Tuple[Any, ...],
+    rows: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Sorted rows of ``partition`` (within ``rows`` if given) matching ``node``.
+
+    Indexed predicates run first off the posting lists, then column ranges,
+    and only the survivors are checked against residual predicates.
+    """
+    kind = node[0]
+    if kind == "and":
+        for child in sorted(node[1], key=_filter_cost):
+            rows = _filter_partition_rows(partition, child, rows)
+            if rows.size == 0:
+                break
+        return rows if rows is not None else np.arange(partition.size)
+    if kind == "or":
+        matched = _EMPTY_ROWS
+        for child in node[1]:
+            matched = np.union1d(matched, _filter_partition_rows(partition, child, rows))
+        return matched
+    _, field, op, operand = node
+    if _is_posting_field(field) and op in ("$eq", "$in", "$ne", "$nin"):
+        posted = partition.posting_rows(field, operand if op in ("$in", "$nin") else [operand])
+        if op in ("$eq", "$in"):
+            return posted if rows is None else np.intersect1d(rows, posted, assume_unique=True)
+        base = rows if rows is not None else np.arange(partition.size)
+        return np.setdiff1d(base, posted, assume_unique=True)
+    base = rows if rows is not None else np.arange(partition.size)
+    if field == "updatedAtMs" and op != "$exists":
+        matched = _filter_column_rows(partition.updated_at, base, op, operand)
+        if matched is not None:
+            return matched
+    store = _VECTOR_STORE
+    present = [(row, store.get(partition.ids[row])) for row in base.tolist()]
+    present = [(row, record) for row, record in present if record is not None]
+    candidates = [record for _, record in present]
+    if field.startswith("metadata."):
+        candidates = _with_documents(candidates)
+    keep = [
+        row
+        for (row, _), record in zip(present, candidates)
+        if _match_filter_values(_record_filter_values(record, field), op, operand)
+    ]
+    return np.asarray(keep, dtype=np.int64)
+
+
+def _clamp_limit(value: Optional[int], default: int = 12, max_limit: int = 50) -> int:
+    try:
+        parsed = int(value if value is not None else default)
+    except Exception:
+        parsed = default
+    if parsed < 1:
+        return 1
+    return min(parsed, max_limit)
+
+
+class _ResultFields:
+    """The keys a result carries besides ``id`` and ``score``, and how many
+    characters of ``document`` to keep. ``documents`` tells callers whether
+    text/metadata must be read back from the segment or backend at all."""
+
+    __slots__ = ("names", "snippet", "documents")
+
+    NAMES = ("userId", "embedding", "objectType", "objectId", "subId", "metadata", "document")
+
+    def __init__(self, names: Iterable[str], snippet: Optional[int] = None):
+        wanted = set(names)
+        self.names = tuple(name for name in self.NAMES if name in wanted)
+        self.snippet = snippet
+        self.documents = "metadata" in wanted or "document" in wanted
+
+    @classmethod
+    def parse(cls, fields: Optional[List[str]], snippet: Optional[int], default: "_ResultFields") -> "_ResultFields":
+        """Request ``fields`` (``None`` for ``default``'s); ``id`` and ``score`` are always returned."""
+        names = default.names if fields is None else {str(name).strip() for name in fields} - {"id", "score"}
+        unknown = sorted(set(names) - set(cls.NAMES))
+        if unknown:
+            raise HTTPException(
+                status_code=400, detail=f"unknown fields {unknown}; choose from {list(cls.NAMES)}"
+            )
+        return cls(names, snippet)
+
+    def result(self, record: Dict[str, Any], score: Optional[float] = None) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"id": record.get("id", "")}
+        for name in self.names:
+            if name == "embedding":
+                out[name] = record["embedding"].tolist()
+            elif name == "metadata":
+                out[name] = record.get("metadata", {}) if isinstance(record.get("metadata"), dict) else {}
+            elif name == "document":
+                text = record.get("text", "") or ""
+                out[name] = text[: self.snippet] if self.snippet else text
+            else:
+                out[name] = record.get(name, "")
+        if score is not None:
+            out["score"] = score
+        return out
+
+
+_SEARCH_FIELDS = _ResultFields(("objectType", "objectId", "subId", "metadata", "document"))
+_GET_FIELDS = _ResultFields(_ResultFields.NAMES)
+
+
+def _vector_result(
+    record: Dict[str, Any], score: Optional[float] = None, fields: _ResultFields = _SEARCH_FIELDS
+) -> Dict[str, Any]:
+    return fields.result(record, score)
+
+
+async def _hf_embed_texts(texts: List[str], config: Optional[Dict[str, Any]] = None) -> List[List[float]]:
+    if not texts:
+        return []
+    cfg = config or get_hf_config()
+    if not cfg["token"]:
+        raise HTTPException(status_code=500, detail="HF_TOKEN not configured")
+    try:
+        url = build_models_inference_url(
+            cfg["models_base_url"],
+            cfg["embedding_model"],
+            "pipeline/feature-extraction"
+        )
+        res = await _post_hf(
+            url,
+            cfg["token"],
+            {"inputs": texts},
+            cfg["timeout_ms"],
+        )
+        body = _parse_json_or_text(res)
+        if res.status_code < 200 or res.status_code >= 300:
+            _raise_hf_response_error("embeddings", body, cfg["provider"])
+        return _normalize_embeddings(body, expected_count=len(texts))
+    except Exception as exc:
+        if isinstance(exc, (HTTPException, UpstreamStructuredError)):
+            raise
+        _raise_hf_error("embeddings", exc)
+
+
+async def _hf_embed_batches(texts: List[str], config: Optional[Dict[str, Any]] = None) -> List[List[float]]:
+    """``_hf_embed_texts`` in requests of at most ``AI_EMBED_BATCH_SIZE`` texts, in order."""
+    embeddings: List[List[float]] = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        embeddings.extend(await _hf_embed_texts(texts[start : start + EMBED_BATCH_SIZE], config=config))
+    return embeddings
+
+
+_CHUNK_ID_SEPARATOR = "#chunk-"
+_CHUNK_WORD = re.compile(r"\S+")
+
+
+def _chunk_text(text: str, words: int, overlap: int) -> List[str]:
+    """Windows of ``words`` whitespace-separated words, each starting ``words - overlap``
+    after the last; the text itself when it fits in one. Chunks are slices of ``text``."""
+    spans = [match.span() for match in _CHUNK_WORD.finditer(text)]
+    if len(spans) <= words:
+        return [text]
+    chunks: List[str] = []
+    for start in range(0, len(spans), words - overlap):
+        end = min(start + words, len(spans))
+        chunks.append(text[spans[start][0] : spans[end - 1][1]])
+        if end == len(spans):
+            break
+    return chunks
+
+
+def _chunk_upsert_items(
+    items: List[EmbeddingUpsertItem],
+) -> Tuple[List[EmbeddingUpsertItem], List[Optional[str]]]:
+    """Items whose text runs past ``AI_EMBED_CHUNK_WORDS`` words replaced by one item per chunk:
+    id ``<id>#chunk-<n>``, ``subId`` ``n``, same object and metadata. Shorter items pass through.
+    Also returns, per item out, the id its chunk was cut from (None for items passed through)."""
+    out: List[EmbeddingUpsertItem] = []
+    chunk_of: List[Optional[str]] = []
+    for item in items:
+        chunks = _chunk_text(str(item.text or "").strip(), EMBED_CHUNK_WORDS, EMBED_CHUNK_OVERLAP)
+        if len(chunks) == 1:
+            out.append(item)
+            chunk_of.append(None)
+            continue
+        parent_id = str(item.id or "").strip()
+        out.extend(
+            item.model_copy(update={"id": f"{parent_id}{_CHUNK_ID_SEPARATOR}{n}", "subId": str(n), "text": chunk})
+            for n, chunk in enumerate(chunks)
+        )
+        chunk_of.extend([parent_id] * len(chunks))
+    return out, chunk_of
+
+
+# Chunk ids stored under each id a chunked text was upserted under, from the
+# records' ``chunkOf``. Changed only inside ``_vector_write``.
+_CHUNK_FAMILIES: Dict[str, Set[str]] = {}
+
+
+def _rebuild_chunk_families() -> None:
+    _CHUNK_FAMILIES.clear()
+    for record in _VECTOR_STORE.values():
+        _link_chunk(record)
+
+
+def _link_chunk(record: _VectorRecord) -> None:
+    if record.chunkOf is not None:
+        _CHUNK_FAMILIES.setdefault(record.chunkOf, set()).add(record.id)
+
+
+def _unlink_chunk(record: _VectorRecord) -> None:
+    family = _CHUNK_FAMILIES.get(record.chunkOf) if record.chunkOf is not None else None
+    if family is not None:
+        family.discard(record.id)
+        if not family:
+            del _CHUNK_FAMILIES[record.chunkOf]
+
+
+def _chunk_family(record_id: str) -> List[str]:
+    """``record_id`` if stored, then the chunks stored under it. Call inside ``_vector_write``."""
+    family = [record_id] if record_id in _VECTOR_STORE else []
+    family.extend(sorted(_CHUNK_FAMILIES.get(record_id, ())))
+    return family
+
+
+def _pop_vector_records(keys: Iterable[str]) -> List[Tuple[str, str]]:
+    """Drop stored ``keys`` and queue their delete; ``(userId, id)`` of each dropped. Call inside ``_vector_write``."""
+    owners: List[Tuple[str, str]] = []
+    for key in keys:
+        record = _VECTOR_STORE.pop(key, None)
+        if record is not None:
+            _unindex_vector_record(record)
+            _unlink_chunk(record)
+            owners.append((record.userId, key))
+    if owners:
+        _enqueue_vector_writes([("delete", [key for _, key in owners])])
+    return owners
+
+
+def _upsert_vector_records(
+    items: List[EmbeddingUpsertItem],
+    embeddings: List[List[float]],
+    chunk_of: Optional[List[Optional[str]]] = None,
+) -> int:
+    """Store ``items``; ``chunk_of`` names, per item, the id its chunk was cut from
+    (see ``_chunk_upsert_items``). Returns the number of records written."""
+    if len(items) != len(embeddings):
+        raise HTTPException(status_code=500, detail="embedding count mismatch")
+    _load_vector_store_if_needed()
+    now_ms = int(time.time() * 1000)
+    records: List[_VectorRecord] = []
+    for item, embedding, parent_id in zip(items, embeddings, chunk_of or itertools.repeat(None)):
+        clean_id = str(item.id or "").strip()
+        clean_user = str(item.userId or "").strip()
+        clean_type = str(item.objectType or "").strip()
+        clean_object_id = str(item.objectId or "").strip()
+        clean_text = str(item.text or "").strip()
+        if not clean_id or not clean_user or not clean_type or not clean_object_id or not clean_text:
+            raise HTTPException(status_code=400, detail="embedding item missing required fields")
+        records.append(
+            _VectorRecord(
+                clean_id,
+                clean_user,
+                clean_type,
+                clean_object_id,
+                str(item.subId or ""),
+                now_ms,
+                np.asarray(embedding, dtype=np.float32),
+                text=clean_text,
+                metadata=item.metadata if isinstance(item.metadata, dict) else {},
+                chunkOf=parent_id,
+            )
+        )
+    fresh = {record.id for record in records}
+    with _vector_write():
+        # Upserting an id replaces all of it: chunks a longer text left behind, or the unchunked record.
+        parents = dict.fromkeys(record.chunkOf or record.id for record in records)
+        stale = _pop_vector_records(key for parent in parents for key in _chunk_family(parent) if key not in fresh)
+        for record in records:
+            previous = _VECTOR_STORE.get(record["id"])
+            if previous is not None:
+                # A record that stays in its partition is rewritten on its own row.
+                if _partition_key(previous) != _partition_key(record):
+                    _unindex_vector_record(previous)
+                _unlink_chunk(previous)
+            _VECTOR_STORE[record["id"]] = record
+            _index_vector_record(record)
+            _link_chunk(record)
+        _enqueue_vector_writes([("upsert", record) for record in records])
+    _note_cluster_writes(stale + [(record.userId, record.id) for record in records])
+    return len(items)
+
+
+def _get_vector_records(ids: List[str], fields: _ResultFields = _GET_FIELDS) -> List[Dict[str, Any]]:
+    _load_vector_store_if_needed()
+    store = _VECTOR_STORE
+    found = [store.get(key) if isinstance(key, str) else None for key in ids]
+    found = [rec for rec in found if rec is not None]
+    return [fields.result(rec) for rec in (_with_documents(found) if fields.documents else found)]
+
+
+def _delete_vector_records(ids: List[str]) -> int:
+    """Delete ``ids`` and the chunks stored under each; returns the number of records removed."""
+    _load_vector_store_if_needed()
+    with _vector_write():
+        clean_ids = [str(raw_id or "").strip() for raw_id in ids]
+        owners = _pop_vector_records(dict.fromkeys(key for clean in clean_ids if clean for key in _chunk_family(clean)))
+    _note_cluster_writes(owners)
+    return len(owners)
+
+
+def _search_vectors(
+    query_vector: List[float],
+    *,
+    user_id: str,
+    types: Optional[List[str]],
+    limit: int,
+    exclude_id: Optional[str] = None,
+    filter_expr: Optional[Dict[str, Any]] = None,
+    exclude_ids: Tuple[str, ...] = (),
+    min_score: float = 0.0,
+    mmr_lambda: Optional[float] = None,
+    collapse: bool = False,
+    quotas: Optional[Dict[str, int]] = None,
+    chunk_score: Optional[str] = None,
+    fields: _ResultFields = _SEARCH_FIELDS,
+) -> List[Dict[str, Any]]:
+    """Top ``limit`` records by cosine score. ``mmr_lambda`` re-ranks the best
+    ``limit * AI_SEARCH_MMR_FETCH_FACTOR`` for diversity (see ``_mmr_rerank``);
+    ``collapse`` and ``quotas`` group results (see ``_VectorPartition.grouped_search``).
+    ``chunk_score`` collapses too, scoring each object by its best chunk
+    (``"max"``) or the mean of its best ``AI_SEARCH_CHUNK_MEAN_TOP`` (``"mean"``)."""
+    _load_vector_store_if_needed()
+    filter_node = _search_filter_node(types, filter_expr)
+    safe_exclude = _exclude_ids(exclude_id, exclude_ids)
+    if query_vector is None or len(query_vector) == 0 or limit <= 0:
+        return []
+    query = _unit_vector(query_vector)
+    if not query.any():
+        return []
+    partitions = _search_partitions(user_id, int(query.shape[0]))
+    if collapse or quotas or chunk_score:
+        collapse = collapse or chunk_score is not None
+        top = SEARCH_CHUNK_MEAN_TOP if chunk_score == "mean" else 1
+        grouped: List[Tuple[float, str, int]] = []
+        for partition in partitions:
+            rows = None if filter_node is None else _filter_partition_rows(partition, filter_node)
+            grouped.extend(
+                partition.grouped_search(query, limit, rows, safe_exclude, min_score, collapse, quotas, top)
+            )
+        return _grouped_results(grouped, limit, collapse=collapse, quotas=quotas, fields=fields)
+    fetch = limit if mmr_lambda is None else limit * SEARCH_MMR_FETCH_FACTOR
+    hits: List[Tuple[float, str]] = []
+    for partition in partitions:
+        rows = None if filter_node is None else _filter_partition_rows(partition, filter_node)
+        hits.extend(partition.search(query, fetch, rows, exclude=safe_exclude, min_score=min_score))
+    if mmr_lambda is not None:
+        return _search_results(_mmr_rerank(hits, limit, mmr_lambda), limit, fields=fields)
+    return _search_results(hits, limit, merged=len(partitions) > 1, fields=fields)
+
+
+def _search_lexical(
+    query: str,
+    *,
+    user_id: str,
+    types: Optional[List[str]],
+    limit: int,
+    filter_expr: Optional[Dict[str, Any]] = None,
+    min_score: float = 0.0,
+    fields: _ResultFields = _SEARCH_FIELDS,
+) -> List[Dict[str, Any]]:
+    """Top ``limit`` records by BM25 over their ``text``; no embedding needed.
+    Covers every partition of ``user_id`` (or of everyone, without one)."""
+    _load_vector_store_if_needed()
+    filter_node = _search_filter_node(types, filter_expr)
+    terms = _lexical_terms(query)
+    if not terms or limit <= 0:
+        return []
+    safe_user_id = str(user_id or "").strip()
+    partitions = [p for p in _VECTOR_PARTITIONS.values() if not safe_user_id or p.user_id == safe_user_id]
+    hits: List[Tuple[float, str]] = []
+    for partition in partitions:
+        if partition.lexical is None:
+            partition = _lexical_partition(partition)
+            if partition is None:
+                continue
+        rows = None if filter_node is None else _filter_partition_rows(partition, filter_node)
+        hits.extend(partition.lexical_search(terms, limit, rows, min_score=min_score))
+    return _search_results(hits, limit, merged=len(partitions) > 1, fields=fields)
+
+
+def _lexical_partition(partition: _VectorPartition) -> Optional[_VectorPartition]:
+    """The latest version of ``partition`` with its BM25 index attached.
+
+    The index is built off-lock from the records the published version holds,
+    then caught up and attached to a draft, so published partitions are never
+    changed and writes made during the build are not missed.
+    """
+    key = (partition.user_id, partition.dim)
+    with _VECTOR_STORE_LOCK:
+        published = _VECTOR_PARTITIONS.get(key)
+        if published is None or published.lexical is not None:
+            return published
+        store = _VECTOR_STORE
+        records = [store.get(record_id) for record_id in published.ids]
+    index = _LexicalIndex.build(records)
+    with _vector_write():
+        draft = _draft_partition(key)
+        if draft is not None and draft.lexical is None:
+            index.catch_up(draft, records)
+            draft.lexical = index
+    return _VECTOR_PARTITIONS.get(key)
+
+
+def _mmr_rerank(hits: List[Tuple[float, str]], limit: int, mmr_lambda: float) -> List[Tuple[float, str]]:
+    """Maximal Marginal Relevance over candidate ``hits``.
+
+    Greedily picks the candidate maximizing ``lambda * score - (1 - lambda) *
+    max cosine to the picks so far``. Candidate similarities are one matrix
+    product; each pick is a vector update, so the loop is ``limit`` numpy steps.
+    Returned hits keep their relevance scores, in pick order.
+    """
+    store = _VECTOR_STORE
+    found = [(score, record_id, store.get(record_id)) for score, record_id in hits]
+    found = [(score, record_id, record) for score, record_id, record in found if record is not None]
+    if len(found) <= 1:
+        return [(score, record_id) for score, record_id, _ in found]
+    found.sort(key=lambda hit: hit[0], reverse=True)
+    relevance = np.array([score for score, _, _ in found], dtype=np.float32)
+    vectors = _unit_rows(np.stack([record.embedding for _, _, record in found]).astype(np.float32))
+    similarity = vectors @ vectors.T
+    closest = np.zeros(len(found), dtype=np.float32)
+    gain = mmr_lambda * relevance
+    picks: List[int] = []
+    for _ in range(min(limit, len(found))):
+        pick = int(np.argmax(gain - (1.0 - mmr_lambda) * closest))
+        picks.append(pick)
+        gain[pick] = -np.inf
+        np.maximum(closest, similarity[pick], out=closest)
+    return [(found[pick][0], found[pick][1]) for pick in picks]
+
+
+def _search_vectors_batch(
+    query_vectors: List[List[float]],
+    *,
+    user_id: str,
+    types: Optional[List[str]],
+    limit: int,
+    filter_expr: Optional[Dict[str, Any]] = None,
+    exclude_ids: Tuple[str, ...] = (),
+    min_score: float = 0.0,
+) -> List[List[Dict[str, Any]]]:
+    """``_search_vectors`` for several queries of one dimension. The filter runs once
+    per partition and the queries are scored together via ``partition.search_batch``."""
+    hits, merged = _search_hits_batch(
+        query_vectors,
+        user_id=user_id,
+        types=types,
+        limit=limit,
+        filter_expr=filter_expr,
+        exclude_ids=exclude_ids,
+        min_score=min_score,
+    )
+    return [_search_results(query_hits, limit, merged=merged) for query_hits in hits]
+
+
+def _search_vectors_union(
+    query_vectors: List[List[float]],
+    *,
+    user_id: str,
+    types: Optional[List[str]],
+    limit: int,
+    filter_expr: Optional[Dict[str, Any]] = None,
+    exclude_ids: Tuple[str, ...] = (),
+    min_score: float = 0.0,
+    mmr_lambda: Optional[float] = None,
+    fields: _ResultFields = _SEARCH_FIELDS,
+) -> List[Dict[str, Any]]:
+    """One ranking over several queries, each record scored by its best query.
+
+    Exact: a record in the top ``limit`` by best score is in the top ``limit`` of
+    the query that gives it that score, so merging the per-query lists is enough.
+    """
+    fetch = limit if mmr_lambda is None else limit * SEARCH_MMR_FETCH_FACTOR
+    hits, _ = _search_hits_batch(
+        query_vectors,
+        user_id=user_id,
+        types=types,
+        limit=fetch,
+        filter_expr=filter_expr,
+        exclude_ids=exclude_ids,
+        min_score=min_score,
+    )
+    best: Dict[str, float] = {}
+    for query_hits in hits:
+        for score, record_id in query_hits:
+            if score > best.get(record_id, 0.0):
+                best[record_id] = score
+    merged = [(score, record_id) for record_id, score in best.items()]
+    if mmr_lambda is not None:
+        return _search_results(_mmr_rerank(merged, limit, mmr_lambda), limit, fields=fields)
+    return _search_results(merged, limit, merged=True, fields=fields)
+
+
+def _search_hits_batch(
+    query_vectors: List[List[float]],
+    *,
+    user_id: str,
+    types: Optional[List[str]],
+    limit: int,
+    filter_expr: Optional[Dict[str, Any]],
+    exclude_ids: Tuple[str, ...],
+    min_score: float = 0.0,
+) -> Tuple[List[List[Tuple[float, str]]], bool]:
+    _load_vector_store_if_needed()
+    filter_node = _search_filter_node(types, filter_expr)
+    hits: List[List[Tuple[float, str]]] = [[] for _ in query_vectors]
+    if not query_vectors or limit <= 0:
+        return hits, False
+    queries = np.stack([_unit_vector(vector) for vector in query_vectors])
+    live = queries.any(axis=1)
+    partitions = _search_partitions(user_id, int(queries.shape[1]))
+    exclude = _exclude_ids(None, exclude_ids)
+    for partition in partitions:
+        rows = None if filter_node is None else _filter_partition_rows(partition, filter_node)
+        for i, partition_hits in enumerate(partition.search_batch(queries, limit, rows, exclude, min_score)):
+            if live[i]:
+                hits[i].extend(partition_hits)
+    return hits, len(partitions) > 1
+
+
+def _exclude_ids(exclude_id: Optional[str], exclude_ids: Tuple[str, ...]) -> Tuple[str, ...]:
+    ids = (exclude_id, *exclude_ids) if exclude_id else tuple(exclude_ids)
+    return tuple(dict.fromkeys(key for key in (str(raw or "").strip() for raw in ids) if key))
+
+
+def _search_filter_node(types: Optional[List[str]], filter_expr: Optional[Dict[str, Any]]) -> Any:
+    types_filter = _normalize_types(types)
+    filter_node = _compile_vector_filter(filter_expr)
+    if types_filter:
+        type_node = ("cmp", "objectType", "$in", sorted(types_filter))
+        filter_node = type_node if filter_node is None else ("and", [type_node, filter_node])
+    return filter_node
+
+
+def _search_partitions(
+    user_id: str, dim: int, snapshot: Optional[_PartitionMap] = None
+) -> List["_VectorPartition"]:
+    safe_user_id = str(user_id or "").strip()
+    snapshot = _VECTOR_PARTITIONS if snapshot is None else snapshot
+    if safe_user_id:
+        partition = snapshot.get((safe_user_id, dim))
+        return [partition] if partition is not None else []
+    return [p for p in snapshot.values() if p.dim == dim]
+
+
+def _search_results(
+    hits: List[Tuple[float, str]], limit: int, *, merged: bool = False, fields: _ResultFields = _SEARCH_FIELDS
+) -> List[Dict[str, Any]]:
+    if merged:
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+    store = _VECTOR_STORE
+    found = [(score, store.get(record_id)) for score, record_id in hits]
+    found = [(score, record) for score, record in found if record is not None][:limit]
+    records = [record for _, record in found]
+    if fields.documents:
+        records = _with_documents(records)
+    return [fields.result(record, score=score) for (score, _), record in zip(found, records)]
+
+
+def _grouped_results(
+    grouped: List[Tuple[float, str, int]],
+    limit: int,
+    *,
+    collapse: bool,
+    quotas: Optional[Dict[str, int]],
+    fields: _ResultFields = _SEARCH_FIELDS,
+) -> List[Dict[str, Any]]:
+    """Merge ``grouped_search`` hits of several partitions, holding ``quotas`` across them.
+    Collapsed results carry the id a chunked record was upserted under; ``subId`` names the chunk."""
+    grouped.sort(key=lambda hit: hit[0], reverse=True)
+    store = _VECTOR_STORE
+    taken: Dict[str, int] = {}
+    found: List[Tuple[float, int, Any]] = []
+    for score, record_id, hits in grouped:
+        record = store.get(record_id)
+        if record is None:
+            continue
+        if quotas:
+            object_type = str(record.objectType or "").lower()
+            if taken.get(object_type, 0) >= quotas.get(object_type, 0):
+                continue
+            taken[object_type] = taken.get(object_type, 0) + 1
+        found.append((score, hits, record))
+        if len(found) >= limit:
+            break
+    records = [record for _, _, record in found]
+    if fields.documents:
+        records = _with_documents(records)
+    results = [fields.result(record, score=score) for (score, _, _), record in zip(found, records)]
+    if collapse:
+        for result, (_, hits, record) in zip(results, found):
+            result["id"] = record.chunkOf or result["id"]
+            result["hits"] = hits
+    return results
+
+
+def _rrf_fuse(result_lists: List[List[Dict[str, Any]]], limit: int, k: int = 60) -> List[Dict[str, Any]]:
+    """Reciprocal rank fusion: each result scores ``sum(1 / (k + rank))`` over the lists it appears in."""
+    fused: Dict[str, float] = {}
+    first: Dict[str, Dict[str, Any]] = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            result_id = result["id"]
+            fused[result_id] = fused.get(result_id, 0.0) + 1.0 / (k + rank)
+            first.setdefault(result_id, result)
+    ranked = sorted(fused.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    return [{**first[result_id], "score": score} for result_id, score in ranked]
+
+
+class _SearchCursor:
+    """A ranked scan kept between the pages of one search.
+
+    Holds the partitions of the snapshot the first page ran against (published
+    partitions never change), the scan score of every candidate row, and the
+    ranking cut so far. A page is a slice of that ranking; reaching past its end
+    ranks the next window of remaining rows, so no page scans or embeds again.
+    With several queries a row scores its best one. Lossy codecs re-score each
+    window from full precision, so their order is exact within a window only.
+    """
+
+    _WINDOW = 256
+
+    def __init__(
+        self,
+        fingerprint: str,
+        snapshot: _PartitionMap,
+        partitions: List["_VectorPartition"],
+        queries: np.ndarray,
+        scores: np.ndarray,
+        owners: np.ndarray,
+        rows: np.ndarray,
+        min_score: float = 0.0,
+    ):
+        self.key = os.urandom(9).hex()
+        self.fingerprint = fingerprint
+        self.version = snapshot.version
+        self.partitions = partitions
+        self.queries = queries
+        self.scores = scores
+        self.owners = owners
+        self.rows = rows
+        self.min_score = min_score
+        self.pending = np.arange(scores.size)
+        self.ranked: List[Tuple[float, str]] = []
+        self.touched = time.monotonic()
+        self.lock = threading.Lock()
+        factors = [
+            partition.codec.rescore_factor if VECTOR_RESCORE_FACTOR is None else VECTOR_RESCORE_FACTOR
+            for partition in partitions
+            if partition.codec.lossy
+        ]
+        self.lossy = any(factors)
+        self.factor = max([1, *factors])
+
+    def page(self, offset: int, limit: int) -> List[Tuple[float, str]]:
+        with self.lock:
+            while len(self.ranked) < offset + limit and self.pending.size:
+                self._rank_window(max(offset + limit - len(self.ranked), self._WINDOW))
+            return self.ranked[offset : offset + limit]
+
+    def hits_from(self, offset: int):
+        """``(next offset, hit)`` pairs from ``offset`` on, skipping records deleted since."""
+        while True:
+            hits = self.page(offset, self._WINDOW)
+            if not hits:
+                return
+            store = _VECTOR_STORE
+            for hit in hits:
+                offset += 1
+                if hit[1] in store:
+                    yield offset, hit
+
+    def _rank_window(self, wanted: int) -> None:
+        pending_scores = self.scores[self.pending]
+        cut = pending_scores.size - min(pending_scores.size, wanted * self.factor)
+        chosen = pending_scores >= np.partition(pending_scores, cut)[cut]
+        window, self.pending = self.pending[chosen], self.pending[~chosen]
+        exact = self._exact_scores(window) if self.lossy else self.scores[window]
+        store = _VECTOR_STORE
+        hits = []
+        for index, score in zip(window.tolist(), exact.tolist()):
+            record_id = self.partitions[self.owners[index]].ids[self.rows[index]]
+            if score > 0 and score >= self.min_score and record_id in store:
+                hits.append((score, record_id, index))
+        hits.sort(key=lambda hit: (-hit[0], hit[1]))
+        if self.lossy and len(hits) > wanted:
+            self.pending = np.concatenate([self.pending, [hit[2] for hit in hits[wanted:]]]).astype(np.int64)
+            hits = hits[:wanted]
+        self.ranked.extend((score, record_id) for score, record_id, _ in hits)
+
+    def _exact_scores(self, window: np.ndarray) -> np.ndarray:
+        exact = self.scores[window].copy()
+        owners = self.owners[window]
+        for owner in np.unique(owners).tolist():
+            partition = self.partitions[owner]
+            if partition.codec.lossy:
+                at = np.flatnonzero(owners == owner)
+                block = partition.full_precision(self.rows[window[at]])
+                exact[at] = (block @ self.queries.T).max(axis=1)
+        return exact
+
+
+_SEARCH_CURSORS: Dict[str, _SearchCursor] = {}
+_SEARCH_CURSORS_LOCK = threading.Lock()
+
+
+def _open_search_cursor(
+    query_vectors: List[Any],
+    *,
+    user_id: str,
+    types: Optional[List[str]],
+    filter_expr: Optional[Dict[str, Any]],
+    fingerprint: str,
+    exclude_ids: Tuple[str, ...] = (),
+    after: Optional[Tuple[float, str]] = None,
+    min_score: float = 0.0,
+) -> _SearchCursor:
+    """Score every allowed row once, ANN or not. ``after`` is a ``(score, id)``
+    watermark: only rows ranked below it are kept."""
+    _load_vector_store_if_needed()
+    filter_node = _search_filter_node(types, filter_expr)
+    queries = np.stack([_unit_vector(vector) for vector in query_vectors])
+    snapshot = _VECTOR_PARTITIONS
+    partitions = _search_partitions(user_id, int(queries.shape[1]), snapshot)
+    exclude = _exclude_ids(None, exclude_ids)
+    scores: List[np.ndarray] = []
+    owners: List[np.ndarray] = []
+    rows: List[np.ndarray] = []
+    for owner, partition in enumerate(partitions):
+        if partition.size == 0:
+            continue
+        if filter_node is None:
+            part_rows = np.arange(partition.size)
+            part_scores = partition.codec.batch_scores(partition.vectors[: partition.size], queries)
+        else:
+            part_rows = _filter_partition_rows(partition, filter_node)
+            part_scores = partition.codec.batch_scores(partition.vectors[part_rows], queries)
+        part_scores = part_scores.max(axis=0)
+        if partition.codec.lossy:
+            keep = np.ones(part_scores.size, dtype=bool)
+        else:
+            keep = part_scores >= min_score if min_score > 0 else part_scores > 0
+        excluded = [partition.rows[record_id] for record_id in exclude if record_id in partition.rows]
+        if excluded:
+            keep &= ~np.isin(part_rows, excluded)
+        if after is not None:
+            keep &= part_scores <= after[0]
+            for pos in np.flatnonzero(keep & (part_scores == after[0])).tolist():
+                keep[pos] = partition.ids[part_rows[pos]] > after[1]
+        scores.append(part_scores[keep])
+        rows.append(part_rows[keep])
+        owners.append(np.full(rows[-1].size, owner, dtype=np.int64))
+    return _SearchCursor(
+        fingerprint,
+        snapshot,
+        partitions,
+        queries,
+        np.concatenate(scores) if scores else np.empty(0, dtype=np.float32),
+        np.concatenate(owners) if owners else _EMPTY_ROWS,
+        np.concatenate(rows) if rows else _EMPTY_ROWS,
+        min_score,
+    )
+
+
+def _cursor_fingerprint(*parts: Any) -> str:
+    """Ties a cursor to the request that opened it."""
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _lookup_search_cursor(
+    token: Optional[str], fingerprint: str
+) -> Tuple[Optional[_SearchCursor], int, Optional[Tuple[float, str]]]:
+    """``(cursor, offset, None)`` while the token's cursor is cached, and
+    ``(None, 0, watermark)`` once it has expired; ``(None, 0, None)`` without a token."""
+    if not token:
+        return None, 0, None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        key, offset, watermark = str(payload["k"]), int(payload["o"]), (float(payload["s"]), str(payload["i"]))
+        if payload["f"] != fingerprint:
+            raise ValueError("cursor belongs to another request")
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    with _SEARCH_CURSORS_LOCK:
+        cursor = _SEARCH_CURSORS.get(key)
+    if cursor is None or time.monotonic() - cursor.touched >= SEARCH_CURSOR_TTL_SEC:
+        return None, 0, watermark
+    return cursor, offset, None
+
+
+def _remember_search_cursor(cursor: _SearchCursor) -> None:
+    now = time.monotonic()
+    with _SEARCH_CURSORS_LOCK:
+        cursor.touched = now
+        _SEARCH_CURSORS.pop(cursor.key, None)
+        _SEARCH_CURSORS[cursor.key] = cursor
+        for key, old in list(_SEARCH_CURSORS.items()):
+            if len(_SEARCH_CURSORS) <= SEARCH_CURSOR_CACHE_SIZE and now - old.touched < SEARCH_CURSOR_TTL_SEC:
+                break
+            del _SEARCH_CURSORS[key]
+
+
+def _search_cursor_page(
+    cursor: _SearchCursor, offset: int, limit: int, fields: _ResultFields = _SEARCH_FIELDS
+) -> Dict[str, Any]:
+    taken = list(itertools.islice(cursor.hits_from(offset), limit + 1))
+    hits = [hit for _, hit in taken[:limit]]
+    next_cursor = None
+    if len(taken) > limit:
+        payload = {
+            "k": cursor.key,
+            "o": taken[limit - 1][0],
+            "v": cursor.version,
+            "f": cursor.fingerprint,
+            "s": hits[-1][0],
+            "i": hits[-1][1],
+        }
+        next_cursor = base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii").rstrip("=")
+        _remember_search_cursor(cursor)
+    return {
+        "results": _search_results(hits, limit, fields=fields),
+        "next_cursor": next_cursor,
+        "version": cursor.version,
+    }
+
+
+def _search_quotas(quotas: Optional[Dict[str, int]]) -> Optional[Dict[str, int]]:
+    """Per-``objectType`` result caps keyed like the objectType postings (lower-case)."""
+    if quotas is None:
+        return None
+    clean = {str(key).strip().lower(): max(0, int(value)) for key, value in quotas.items() if str(key).strip()}
+    if not clean or not any(clean.values()):
+        raise HTTPException(status_code=400, detail="quotas needs at least one objectType with a positive count")
+    return clean
+
+
+def _reject_paged_mmr(mmr_lambda: Optional[float]) -> None:
+    if mmr_lambda is not None:
+        raise HTTPException(status_code=400, detail="mmrLambda cannot be combined with paginate, cursor or stream")
+
+
+def _stream_limit(value: Optional[int]) -> int:
+    return _clamp_limit(value, default=SEARCH_STREAM_MAX_RESULTS, max_limit=SEARCH_STREAM_MAX_RESULTS)
+
+
+def _stream_search_cursor(
+    cursor: _SearchCursor, offset: int, limit: int, fields: _ResultFields = _SEARCH_FIELDS
+) -> StreamingResponse:
+    """NDJSON, one result per line, written a growing batch of lines at a time as the ranking advances."""
+
+    def lines():
+        hits = (hit for _, hit in itertools.islice(cursor.hits_from(offset), limit))
+        chunk = 64
+        while True:
+            batch = list(itertools.islice(hits, chunk))
+            if not batch:
+                return
+            yield "".join(
+                json.dumps(result) + "\n" for result in _search_results(batch, len(batch), fields=fields)
+            )
+            chunk = min(chunk * 2, 4096)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+_DEDUPE_SMALL_BUCKET = 64
+
+
+def _dedupe_pairs_blocked(
+    vectors: np.ndarray, threshold: float, block: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Every pair ``i < j`` of unit ``vectors`` with cosine >= ``threshold``.
+
+    The upper triangle is walked in ``block x block`` tiles, so memory stays at
+    one tile of scores however many rows there are.
+    """
+    size = vectors.shape[0]
+    left: List[np.ndarray] = []
+    right: List[np.ndarray] = []
+    scores: List[np.ndarray] = []
+    for start in range(0, size, block):
+        head = vectors[start : start + block]
+        for other in range(start, size, block):
+            tile = head @ vectors[other : other + block].T
+            if other == start:
+                tile = np.triu(tile, k=1)
+            i, j = np.nonzero(tile >= threshold)
+            if i.size:
+                left.append(i + start)
+                right.append(j + other)
+                scores.append(tile[i, j])
+    if not left:
+        return _EMPTY_ROWS, _EMPTY_ROWS, np.zeros(0, dtype=np.float32)
+    return np.concatenate(left), np.concatenate(right), np.concatenate(scores)
+
+
+def _dedupe_pairs_lsh(
+    vectors: np.ndarray, threshold: float, block: int, tables: int, bits: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Pairs above ``threshold`` among rows that share a random-hyperplane LSH bucket.
+
+    Each of ``tables`` hashes is the signs of ``bits`` hyperplanes, so two rows
+    at cosine ``s`` collide in one table with probability ``(1 - acos(s) / pi)
+    ** bits``. Pairs in buckets of up to ``_DEDUPE_SMALL_BUCKET`` rows are listed
+    by offset within the sorted table; bigger buckets go through
+    ``_dedupe_pairs_blocked``. Every candidate is verified with its exact cosine.
+    """
+    size = vectors.shape[0]
+    planes = np.random.default_rng(0).standard_normal((vectors.shape[1], tables * bits)).astype(np.float32)
+    weights = np.left_shift(1, np.arange(bits, dtype=np.int64))
+    codes = np.empty((size, tables), dtype=np.int64)
+    for start in range(0, size, block):
+        signs = (vectors[start : start + block] @ planes > 0).reshape(-1, tables, bits)
+        codes[start : start + block] = signs.astype(np.int64) @ weights
+    keys: List[np.ndarray] = []
+    for table in range(tables):
+        order = np.argsort(codes[:, table], kind="stable")
+        bucket = codes[order, table]
+        bounds = np.flatnonzero(np.diff(bucket)) + 1
+        starts = np.concatenate(([0], bounds))
+        lengths = np.diff(np.concatenate((starts, [size])))
+        small = np.repeat(lengths <= _DEDUPE_SMALL_BUCKET, lengths)
+        for offset in range(1, min(int(lengths.max()), _DEDUPE_SMALL_BUCKET)):
+            same = (bucket[offset:] == bucket[:-offset]) & small[offset:]
+            a, b = order[:-offset][same], order[offset:][same]
+            keys.append(np.minimum(a, b) * size + np.maximum(a, b))
+        large = lengths > _DEDUPE_SMALL_BUCKET
+        for start, length in zip(starts[large].tolist(), lengths[large].tolist()):
+            rows = np.sort(order[start : start + length])
+            i, j, _ = _dedupe_pairs_blocked(vectors[rows], threshold, block)
+            keys.append(rows[i] * size + rows[j])
+    if not keys:
+        return _EMPTY_ROWS, _EMPTY_ROWS, np.zeros(0, dtype=np.float32)
+    candidates = np.unique(np.concatenate(keys))
+    left, right = candidates // size, candidates % size
+    scores = np.empty(candidates.size, dtype=np.float32)
+    for start in range(0, candidates.size, block * 4):
+        a, b = left[start : start + block * 4], right[start : start + block * 4]
+        scores[start : start + block * 4] = np.einsum("ij,ij->i", vectors[a], vectors[b])
+    keep = scores >= threshold
+    return left[keep], right[keep], scores[keep]
+
+
+def _pair_components(left: np.ndarray, right: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """``(nodes, labels)``: the rows appearing in the pairs and the smallest row
+    of each one's connected component, by min-label propagation with pointer jumping."""
+    nodes, ends = np.unique(np.concatenate((left, right)), return_inverse=True)
+    a, b = ends[: left.size], ends[left.size :]
+    labels = np.arange(nodes.size)
+    while True:
+        before = labels.copy()
+        low = np.minimum(labels[a], labels[b])
+        np.minimum.at(labels, a, low)
+        np.minimum.at(labels, b, low)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+        if np.array_equal(labels, before):
+            return nodes, labels
+
+
+def _find_duplicates(
+    *,
+    user_id: str,
+    types: Optional[List[str]],
+    filter_expr: Optional[Dict[str, Any]],
+    threshold: float,
+    method: str = "auto",
+) -> Tuple[List[Dict[str, Any]], int, str]:
+    """Clusters of ``user_id``'s records linked by cosine >= ``threshold``, largest first.
+
+    Each partition is searched on its own: blocked all pairs below
+    ``AI_DEDUPE_LSH_MIN_ROWS`` rows (or with ``method="exact"``), LSH buckets
+    above. Clusters are connected components of the pairs found, so two members
+    may be less similar than ``threshold`` if a third links them. Returns the
+    clusters, the number of records compared and the method used.
+    """
+    _load_vector_store_if_needed()
+    filter_node = _search_filter_node(types, filter_expr)
+    store = _VECTOR_STORE
+    clusters: List[Dict[str, Any]] = []
+    compared = 0
+    used = "exact"
+    for partition in [p for p in _VECTOR_PARTITIONS.values() if p.user_id == user_id]:
+        rows = np.arange(partition.size) if filter_node is None else _filter_partition_rows(partition, filter_node)
+        compared += int(rows.size)
+        if rows.size < 2:
+            continue
+        if partition.codec.lossy:
+            vectors = partition.full_precision(rows)
+        else:
+            vectors = partition.vectors[rows]
+        lsh = method == "lsh" or (method == "auto" and rows.size >= DEDUPE_LSH_MIN_ROWS)
+        if lsh:
+            used = "lsh"
+            left, right, scores = _dedupe_pairs_lsh(
+                vectors, threshold, DEDUPE_BLOCK_ROWS, DEDUPE_LSH_TABLES, DEDUPE_LSH_BITS
+            )
+        else:
+            left, right, scores = _dedupe_pairs_blocked(vectors, threshold, DEDUPE_BLOCK_ROWS)
+        if left.size == 0:
+            continue
+        nodes, labels = _pair_components(left, right)
+        best = np.zeros(nodes.size, dtype=np.float32)
+        np.maximum.at(best, labels[np.searchsorted(nodes, left)], scores)
+        order = np.argsort(labels, kind="stable")
+        bounds = np.flatnonzero(np.diff(labels[order])) + 1
+        for members in np.split(order, bounds):
+            records = [store.get(partition.ids[row]) for row in rows[nodes[members]].tolist()]
+            records = sorted((r for r in records if r is not None), key=lambda r: (r.updatedAtMs, r.id))
+            if len(records) > 1:
+                score = float(best[labels[members[0]]])
+                clusters.append({"ids": [record.id for record in records], "score": score})
+    clusters.sort(key=lambda cluster: (-len(cluster["ids"]), -cluster["score"], cluster["ids"][0]))
+    return clusters, compared, used
+
+
+class _ClusterModel:
+    """A fitted k-means over one user's partition, cached between ``/cluster`` calls.
+
+    ``assign`` and ``scores`` map record ids to their cluster and their cosine to
+    its centroid. Writes add ids to ``dirty``; the next call assigns only those
+    to the existing centroids, and refits (warm-started) once more than
+    ``AI_CLUSTER_REFIT_RATIO`` of the fitted rows changed. ``payload`` holds the
+    clusters with their members ranked by score, reused until something changes;
+    each call takes its exemplars from the head of that ranking.
+    """
+
+    def __init__(self, user_id: str, fingerprint: str):
+        self.user_id = user_id
+        self.fingerprint = fingerprint
+        self.dim = 0
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.assign: Dict[str, int] = {}
+        self.scores: Dict[str, float] = {}
+        self.dirty: Set[str] = set()
+        self.changed = 0
+        self.fitted_rows = 0
+        self.payload: Optional[List[Dict[str, Any]]] = None
+        self.lock = threading.Lock()
+
+    def fit(self, ids: List[str], vectors: np.ndarray, k: int) -> None:
+        rng = np.random.default_rng(len(ids))
+        warm = self.centroids if self.centroids.shape == (k, vectors.shape[1]) else None
+        epochs = 1 if warm is not None else 3
+        steps = max(10, epochs * vectors.shape[0] // CLUSTER_BATCH_ROWS)
+        self.centroids = _minibatch_kmeans(
+            vectors, k, rng, batch=CLUSTER_BATCH_ROWS, steps=steps, centroids=warm
+        )
+        self.dim = vectors.shape[1]
+        self.assign, self.scores = {}, {}
+        self.place(ids, vectors)
+        self.changed = 0
+        self.fitted_rows = len(ids)
+
+    def place(self, ids: List[str], vectors: np.ndarray) -> None:
+        """Assign rows to their nearest existing centroid."""
+        if not ids:
+            return
+        labels = _nearest_centroids(vectors, self.centroids)
+        scores = np.einsum("ij,ij->i", vectors, self.centroids[labels])
+        self.assign.update(zip(ids, labels.tolist()))
+        self.scores.update(zip(ids, scores.tolist()))
+        self.payload = None
+
+    def forget(self, ids: Iterable[str]) -> None:
+        for record_id in ids:
+            if self.assign.pop(record_id, None) is not None:
+                self.scores.pop(record_id, None)
+                self.payload = None
+
+    def clusters(self, exemplars: int) -> List[Dict[str, Any]]:
+        if self.payload is None:
+            self.payload = self._ranked()
+        store = _VECTOR_STORE
+        out: List[Dict[str, Any]] = []
+        for cluster in self.payload:
+            nearest = [store.get(record_id) for record_id in cluster["members"][:exemplars]]
+            nearest = [record for record in nearest if record is not None]
+            out.append(
+                {
+                    "cluster": cluster["cluster"],
+                    "size": cluster["size"],
+                    "cohesion": cluster["cohesion"],
+                    "centroid": cluster["centroid"],
+                    "exemplars": [
+                        _vector_result(record, score=self.scores[record.id]) for record in _with_documents(nearest)
+                    ],
+                    "members": cluster["members"],
+                }
+            )
+        return out
+
+    def _ranked(self) -> List[Dict[str, Any]]:
+        """Clusters, largest first, each with its members best-scoring first."""
+        ids = list(self.assign)
+        labels = np.fromiter((self.assign[record_id] for record_id in ids), dtype=np.int64, count=len(ids))
+        scores = np.fromiter((self.scores[record_id] for record_id in ids), dtype=np.float32, count=len(ids))
+        order = np.lexsort((-scores, labels))
+        bounds = np.flatnonzero(np.diff(labels[order])) + 1
+        payload: List[Dict[str, Any]] = []
+        for members in np.split(order, bounds) if order.size else []:
+            label = int(labels[members[0]])
+            payload.append(
+                {
+                    "cluster": label,
+                    "size": int(members.size),
+                    "cohesion": float(scores[members].mean()),
+                    "centroid": self.centroids[label].tolist(),
+                    "members": [ids[pos] for pos in members.tolist()],
+                }
+            )
+        payload.sort(key=lambda cluster: (-cluster["size"], cluster["cluster"]))
+        return payload
+
+
+_CLUSTER_MODELS: Dict[str, _ClusterModel] = {}
+_CLUSTER_MODELS_LOCK = threading.Lock()
+
+
+def _note_cluster_writes(written: Iterable[Tuple[str, str]]) -> None:
+    """Mark ``(userId, id)`` pairs dirty on that user's cached cluster models."""
+    if not _CLUSTER_MODELS:
+        return
+    by_user: Dict[str, List[str]] = {}
+    for user_id, record_id in written:
+        by_user.setdefault(user_id, []).append(record_id)
+    with _CLUSTER_MODELS_LOCK:
+        for model in _CLUSTER_MODELS.values():
+            ids = by_user.get(model.user_id)
+            if ids:
+                model.dirty.update(ids)
+
+
+def _cluster_k(requested: Optional[int], rows: int) -> int:
+    """``requested`` or ``sqrt(rows / 2)``, within ``[1, AI_CLUSTER_MAX_K]`` and at most ``rows``."""
+    k = requested if requested is not None else int(round(math.sqrt(rows / 2)))
+    return max(1, min(k, CLUSTER_MAX_K, rows))
+
+
+def _cluster_vectors(partition: "_VectorPartition", rows: np.ndarray) -> np.ndarray:
+    if partition.codec.lossy:
+        return partition.full_precision(rows)
+    return partition.vectors[rows]
+
+
+def _cluster_records(
+    *,
+    user_id: str,
+    types: Optional[List[str]],
+    filter_expr: Optional[Dict[str, Any]],
+    k: Optional[int],
+    exemplars: int,
+) -> Tuple[List[Dict[str, Any]], int, str]:
+    """Clusters of ``user_id``'s largest partition, from the cached model when
+    there is one. Returns the clusters, the rows clustered and how the model was
+    brought up to date: ``"fit"``, ``"incremental"`` or ``"cached"``."""
+    _load_vector_store_if_needed()
+    filter_node = _search_filter_node(types, filter_expr)
+    fingerprint = _cursor_fingerprint("cluster", user_id, types, filter_expr, k)
+    with _CLUSTER_MODELS_LOCK:
+        model = _CLUSTER_MODELS.pop(fingerprint, None) or _ClusterModel(user_id, fingerprint)
+        _CLUSTER_MODELS[fingerprint] = model
+        while len(_CLUSTER_MODELS) > CLUSTER_CACHE_SIZE:
+            del _CLUSTER_MODELS[next(iter(_CLUSTER_MODELS))]
+    with model.lock:
+        with _CLUSTER_MODELS_LOCK:
+            dirty, model.dirty = model.dirty, set()
+        partitions = [p for p in _VECTOR_PARTITIONS.values() if p.user_id == user_id and p.size]
+        if not partitions:
+            model.forget(list(model.assign))
+            model.fitted_rows = 0
+            return [], 0, "fit"
+        partition = max(partitions, key=lambda p: (p.size, p.dim))
+        refit = (
+            partition.dim != model.dim
+            or not model.fitted_rows
+            or model.changed + len(dirty) > CLUSTER_REFIT_RATIO * model.fitted_rows
+        )
+        if refit:
+            rows = np.arange(partition.size) if filter_node is None else _filter_partition_rows(partition, filter_node)
+            if rows.size == 0:
+                model.forget(list(model.assign))
+                model.fitted_rows = 0
+                return [], 0, "fit"
+            ids = [partition.ids[row] for row in rows.tolist()]
+            model.fit(ids, _cluster_vectors(partition, rows), _cluster_k(k, rows.size))
+            state = "fit"
+        elif dirty:
+            model.forget(dirty)
+            present = np.sort(np.asarray([partition.rows[i] for i in dirty if i in partition.rows], dtype=np.int64))
+            if filter_node is not None and present.size:
+                present = _filter_partition_rows(partition, filter_node, present)
+            model.place([partition.ids[row] for row in present.tolist()], _cluster_vectors(partition, present))
+            model.changed += len(dirty)
+            state = "incremental"
+        else:
+            state = "cached"
+        return model.clusters(exemplars), len(model.assign), state
+
+
+def _build_synthesis_schema() -> Dict[str, Any]:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "Synthesis",
+            "schema": {
+                "type": "object",
+                "additionalProperties": False,
+                "properties": {
+                    "themes": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "minItems": 3,
+                        "maxItems": 3,
+                    },
+                    "connections": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "minItems": 3,
+                        "maxItems": 3,
+                    },
+                    "questions": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "minItems": 3,
+                        "maxItems": 3,
+                    },
+                },
+                "required": ["themes", "connections", "questions"],
+            },
+        },
+    }
+
+
+async def hf_chat_complete(
+    prompt: str,
     model: str,
     token: str,
     timeout_ms: int,
@@ -1582,6 +5870,23 @@ def debug_secret():
         "expected_fp": _secret_fp(AI_SHARED_SECRET) or "EMPTY"
     }
 
+@app.get("/debug/vector-store")
+def debug_vector_store():
+    snapshot = _VECTOR_PARTITIONS
+    ann_partitions = sum(1 for p in snapshot.values() if p.ann is not None and p.ann.ready)
+    return {
+        "loaded": _VECTOR_STORE_LOADED,
+        "records": len(_VECTOR_STORE),
+        "version": snapshot.version,
+        "partitions": len(snapshot),
+        "ann": {"mode": VECTOR_ANN_INDEX, "indexedPartitions": ann_partitions},
+        "codec": VECTOR_CODEC,
+        "searchCursors": len(_SEARCH_CURSORS),
+        "similarLists": sum(len(p.knn.lists) for p in snapshot.values() if p.knn is not None),
+        "clusterModels": len(_CLUSTER_MODELS),
+        "persistence": _vector_persistence_stats(),
+    }
+
 @app.get("/debug/hf")
 def debug_hf():
     config = get_hf_config()
@@ -1761,22 +6066,32 @@ async def embed_upsert(req: EmbedUpsertRequest):
     texts = [str(item.text or "").strip() for item in req.items]
     if not all(texts):
         raise HTTPException(status_code=400, detail="embedding item text is empty")
+    items, chunk_of = req.items, None
+    if req.chunk:
+        if any(item.subId for item in req.items):
+            raise HTTPException(status_code=400, detail="subId is set per chunk; omit it with chunk")
+        items, chunk_of = _chunk_upsert_items(req.items)
+        texts = [str(item.text or "").strip() for item in items]
     config = get_hf_config()
-    embeddings = await _hf_embed_texts(texts, config=config)
-    upserted = _upsert_vector_records(req.items, embeddings)
+    embeddings = await _hf_embed_batches(texts, config=config)
+    records = _upsert_vector_records(items, embeddings, chunk_of)
     vector_dim = len(embeddings[0]) if embeddings else 0
-    return {
-        "upserted": upserted,
+    response = {
+        "upserted": len(req.items),
         "vector_dim": vector_dim,
         "model": config["embedding_model"],
     }
+    if req.chunk:
+        response["records"] = records
+    return response
 
 
 @app.post("/embed/get", dependencies=[Depends(require_shared_secret)])
 async def embed_get(req: EmbedGetRequest):
+    fields = _ResultFields.parse(req.fields, req.snippet, _GET_FIELDS)
     if not req.ids:
         return {"results": []}
-    return {"results": _get_vector_records(req.ids)}
+    return {"results": _get_vector_records(req.ids, fields)}
 
 
 @app.post("/embed/delete", dependencies=[Depends(require_shared_secret)])
@@ -1793,40 +6108,272 @@ async def search(req: SearchRequest):
     if not query:
         raise HTTPException(status_code=400, detail="query is required")
     safe_limit = _clamp_limit(req.limit, default=12, max_limit=50)
+    _compile_vector_filter(req.filter)
+    min_score = float(req.minScore or 0.0)
+    quotas = _search_quotas(req.quotas)
+    fields = _ResultFields.parse(req.fields, req.snippet, _SEARCH_FIELDS)
+    if req.collapse or req.chunkScore or quotas is not None:
+        if req.mode != "vector" or req.paginate or req.cursor or req.stream or req.mmrLambda is not None:
+            raise HTTPException(
+                status_code=400,
+                detail=(
+                    "collapse, chunkScore and quotas need mode vector, "
+                    "without paginate, cursor, stream or mmrLambda"
+                ),
+            )
+        if quotas is not None:
+            safe_limit = min(safe_limit if req.limit is not None else 50, sum(quotas.values()))
+    if req.mode != "vector":
+        if req.paginate or req.cursor or req.stream or req.mmrLambda is not None:
+            raise HTTPException(
+                status_code=400,
+                detail=f"{req.mode} search does not support paginate, cursor, stream or mmrLambda",
+            )
+        lexical = await asyncio.to_thread(
+            _search_lexical,
+            query,
+            user_id=req.userId,
+            types=req.types,
+            limit=safe_limit if req.mode == "lexical" else max(safe_limit, SEARCH_HYBRID_FETCH),
+            filter_expr=req.filter,
+            min_score=min_score if req.mode == "lexical" else 0.0,
+            fields=fields,
+        )
+        if req.mode == "lexical":
+            return {"results": lexical}
+        query_vector = (await _hf_embed_texts([query], config=get_hf_config()))[0]
+        semantic = _search_vectors(
+            query_vector,
+            user_id=req.userId,
+            types=req.types,
+            limit=max(safe_limit, SEARCH_HYBRID_FETCH),
+            filter_expr=req.filter,
+            min_score=min_score,
+            fields=fields,
+        )
+        return {"results": _rrf_fuse([semantic, lexical], safe_limit, k=SEARCH_RRF_K)}
+    if req.paginate or req.cursor or req.stream:
+        _reject_paged_mmr(req.mmrLambda)
+        fingerprint = _cursor_fingerprint("search", req.userId, query, req.types, req.filter, min_score)
+        cursor, offset, after = _lookup_search_cursor(req.cursor, fingerprint)
+        if cursor is None:
+            query_vector = (await _hf_embed_texts([query], config=get_hf_config()))[0]
+            cursor = _open_search_cursor(
+                [query_vector],
+                user_id=req.userId,
+                types=req.types,
+                filter_expr=req.filter,
+                fingerprint=fingerprint,
+                after=after,
+                min_score=min_score,
+            )
+        if req.stream:
+            return _stream_search_cursor(cursor, offset, _stream_limit(req.limit), fields)
+        return _search_cursor_page(cursor, offset, safe_limit, fields)
     query_vector = (await _hf_embed_texts([query], config=get_hf_config()))[0]
     results = _search_vectors(
         query_vector,
         user_id=req.userId,
         types=req.types,
         limit=safe_limit,
+        filter_expr=req.filter,
+        min_score=min_score,
+        mmr_lambda=req.mmrLambda,
+        collapse=req.collapse,
+        quotas=quotas,
+        chunk_score=req.chunkScore,
+        fields=fields,
     )
     return {"results": results}
 
 
+@app.post("/search/batch", dependencies=[Depends(require_shared_secret)])
+async def search_batch(req: SearchBatchRequest):
+    queries = list(dict.fromkeys(q for q in (str(q or "").strip() for q in req.queries) if q))
+    if not queries:
+        raise HTTPException(status_code=400, detail="queries are required")
+    if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+        raise HTTPException(
+            status_code=400, detail=f"at most {SEARCH_BATCH_MAX_QUERIES} queries per batch"
+        )
+    safe_limit = _clamp_limit(req.limit, default=12, max_limit=50)
+    _compile_vector_filter(req.filter)
+    query_vectors = await _hf_embed_texts(queries, config=get_hf_config())
+    per_query = _search_vectors_batch(
+        query_vectors,
+        user_id=req.userId,
+        types=req.types,
+        limit=safe_limit,
+        filter_expr=req.filter,
+        min_score=float(req.minScore or 0.0),
+    )
+    response: Dict[str, Any] = {
+        "queries": [{"query": query, "results": results} for query, results in zip(queries, per_query)]
+    }
+    if req.fuse:
+        response["fused"] = _rrf_fuse(per_query, safe_limit, k=SEARCH_RRF_K)
+    return response
+
+
+def _similar_sources(source_ids: Tuple[str, ...], user_id: str) -> Tuple[List[str], List[np.ndarray]]:
+    """Embeddings of the sources ``user_id`` may use: their own records, or records
+    stored without a userId. Sources of another dimension than the first are skipped."""
+    _load_vector_store_if_needed()
+    store = _VECTOR_STORE
+    found: List[str] = []
+    vectors: List[np.ndarray] = []
+    for source_id in source_ids:
+        record = store.get(source_id)
+        if record is None or (record.userId and record.userId != user_id):
+            continue
+        if record.embedding.size == 0 or (vectors and record.embedding.size != vectors[0].size):
+            continue
+        found.append(source_id)
+        vectors.append(record.embedding)
+    return found, vectors
+
+
+def _similar_neighbors(
+    source_id: str, user_id: str, limit: int, min_score: float, fields: _ResultFields = _SEARCH_FIELDS
+) -> Optional[List[Dict[str, Any]]]:
+    """Unfiltered ``/similar`` for one source, read from its partition's neighbour
+    graph. ``None`` when the graph cannot answer and the caller should scan.
+
+    A miss scans the published partition exactly, past any ANN index, and the
+    list is cached on a draft only if no write has published a newer version
+    since, so every cached list is exact for the version holding it.
+    """
+    record = _VECTOR_STORE.get(source_id)
+    if not SIMILAR_GRAPH_K or limit > SIMILAR_GRAPH_K or record is None:
+        return None
+    key = (user_id, int(record.embedding.size))
+    partition = _VECTOR_PARTITIONS.get(key)
+    if partition is None or source_id not in partition.rows or partition.codec.lossy:
+        return None
+    hits = partition.knn.neighbors(source_id, limit) if partition.knn is not None else None
+    if hits is None:
+        k = partition.knn.k if partition.knn is not None else SIMILAR_GRAPH_K
+        row = partition.rows[source_id]
+        scanned = partition.search(partition.row_vectors(row), k, exclude=(source_id,), exact=True)
+        with _vector_write():
+            if _VECTOR_PARTITIONS.get(key) is partition:
+                draft = _draft_partition(key)
+                if draft.knn is None:
+                    draft.knn = _NeighborGraph(k, draft.vectors.shape[0])
+                draft.knn.fill(draft, source_id, scanned)
+        hits = scanned[:limit]
+    if min_score > 0:
+        hits = [hit for hit in hits if hit[0] >= min_score]
+    return _search_results(hits, limit, fields=fields)
+
+
 @app.post("/similar", dependencies=[Depends(require_shared_secret)])
 async def similar(req: SimilarRequest):
-    source_id = str(req.sourceId or "").strip()
+    source_ids = _exclude_ids(req.sourceId, tuple(req.sourceIds))
     user_id = str(req.userId or "").strip()
-    if not source_id or not user_id:
-        raise HTTPException(status_code=400, detail="userId and sourceId are required")
-    source_records = _get_vector_records([source_id])
-    if not source_records:
-        return {"results": [], "source_found": False}
-    source = source_records[0]
-    if str(source.get("userId") or "") and str(source.get("userId")) != user_id:
-        return {"results": [], "source_found": False}
-    query_vector = _safe_float_vector(source.get("embedding")) or []
-    if not query_vector:
-        return {"results": [], "source_found": False}
+    if not source_ids or not user_id:
+        raise HTTPException(status_code=400, detail="userId and sourceId or sourceIds are required")
+    if len(source_ids) > SIMILAR_MAX_SOURCES:
+        raise HTTPException(status_code=400, detail=f"at most {SIMILAR_MAX_SOURCES} sourceIds")
+    _compile_vector_filter(req.filter)
+    fields = _ResultFields.parse(req.fields, req.snippet, _SEARCH_FIELDS)
+    found, vectors = _similar_sources(source_ids, user_id)
+    if not found:
+        return {"results": [], "source_found": False, "sources_found": []}
     safe_limit = _clamp_limit(req.limit, default=12, max_limit=50)
-    results = _search_vectors(
-        query_vector,
+    min_score = float(req.minScore or 0.0)
+    if req.paginate or req.cursor or req.stream:
+        _reject_paged_mmr(req.mmrLambda)
+        fingerprint = _cursor_fingerprint(
+            "similar", user_id, source_ids, req.mode, req.types, req.filter, min_score
+        )
+        cursor, offset, after = _lookup_search_cursor(req.cursor, fingerprint)
+        if cursor is None:
+            cursor = _open_search_cursor(
+                vectors if req.mode == "union" else [np.mean([_unit_vector(v) for v in vectors], axis=0)],
+                user_id=user_id,
+                types=req.types,
+                filter_expr=req.filter,
+                fingerprint=fingerprint,
+                exclude_ids=source_ids,
+                after=after,
+                min_score=min_score,
+            )
+        if req.stream:
+            return _stream_search_cursor(cursor, offset, _stream_limit(req.limit), fields)
+        page = _search_cursor_page(cursor, offset, safe_limit, fields)
+        return {**page, "source_found": True, "sources_found": found}
+    if len(found) == 1 and req.mmrLambda is None and _search_filter_node(req.types, req.filter) is None:
+        results = _similar_neighbors(found[0], user_id, safe_limit, min_score, fields)
+        if results is not None:
+            return {"results": results, "source_found": True, "sources_found": found}
+    if req.mode == "union" and len(vectors) > 1:
+        results = _search_vectors_union(
+            vectors,
+            user_id=user_id,
+            types=req.types,
+            limit=safe_limit,
+            filter_expr=req.filter,
+            exclude_ids=source_ids,
+            min_score=min_score,
+            mmr_lambda=req.mmrLambda,
+            fields=fields,
+        )
+    else:
+        centroid = np.mean([_unit_vector(vector) for vector in vectors], axis=0)
+        results = _search_vectors(
+            centroid,
+            user_id=user_id,
+            types=req.types,
+            limit=safe_limit,
+            filter_expr=req.filter,
+            exclude_ids=source_ids,
+            min_score=min_score,
+            mmr_lambda=req.mmrLambda,
+            fields=fields,
+        )
+    return {"results": results, "source_found": True, "sources_found": found}
+
+
+@app.post("/dedupe", dependencies=[Depends(require_shared_secret)])
+async def dedupe(req: DedupeRequest):
+    user_id = str(req.userId or "").strip()
+    if not user_id:
+        raise HTTPException(status_code=400, detail="userId is required")
+    _compile_vector_filter(req.filter)
+    clusters, compared, method = await asyncio.to_thread(
+        _find_duplicates,
         user_id=user_id,
         types=req.types,
-        limit=safe_limit,
-        exclude_id=source_id,
+        filter_expr=req.filter,
+        threshold=req.threshold,
+        method=req.method,
     )
-    return {"results": results, "source_found": True}
+    safe_limit = _clamp_limit(req.limit, default=50, max_limit=1000)
+    return {"clusters": clusters[:safe_limit], "total": len(clusters), "records": compared, "method": method}
+
+
+@app.post("/cluster", dependencies=[Depends(require_shared_secret)])
+async def cluster(req: ClusterRequest):
+    user_id = str(req.userId or "").strip()
+    if not user_id:
+        raise HTTPException(status_code=400, detail="userId is required")
+    _compile_vector_filter(req.filter)
+    clusters, records, state = await asyncio.to_thread(
+        _cluster_records,
+        user_id=user_id,
+        types=req.types,
+        filter_expr=req.filter,
+        k=req.k,
+        exemplars=req.exemplars,
+    )
+    max_members = _clamp_limit(req.maxMembers, default=100, max_limit=1000)
+    return {
+        "clusters": [{**c, "members": c["members"][:max_members]} for c in clusters],
+        "k": len(clusters),
+        "records": records,
+        "model": state,
+    }
 
 
 @app.post("/synthesize", dependencies=[Depends(require_shared_secret)])
@@ -0,0 +1,345 @@
+import os
+import unittest
+
+import numpy as np
+
+from ai_service import main
+from ai_service.tests.test_vector_search import VectorStoreTestCase, _item
+
+
+def _clustered(count, dim=24, seed=3):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((12, dim))
+    return centres[rng.integers(0, 12, size=count)] + 0.4 * rng.standard_normal((count, dim))
+
+
+class AnnIndexTestCase(VectorStoreTestCase):
+    mode = "hnsw"
+
+    def setUp(self):
+        self._saved = {name: getattr(main, name) for name in ("VECTOR_ANN_INDEX", "VECTOR_ANN_MIN_ROWS")}
+        main.VECTOR_ANN_INDEX = self.mode
+        main.VECTOR_ANN_MIN_ROWS = 50
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        for name, value in self._saved.items():
+            setattr(main, name, value)
+
+    def _reload_store(self):
+        super()._reload_store()
+        main._join_vector_builds()
+
+    def _upsert(self, vectors, prefix="r", **kwargs):
+        ids = [f"{prefix}{i}" for i in range(len(vectors))]
+        main._upsert_vector_records([_item(i, **kwargs) for i in ids], [v.tolist() for v in vectors])
+        main._join_vector_builds()
+        return ids
+
+    def _exact(self, query, k, **kwargs):
+        partition = main._VECTOR_PARTITIONS[("u1", len(query))]
+        ann, partition.ann = partition.ann, None
+        try:
+            return [r["id"] for r in main._search_vectors(query, user_id="u1", types=None, limit=k, **kwargs)]
+        finally:
+            partition.ann = ann
+
+    def _recall(self, queries, k=10, **kwargs):
+        hits = total = 0
+        for query in queries:
+            truth = self._exact(query, k, **kwargs)
+            found = [
+                r["id"] for r in main._search_vectors(query, user_id="u1", types=None, limit=k, **kwargs)
+            ]
+            hits += len(set(truth) & set(found))
+            total += len(truth)
+        return hits / total
+
+
+class TestHnswIndex(AnnIndexTestCase):
+    def _assert_consistent(self, partition):
+        ann = partition.ann
+        self.assertEqual(len(ann.row_node), partition.size)
+        for row, node in enumerate(ann.row_node):
+            self.assertEqual(ann.node_row[node], row)
+        self.assertEqual(ann.live, partition.size)
+
+    def test_small_partitions_stay_exact(self):
+        self._upsert(_clustered(20))
+
+        self.assertIsNone(main._VECTOR_PARTITIONS[("u1", 24)].ann)
+
+    def test_recall_against_exact_scan(self):
+        vectors = _clustered(600)
+        self._upsert(vectors[:500])
+
+        self.assertTrue(main._VECTOR_PARTITIONS[("u1", 24)].ann.ready)
+        self.assertGreaterEqual(self._recall(vectors[500:]), 0.95)
+
+    def test_searches_scan_exactly_until_the_build_lands(self):
+        vectors = _clustered(200)
+        original = main._HNSWIndex.start_build
+        main._HNSWIndex.start_build = lambda index: None
+        try:
+            self._upsert(vectors)
+        finally:
+            main._HNSWIndex.start_build = original
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        self.assertFalse(partition.ann.ready)
+        self.assertEqual(self._recall(vectors[:20]), 1.0)
+        self.assertFalse(os.path.exists(main._vector_ann_path()))
+
+    def test_writes_during_the_build_are_caught_up(self):
+        vectors = _clustered(300)
+        moved = -vectors[1]
+        original = main._HNSWIndex.build
+
+        def build_with_writes(index):
+            if not index.partition.ann.ready:
+                main._delete_vector_records([f"r{i}" for i in range(0, 300, 3)])
+                main._upsert_vector_records([_item("r1")], [moved.tolist()])
+                main._upsert_vector_records(
+                    [_item(f"late{i}") for i in range(20)], [v.tolist() for v in _clustered(20, seed=7)]
+                )
+            original(index)
+
+        main._HNSWIndex.build = build_with_writes
+        try:
+            self._upsert(vectors)
+        finally:
+            main._HNSWIndex.build = original
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        self.assertTrue(partition.ann.ready)
+        self.assertEqual(partition.size, 220)
+        self._assert_consistent(partition)
+        results = main._search_vectors(moved.tolist(), user_id="u1", types=None, limit=5)
+        self.assertEqual(results[0]["id"], "r1")
+        self.assertGreaterEqual(self._recall(vectors[1:60:3]), 0.9)
+
+    def test_deletes_and_updates_keep_graph_consistent(self):
+        vectors = _clustered(300)
+        ids = self._upsert(vectors)
+        main._delete_vector_records(ids[::2])
+        moved = -vectors[1]
+        main._upsert_vector_records([_item(ids[1])], [moved.tolist()])
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        self._assert_consistent(partition)
+        results = main._search_vectors(moved.tolist(), user_id="u1", types=None, limit=5)
+        self.assertEqual(results[0]["id"], ids[1])
+        self.assertFalse(set(ids[::2]) & {r["id"] for r in results})
+        self.assertGreaterEqual(self._recall(vectors[1:40:2]), 0.9)
+
+    def test_updates_relink_the_row_in_place(self):
+        vectors = _clustered(300)
+        ids = self._upsert(vectors)
+        row = main._VECTOR_PARTITIONS[("u1", 24)].rows[ids[5]]
+        original = main._HNSWIndex.replace
+        replaced = []
+        main._HNSWIndex.replace = lambda index, row: (replaced.append(row), original(index, row))[1]
+        try:
+            moved = -vectors[5]
+            main._upsert_vector_records([_item(ids[5])], [moved.tolist()])
+        finally:
+            main._HNSWIndex.replace = original
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        self.assertEqual(replaced, [row])
+        self.assertEqual(partition.rows[ids[5]], row)
+        self._assert_consistent(partition)
+        results = main._search_vectors(moved.tolist(), user_id="u1", types=None, limit=5)
+        self.assertEqual(results[0]["id"], ids[5])
+        self.assertGreaterEqual(self._recall(vectors[10:40]), 0.9)
+
+    def test_filtered_traversal_returns_only_allowed_rows(self):
+        vectors = _clustered(400)
+        ids = [f"r{i}" for i in range(400)]
+        main._upsert_vector_records(
+            [_item(i, object_type="article" if n % 3 == 0 else "highlight") for n, i in enumerate(ids)],
+            [v.tolist() for v in vectors],
+        )
+        articles = {i for n, i in enumerate(ids) if n % 3 == 0}
+
+        results = main._search_vectors(vectors[0].tolist(), user_id="u1", types=["article"], limit=10)
+
+        self.assertEqual(len(results), 10)
+        self.assertTrue({r["id"] for r in results} <= articles)
+        self.assertGreaterEqual(
+            self._recall(vectors[:30], filter_expr={"objectType": "article"}), 0.9
+        )
+
+    def test_published_graph_is_untouched_by_later_writes(self):
+        vectors = _clustered(300)
+        ids = self._upsert(vectors)
+        old = main._VECTOR_PARTITIONS[("u1", 24)]
+        links = [[list(neighbors) for neighbors in node] for node in old.ann.links]
+
+        main._delete_vector_records(ids[::2])
+        self._upsert(_clustered(50, seed=5), prefix="late")
+
+        self.assertEqual([[list(neighbors) for neighbors in node] for node in old.ann.links], links)
+        self._assert_consistent(old)
+        self._assert_consistent(main._VECTOR_PARTITIONS[("u1", 24)])
+
+    def test_graph_is_persisted_and_caught_up_on_boot(self):
+        vectors = _clustered(300)
+        ids = self._upsert(vectors[:250])
+        main._persist_vector_store()
+        main._delete_vector_records(ids[:10])
+        self._upsert(vectors[250:], prefix="late")
+
+        self.assertTrue(os.path.exists(main._vector_ann_path()))
+        original = main._HNSWIndex.add
+        added = []
+        main._HNSWIndex.add = lambda index, row: (added.append(row), original(index, row))[1]
+        try:
+            self._reload_store()
+        finally:
+            main._HNSWIndex.add = original
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        self.assertEqual(len(added), 50)
+        self._assert_consistent(partition)
+        self.assertGreaterEqual(self._recall(vectors[250:]), 0.9)
+
+
+class TestIvfIndex(AnnIndexTestCase):
+    mode = "ivf"
+
+    def setUp(self):
+        super().setUp()
+        self._saved.update(
+            {name: getattr(main, name) for name in ("VECTOR_IVF_NPROBE", "VECTOR_IVF_REBALANCE_RATIO")}
+        )
+        main.VECTOR_IVF_NPROBE = 4
+
+    def _assert_consistent(self, partition):
+        ann = partition.ann
+        self.assertEqual(len(ann.row_list), partition.size)
+        self.assertEqual(sum(len(rows) for rows in ann.lists), partition.size)
+        for row, list_id in enumerate(ann.row_list):
+            self.assertIn(row, ann.lists[list_id])
+
+    def test_recall_against_exact_scan(self):
+        vectors = _clustered(600)
+        self._upsert(vectors[:500])
+        main.VECTOR_IVF_NPROBE = 8
+
+        ann = main._VECTOR_PARTITIONS[("u1", 24)].ann
+        self.assertEqual(ann.kind, "ivf")
+        self.assertTrue(ann.ready)
+        self.assertGreaterEqual(self._recall(vectors[500:]), 0.9)
+
+    def test_first_training_runs_in_the_background(self):
+        vectors = _clustered(300)
+        original = main._IVFIndex.start_retrain
+        main._IVFIndex.start_retrain = lambda index: None
+        try:
+            ids = self._upsert(vectors)
+        finally:
+            main._IVFIndex.start_retrain = original
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        self.assertFalse(partition.ann.ready)
+        self.assertEqual(self._recall(vectors[:20]), 1.0)
+
+        original = main._IVFIndex._train
+
+        def train_with_writes(index, block):
+            main._delete_vector_records(ids[::3])
+            return original(index, block)
+
+        main._IVFIndex._train = train_with_writes
+        try:
+            partition.ann.start_build()
+            main._join_vector_builds()
+        finally:
+            main._IVFIndex._train = original
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        self.assertTrue(partition.ann.ready)
+        self.assertEqual(partition.size, 200)
+        self._assert_consistent(partition)
+
+    def test_probe_count_bounds_scanned_rows(self):
+        vectors = _clustered(400)
+        self._upsert(vectors)
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        query = main._unit_vector(vectors[0])
+
+        narrow = partition.ann.candidates(query, 10)
+        main.VECTOR_IVF_NPROBE = len(partition.ann.lists)
+        everything = partition.ann.candidates(query, 10)
+
+        self.assertLess(narrow.size, partition.size)
+        self.assertEqual(everything.tolist(), list(range(partition.size)))
+
+    def test_deletes_and_updates_keep_lists_consistent(self):
+        vectors = _clustered(300)
+        ids = self._upsert(vectors)
+        main._delete_vector_records(ids[::3])
+        moved = -vectors[1]
+        main._upsert_vector_records([_item(ids[1])], [moved.tolist()])
+
+        self._assert_consistent(main._VECTOR_PARTITIONS[("u1", 24)])
+        results = main._search_vectors(moved.tolist(), user_id="u1", types=None, limit=3)
+        self.assertEqual(results[0]["id"], ids[1])
+
+    def test_updates_refile_the_row_in_place(self):
+        vectors = _clustered(300)
+        ids = self._upsert(vectors)
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        row = partition.rows[ids[5]]
+        moved = -vectors[5]
+        target = int(np.argmax(partition.ann.centroids @ main._unit_vector(moved)))
+        self.assertNotEqual(partition.ann.row_list[row], target)
+
+        main._upsert_vector_records([_item(ids[5])], [moved.tolist()])
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        self.assertEqual(partition.size, 300)
+        self.assertEqual(partition.rows[ids[5]], row)
+        self.assertEqual(partition.ann.row_list[row], target)
+        self._assert_consistent(partition)
+        results = main._search_vectors(moved.tolist(), user_id="u1", types=None, limit=3)
+        self.assertEqual(results[0]["id"], ids[5])
+
+    def test_imbalance_triggers_background_retrain(self):
+        vectors = _clustered(200)
+        self._upsert(vectors)
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        ann = partition.ann
+        centroids = ann.centroids
+        main.VECTOR_IVF_REBALANCE_RATIO = 1.0
+
+        crowd = np.tile(vectors[0], (ann._CHECK_EVERY, 1)) + 0.01 * _clustered(ann._CHECK_EVERY, seed=9)
+        self._upsert(crowd, prefix="crowd")
+        main._VECTOR_PARTITIONS[("u1", 24)].ann.retrain_thread.join(timeout=10)
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        ann = partition.ann
+        self.assertIsNot(ann.centroids, centroids)
+        self.assertEqual(ann.trained_rows, partition.size)
+        self._assert_consistent(partition)
+
+    def test_lists_are_persisted_and_refiled_on_boot(self):
+        vectors = _clustered(300)
+        ids = self._upsert(vectors[:250])
+        main._persist_vector_store()
+        centroids = main._VECTOR_PARTITIONS[("u1", 24)].ann.centroids.copy()
+        main._delete_vector_records(ids[:10])
+        self._upsert(vectors[250:], prefix="late")
+
+        self._reload_store()
+
+        partition = main._VECTOR_PARTITIONS[("u1", 24)]
+        self.assertTrue(np.array_equal(partition.ann.centroids, centroids))
+        self._assert_consistent(partition)
+        self.assertGreaterEqual(self._recall(vectors[250:]), 0.9)
+
+
+if __name__ == "__main__":
+    unittest.main()
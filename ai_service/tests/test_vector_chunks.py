@@ -0,0 +1,238 @@
+import unittest
+import zlib
+
+import numpy as np
+
+from ai_service import main
+from ai_service.tests.test_vector_search import AsyncVectorStoreTestCase, _item
+
+
+def _words(count, prefix="w"):
+    return " ".join(f"{prefix}{i}" for i in range(count))
+
+
+class TestChunkText(unittest.TestCase):
+    def test_windows_overlap_and_cover_the_text(self):
+        text = _words(24)
+
+        chunks = main._chunk_text(text, 10, 3)
+
+        self.assertEqual([c.split()[0] for c in chunks], ["w0", "w7", "w14"])
+        self.assertEqual(chunks[-1].split()[-1], "w23")
+        self.assertTrue(all(len(c.split()) <= 10 for c in chunks))
+        self.assertEqual(chunks[0].split()[-3:], chunks[1].split()[:3])
+
+    def test_short_text_and_original_spacing_are_kept(self):
+        self.assertEqual(main._chunk_text("a  b\nc", 10, 3), ["a  b\nc"])
+        self.assertEqual(main._chunk_text("a  b\nc d", 3, 1), ["a  b\nc", "c d"])
+
+
+class TestTopGroups(unittest.TestCase):
+    def _reference(self, scores, codes, limit, top):
+        groups = {}
+        for pos, (score, code) in enumerate(zip(scores.tolist(), codes.tolist())):
+            groups.setdefault(code, []).append((score, pos))
+        ranked = []
+        for members in groups.values():
+            members.sort(key=lambda member: (-member[0], member[1]))
+            best = members[:top]
+            ranked.append((sum(score for score, _ in best) / len(best), best[0][1], len(members)))
+        ranked.sort(key=lambda group: -group[0])
+        return ranked[:limit]
+
+    def test_matches_a_full_grouping(self):
+        rng = np.random.default_rng(3)
+        for top in (1, 2, 3):
+            for limit in (1, 5, 40):
+                with self.subTest(top=top, limit=limit):
+                    scores = rng.random(2000).astype(np.float32)
+                    codes = rng.integers(0, 300, size=2000)
+
+                    best, sizes, values = main._top_k_groups(scores, codes, limit, top)
+
+                    expected = self._reference(scores, codes, limit, top)
+                    self.assertEqual(best.tolist(), [pos for _, pos, _ in expected])
+                    self.assertEqual(sizes.tolist(), [size for _, _, size in expected])
+                    self.assertTrue(np.allclose(values, [value for value, _, _ in expected]))
+
+
+class ChunkStoreTestCase(AsyncVectorStoreTestCase):
+    def setUp(self):
+        names = ("EMBED_BATCH_SIZE", "EMBED_CHUNK_WORDS", "EMBED_CHUNK_OVERLAP", "_hf_embed_texts")
+        self._saved = {name: getattr(main, name) for name in names}
+        main.EMBED_BATCH_SIZE = 4
+        main.EMBED_CHUNK_WORDS = 10
+        main.EMBED_CHUNK_OVERLAP = 2
+        self.batches = []
+
+        async def fake_embed(texts, config=None):
+            self.batches.append(len(texts))
+            return [np.random.default_rng(zlib.crc32(text.encode())).standard_normal(8).tolist() for text in texts]
+
+        main._hf_embed_texts = fake_embed
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        for name, value in self._saved.items():
+            setattr(main, name, value)
+
+    async def _upsert(self, *items, chunk=True):
+        return await main.embed_upsert(main.EmbedUpsertRequest(items=list(items), chunk=chunk))
+
+    def _stored(self, prefix):
+        return sorted(key for key in main._VECTOR_STORE if key == prefix or key.startswith(prefix + "#"))
+
+
+class TestChunkedUpsert(ChunkStoreTestCase):
+    async def test_long_text_is_stored_as_subid_children(self):
+        response = await self._upsert(
+            _item("a1", text=_words(30)), _item("n1", text="short note", object_type="note")
+        )
+
+        self.assertEqual((response["upserted"], response["records"]), (2, 5))
+        self.assertEqual(self.batches, [4, 1])
+        self.assertEqual(self._stored("a1"), [f"a1#chunk-{n}" for n in range(4)])
+        chunk = main._VECTOR_STORE["a1#chunk-1"]
+        self.assertEqual((chunk.objectId, chunk.subId, chunk.text.split()[0]), ("obj-a1", "1", "w8"))
+        self.assertIn("n1", main._VECTOR_STORE)
+
+    async def test_upserts_replace_every_chunk_of_an_id(self):
+        await self._upsert(_item("a1", text=_words(30)))
+
+        await self._upsert(_item("a1", text=_words(15)))
+        self.assertEqual(self._stored("a1"), ["a1#chunk-0", "a1#chunk-1"])
+
+        await self._upsert(_item("a1", text="now short"))
+        self.assertEqual(self._stored("a1"), ["a1"])
+
+        await self._upsert(_item("a1", text=_words(20)))
+        self.assertEqual(self._stored("a1"), ["a1#chunk-0", "a1#chunk-1", "a1#chunk-2"])
+        self.assertEqual(len(main._VECTOR_PARTITIONS[("u1", 8)].rows), 3)
+
+    async def test_delete_cascades_to_chunks_after_reload(self):
+        await self._upsert(_item("a1", text=_words(30)), _item("a2", text=_words(30)))
+        main._persist_vector_store()
+        self._reset_store()
+
+        response = await main.embed_delete(main.EmbedDeleteRequest(ids=["a1", "missing"]))
+
+        self.assertEqual(response["deleted"], 4)
+        self.assertEqual(self._stored("a1"), [])
+        self.assertEqual(len(self._stored("a2")), 4)
+
+    async def test_families_are_replayed_from_the_wal(self):
+        await self._upsert(_item("a1", text=_words(30)))
+        self._reset_store()
+
+        await self._upsert(_item("a1", text="now short"))
+
+        self.assertEqual(self._stored("a1"), ["a1"])
+
+    async def test_plain_ids_shaped_like_chunks_do_not_cascade(self):
+        await self._upsert(_item("a1", text=_words(30)), _item("b", text="plain b"))
+
+        await self._upsert(_item("a1#chunk-1", text="plain"), _item("b#chunk-0", text="plain"), chunk=False)
+
+        self.assertEqual(self._stored("a1"), [f"a1#chunk-{n}" for n in range(4)])
+        self.assertEqual(main._VECTOR_STORE["a1#chunk-1"].text, "plain")
+        self.assertEqual(self._stored("b"), ["b", "b#chunk-0"])
+        response = await main.embed_delete(main.EmbedDeleteRequest(ids=["a1"]))
+        self.assertEqual(response["deleted"], 3)
+        self.assertEqual(self._stored("a1"), ["a1#chunk-1"])
+
+    async def test_deleting_one_chunk_keeps_the_rest_under_the_parent(self):
+        await self._upsert(_item("a1", text=_words(30)))
+
+        await main.embed_delete(main.EmbedDeleteRequest(ids=["a1#chunk-1"]))
+        self.assertEqual(self._stored("a1"), ["a1#chunk-0", "a1#chunk-2", "a1#chunk-3"])
+
+        response = await main.embed_delete(main.EmbedDeleteRequest(ids=["a1"]))
+        self.assertEqual(response["deleted"], 3)
+        self.assertEqual(self._stored("a1"), [])
+
+    async def test_sub_id_is_rejected_with_chunk(self):
+        item = _item("a1", text=_words(30))
+        item.subId = "p2"
+
+        with self.assertRaises(main.HTTPException) as ctx:
+            await self._upsert(item)
+
+        self.assertEqual(ctx.exception.status_code, 400)
+        self.assertEqual(self._stored("a1"), [])
+        response = await self._upsert(item, chunk=False)
+        self.assertEqual(response["upserted"], 1)
+        self.assertEqual(main._VECTOR_STORE["a1"].subId, "p2")
+
+
+class TestChunkScoring(ChunkStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        query = np.eye(8)[0]
+        self.query = query.tolist()
+
+        def near(score):
+            return (score * query + np.sqrt(1 - score**2) * np.eye(8)[1]).tolist()
+
+        # "peak" has one very close chunk, "steady" several fairly close ones.
+        chunks = {"peak": [0.95, 0.1, 0.1, 0.1], "steady": [0.8, 0.78, 0.76, 0.2], "other": [0.5]}
+        items, vectors, chunk_of = [], [], []
+        for parent, scores in chunks.items():
+            ids = [parent] if len(scores) == 1 else [f"{parent}#chunk-{n}" for n in range(len(scores))]
+            for n, (record_id, score) in enumerate(zip(ids, scores)):
+                items.append(_item(record_id, text=f"{parent} {n}"))
+                items[-1].objectId = parent
+                items[-1].subId = "" if len(scores) == 1 else str(n)
+                vectors.append(near(score))
+                chunk_of.append(None if len(scores) == 1 else parent)
+        main._upsert_vector_records(items, vectors, chunk_of)
+
+    async def _search(self, **kwargs):
+        main._hf_embed_texts = _fixed(self.query)
+        return (await main.search(main.SearchRequest(userId="u1", query="q", **kwargs)))["results"]
+
+    async def test_max_scores_the_best_chunk(self):
+        results = await self._search(chunkScore="max")
+
+        self.assertEqual([r["id"] for r in results], ["peak", "steady", "other"])
+        self.assertEqual([r["hits"] for r in results], [4, 4, 1])
+        self.assertEqual((results[0]["subId"], results[0]["document"]), ("0", "peak 0"))
+        self.assertAlmostEqual(results[0]["score"], 0.95, places=5)
+
+    async def test_mean_of_top_chunks_favours_steady_matches(self):
+        results = await self._search(chunkScore="mean")
+
+        self.assertEqual([r["id"] for r in results], ["steady", "other", "peak"])
+        self.assertAlmostEqual(results[0]["score"], (0.8 + 0.78 + 0.76) / 3, places=5)
+        self.assertAlmostEqual(results[1]["score"], 0.5, places=5)
+        self.assertEqual(results[0]["subId"], "0")
+
+    async def test_lossy_codec_means_use_exact_scores(self):
+        saved = main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS
+        main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS = "int8", 1
+        try:
+            main._upsert_vector_records([_item("late", text="late")], [np.eye(8)[2].tolist()])
+            main._join_vector_builds()
+            self.assertTrue(main._VECTOR_PARTITIONS[("u1", 8)].codec.lossy)
+            results = await self._search(chunkScore="mean", limit=2)
+        finally:
+            main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS = saved
+
+        self.assertEqual([r["id"] for r in results], ["steady", "other"])
+        self.assertAlmostEqual(results[0]["score"], (0.8 + 0.78 + 0.76) / 3, places=5)
+
+    async def test_chunk_score_needs_vector_mode(self):
+        with self.assertRaises(main.HTTPException) as ctx:
+            await self._search(chunkScore="mean", mode="hybrid")
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+def _fixed(vector):
+    async def embed(texts, config=None):
+        return [vector for _ in texts]
+
+    return embed
+
+
+if __name__ == "__main__":
+    unittest.main()
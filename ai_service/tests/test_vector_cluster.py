@@ -0,0 +1,141 @@
+import unittest
+
+import numpy as np
+
+from ai_service import main
+from ai_service.tests.test_vector_search import AsyncVectorStoreTestCase, _item
+
+
+def _blobs(count, centres, noise=0.05, seed=5):
+    rng = np.random.default_rng(seed)
+    labels = np.arange(count) % len(centres)
+    return labels, centres[labels] + noise * rng.standard_normal((count, centres.shape[1])).astype(np.float32)
+
+
+CENTRES = np.eye(16, dtype=np.float32)[:4] * 3.0
+
+
+class TestMiniBatchKMeans(unittest.TestCase):
+    def test_recovers_separated_blobs(self):
+        labels, vectors = _blobs(2000, CENTRES)
+        vectors = main._unit_rows(vectors)
+
+        centroids = main._minibatch_kmeans(vectors, 4, np.random.default_rng(1), batch=128, steps=30)
+
+        assign = main._nearest_centroids(vectors, centroids)
+        for label in range(4):
+            self.assertEqual(len(set(assign[labels == label].tolist())), 1)
+        self.assertEqual(len(set(assign.tolist())), 4)
+        self.assertTrue(np.allclose(np.linalg.norm(centroids, axis=1), 1.0, atol=1e-5))
+
+    def test_warm_start_keeps_centroids_in_place(self):
+        _, vectors = _blobs(400, CENTRES)
+        vectors = main._unit_rows(vectors)
+        start = main._unit_rows(CENTRES)
+
+        centroids = main._minibatch_kmeans(vectors, 4, np.random.default_rng(1), batch=64, steps=5, centroids=start)
+
+        self.assertGreater(float(np.einsum("ij,ij->i", centroids, start).min()), 0.99)
+
+
+class TestClusterEndpoint(AsyncVectorStoreTestCase):
+    def setUp(self):
+        self._saved_refit_ratio = main.CLUSTER_REFIT_RATIO
+        super().setUp()
+        self.labels, vectors = _blobs(80, CENTRES)
+        self.ids = [f"r{i}" for i in range(80)]
+        main._upsert_vector_records(
+            [_item(i, object_type="article" if n % 8 == 0 else "highlight") for n, i in enumerate(self.ids)],
+            vectors.tolist(),
+        )
+
+    def tearDown(self):
+        super().tearDown()
+        main.CLUSTER_REFIT_RATIO = self._saved_refit_ratio
+
+    async def _cluster(self, **kwargs):
+        return await main.cluster(main.ClusterRequest(userId="u1", k=4, **kwargs))
+
+    def _groups(self, response):
+        return sorted(sorted(c["members"]) for c in response["clusters"])
+
+    def _expected(self, ids, labels):
+        groups = {}
+        for record_id, label in zip(ids, labels):
+            groups.setdefault(int(label), []).append(record_id)
+        return sorted(sorted(members) for members in groups.values())
+
+    async def test_fit_returns_members_centroids_and_exemplars(self):
+        response = await self._cluster(exemplars=2)
+
+        self.assertEqual(response["model"], "fit")
+        self.assertEqual((response["k"], response["records"]), (4, 80))
+        self.assertEqual(self._groups(response), self._expected(self.ids, self.labels))
+        for cluster in response["clusters"]:
+            self.assertEqual(cluster["size"], 20)
+            self.assertEqual(len(cluster["centroid"]), 16)
+            exemplars = cluster["exemplars"]
+            self.assertEqual([e["id"] for e in exemplars], cluster["members"][:2])
+            self.assertGreaterEqual(exemplars[0]["score"], exemplars[1]["score"])
+            self.assertEqual(exemplars[0]["document"], f"text for {exemplars[0]['id']}")
+
+    async def test_writes_update_the_cached_model_incrementally(self):
+        await self._cluster()
+        self.assertEqual((await self._cluster())["model"], "cached")
+
+        main._upsert_vector_records([_item("late")], [(CENTRES[2] + 0.01).tolist()])
+        main._delete_vector_records(["r0", "r1"])
+        main._upsert_vector_records([_item("other", user_id="u2")], [CENTRES[0].tolist()])
+        response = await self._cluster()
+
+        self.assertEqual(response["model"], "incremental")
+        self.assertEqual(response["records"], 79)
+        expected = self._expected(self.ids[2:] + ["late"], list(self.labels[2:]) + [2])
+        self.assertEqual(self._groups(response), expected)
+        self.assertEqual((await self._cluster())["model"], "cached")
+
+    async def test_cached_model_serves_any_exemplar_count(self):
+        await self._cluster(exemplars=1)
+
+        response = await self._cluster(exemplars=5)
+
+        self.assertEqual(response["model"], "cached")
+        for cluster in response["clusters"]:
+            self.assertEqual([e["id"] for e in cluster["exemplars"]], cluster["members"][:5])
+        response = await self._cluster(exemplars=0)
+        self.assertTrue(all(cluster["exemplars"] == [] for cluster in response["clusters"]))
+
+    async def test_many_changes_trigger_a_refit(self):
+        main.CLUSTER_REFIT_RATIO = 0.1
+        await self._cluster()
+
+        main._delete_vector_records(self.ids[:10])
+        response = await self._cluster()
+
+        self.assertEqual(response["model"], "fit")
+        self.assertEqual(self._groups(response), self._expected(self.ids[10:], self.labels[10:]))
+
+    async def test_filters_and_member_cap(self):
+        response = await self._cluster(types=["highlight"], maxMembers=3)
+
+        self.assertEqual(response["records"], 70)
+        self.assertEqual(sum(c["size"] for c in response["clusters"]), 70)
+        self.assertTrue(all(len(c["members"]) == 3 for c in response["clusters"]))
+        articles = {i for n, i in enumerate(self.ids) if n % 8 == 0}
+        self.assertFalse(articles & {i for c in response["clusters"] for i in c["members"]})
+
+        main._upsert_vector_records([_item("new-article", object_type="article")], [CENTRES[1].tolist()])
+        response = await self._cluster(types=["highlight"])
+        self.assertEqual((response["model"], response["records"]), ("incremental", 70))
+
+    async def test_unknown_user_and_missing_user(self):
+        response = await main.cluster(main.ClusterRequest(userId="nobody"))
+        self.assertEqual((response["clusters"], response["records"]), ([], 0))
+
+        with self.assertRaises(main.HTTPException) as ctx:
+            await main.cluster(main.ClusterRequest(userId=""))
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from ai_service import main
+from ai_service.tests.test_vector_search import AsyncVectorStoreTestCase, _item
+
+
+def _brute_force_pairs(vectors, threshold):
+    scores = vectors @ vectors.T
+    return {
+        (i, j)
+        for i in range(len(vectors))
+        for j in range(i + 1, len(vectors))
+        if scores[i, j] >= threshold
+    }
+
+
+def _with_duplicates(count, copies, dim=32, noise=0.05, seed=11):
+    """``count`` random unit rows, the first ``copies`` of them repeated with ``noise`` added."""
+    rng = np.random.default_rng(seed)
+    base = rng.standard_normal((count, dim)).astype(np.float32)
+    near = base[:copies] + noise * rng.standard_normal((copies, dim)).astype(np.float32)
+    return main._unit_rows(np.concatenate([base, near]))
+
+
+class TestDuplicatePairs(unittest.TestCase):
+    def test_blocked_pairs_match_brute_force_across_tiles(self):
+        vectors = _with_duplicates(90, 30, noise=0.4)
+
+        left, right, scores = main._dedupe_pairs_blocked(vectors, 0.8, block=16)
+
+        self.assertEqual(set(zip(left.tolist(), right.tolist())), _brute_force_pairs(vectors, 0.8))
+        self.assertTrue(np.allclose(scores, np.einsum("ij,ij->i", vectors[left], vectors[right]), atol=1e-5))
+
+    def test_lsh_finds_near_duplicates_and_verifies_every_pair(self):
+        vectors = _with_duplicates(2000, 200)
+
+        left, right, scores = main._dedupe_pairs_lsh(vectors, 0.95, block=256, tables=8, bits=10)
+
+        found = set(zip(left.tolist(), right.tolist()))
+        truth = _brute_force_pairs(vectors, 0.95)
+        self.assertLessEqual(found, truth)
+        self.assertGreaterEqual(len(found) / len(truth), 0.98)
+        self.assertTrue((scores >= 0.95).all())
+
+    def test_lsh_splits_large_buckets_into_blocks(self):
+        vectors = _with_duplicates(300, 100, noise=0.3)
+
+        left, right, _ = main._dedupe_pairs_lsh(vectors, 0.9, block=32, tables=2, bits=1)
+
+        self.assertEqual(set(zip(left.tolist(), right.tolist())), _brute_force_pairs(vectors, 0.9))
+
+    def test_components_follow_chains(self):
+        left = np.array([10, 11, 40, 12])
+        right = np.array([11, 12, 41, 13])
+
+        nodes, labels = main._pair_components(left, right)
+
+        groups = {}
+        for node, label in zip(nodes.tolist(), labels.tolist()):
+            groups.setdefault(label, []).append(node)
+        self.assertEqual(sorted(groups.values()), [[10, 11, 12, 13], [40, 41]])
+
+
+class TestDedupeEndpoint(AsyncVectorStoreTestCase):
+    def setUp(self):
+        self._saved_lsh_min_rows = main.DEDUPE_LSH_MIN_ROWS
+        super().setUp()
+        vectors = _with_duplicates(60, 4, noise=0.02)
+        self.ids = [f"r{i}" for i in range(64)]
+        main._upsert_vector_records([_item(i) for i in self.ids[:60]], vectors[:60].tolist())
+        with mock.patch.object(main.time, "time", return_value=4_000_000_000.0):
+            main._upsert_vector_records(
+                [_item(i, object_type="article" if i == "r62" else "highlight") for i in self.ids[60:]],
+                vectors[60:].tolist(),
+            )
+        main._upsert_vector_records([_item("other", user_id="u2")], [vectors[0].tolist()])
+
+    def tearDown(self):
+        super().tearDown()
+        main.DEDUPE_LSH_MIN_ROWS = self._saved_lsh_min_rows
+
+    async def test_clusters_list_the_earliest_record_first(self):
+        response = await main.dedupe(main.DedupeRequest(userId="u1", threshold=0.98))
+
+        self.assertEqual(response["method"], "exact")
+        self.assertEqual(response["records"], 64)
+        self.assertEqual(response["total"], 4)
+        self.assertEqual(
+            sorted(cluster["ids"] for cluster in response["clusters"]),
+            [["r0", "r60"], ["r1", "r61"], ["r2", "r62"], ["r3", "r63"]],
+        )
+        self.assertTrue(all(cluster["score"] >= 0.98 for cluster in response["clusters"]))
+
+    async def test_filters_and_lsh_method(self):
+        main.DEDUPE_LSH_MIN_ROWS = 10
+
+        response = await main.dedupe(main.DedupeRequest(userId="u1", types=["highlight"], threshold=0.98, limit=2))
+
+        self.assertEqual(response["method"], "lsh")
+        self.assertEqual(response["records"], 63)
+        self.assertEqual(response["total"], 3)
+        self.assertEqual(len(response["clusters"]), 2)
+        self.assertNotIn("r62", [i for cluster in response["clusters"] for i in cluster["ids"]])
+
+    async def test_requires_user(self):
+        with self.assertRaises(main.HTTPException) as ctx:
+            await main.dedupe(main.DedupeRequest(userId=" "))
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+import math
+import threading
+import unittest
+
+import numpy as np
+
+from ai_service import main
+from ai_service.tests.test_vector_search import AsyncVectorStoreTestCase, VectorStoreTestCase, _item
+
+
+TEXTS = {
+    "a": "Spaced repetition schedules reviews just before forgetting",
+    "b": "The forgetting curve drops fast without repetition repetition",
+    "c": "Ebbinghaus measured the forgetting curve with nonsense syllables",
+    "d": "Interleaving practice beats blocked practice for transfer",
+    "e": "Sleep consolidates memory traces",
+}
+
+
+def _bm25(query, texts):
+    docs = {record_id: main._lexical_terms(text) for record_id, text in texts.items()}
+    average = sum(len(terms) for terms in docs.values()) / len(docs)
+    scores = {}
+    for record_id, terms in docs.items():
+        score = 0.0
+        for term in dict.fromkeys(main._lexical_terms(query)):
+            df = sum(1 for other in docs.values() if term in other)
+            tf = terms.count(term)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+            norm = main._BM25_K1 * (1 - main._BM25_B + main._BM25_B * len(terms) / average)
+            score += idf * tf * (main._BM25_K1 + 1) / (tf + norm)
+        if score > 0:
+            scores[record_id] = score
+    return sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
+
+
+class LexicalTestCase(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rng = np.random.default_rng(31)
+
+    def _upsert(self, texts, **kwargs):
+        main._upsert_vector_records(
+            [_item(record_id, text=text, **kwargs) for record_id, text in texts.items()],
+            self.rng.standard_normal((len(texts), 8)).tolist(),
+        )
+
+    def _search(self, query, **kwargs):
+        kwargs.setdefault("user_id", "u1")
+        kwargs.setdefault("types", None)
+        kwargs.setdefault("limit", 10)
+        return main._search_lexical(query, **kwargs)
+
+
+class TestBm25Search(LexicalTestCase):
+    def test_ranking_matches_reference_bm25(self):
+        self._upsert(TEXTS)
+
+        for query in ("forgetting curve", "repetition", "Ebbinghaus syllables", "practice transfer sleep"):
+            with self.subTest(query=query):
+                results = self._search(query)
+                expected = _bm25(query, TEXTS)
+                self.assertEqual([r["id"] for r in results], [record_id for record_id, _ in expected])
+                for result, (_, score) in zip(results, expected):
+                    self.assertAlmostEqual(result["score"], score, places=5)
+
+    def test_unknown_terms_and_other_users_return_nothing(self):
+        self._upsert(TEXTS)
+        self._upsert({"z": "forgetting curve notes"}, user_id="u2")
+
+        self.assertEqual(self._search("zettelkasten"), [])
+        self.assertEqual(self._search("  "), [])
+        self.assertNotIn("z", [r["id"] for r in self._search("forgetting")])
+
+    def test_filters_apply_before_scoring(self):
+        self._upsert({k: v for k, v in TEXTS.items() if k != "c"})
+        self._upsert({"c": TEXTS["c"]}, object_type="article")
+
+        results = self._search("forgetting curve", types=["article"])
+
+        self.assertEqual([r["id"] for r in results], ["c"])
+
+    def test_min_score_floor(self):
+        self._upsert(TEXTS)
+        expected = _bm25("forgetting repetition", TEXTS)
+        floor = expected[1][1]
+
+        results = self._search("forgetting repetition", min_score=floor)
+
+        self.assertEqual([r["id"] for r in results], [record_id for record_id, _ in expected[:2]])
+
+
+class TestLexicalIndexMaintenance(LexicalTestCase):
+    def _assert_matches_rebuild(self, partition):
+        built = main._LexicalIndex.build([main._VECTOR_STORE.get(record_id) for record_id in partition.ids])
+        live = partition.lexical
+        self.assertEqual(
+            {term: dict(rows) for term, rows in live.postings.items()},
+            {term: dict(rows) for term, rows in built.postings.items()},
+        )
+        self.assertEqual(live.lengths[: partition.size].tolist(), built.lengths[: partition.size].tolist())
+        self.assertEqual(live.total_length, built.total_length)
+        self.assertEqual(len(live.row_terms), partition.size)
+
+    def test_writes_keep_the_index_equal_to_a_rebuild(self):
+        texts = {f"r{i}": " ".join(self.rng.choice(["alpha", "beta", "gamma", "delta"], 6)) for i in range(60)}
+        self._upsert(texts)
+        self._search("alpha")
+        self.assertIsNotNone(main._VECTOR_PARTITIONS[("u1", 8)].lexical)
+
+        main._delete_vector_records([f"r{i}" for i in range(0, 60, 3)])
+        self._upsert({"r1": "omega omega alpha", "r2": "zeta", "new": "beta omega"})
+
+        partition = main._VECTOR_PARTITIONS[("u1", 8)]
+        self._assert_matches_rebuild(partition)
+        self.assertEqual(self._search("omega")[0]["id"], "r1")
+        self.assertNotIn("r0", [r["id"] for r in self._search("alpha beta gamma delta", limit=100)])
+
+    def test_published_index_is_untouched_by_later_writes(self):
+        self._upsert(TEXTS)
+        self._search("forgetting")
+        old = main._VECTOR_PARTITIONS[("u1", 8)]
+        before = old.lexical.scores(["forgetting"], old.size).tolist()
+
+        main._delete_vector_records(["a"])
+        self._upsert({"f": "forgetting forgetting forgetting"})
+
+        self.assertEqual(old.lexical.scores(["forgetting"], old.size).tolist(), before)
+        self._assert_matches_rebuild(main._VECTOR_PARTITIONS[("u1", 8)])
+
+    def test_first_query_publishes_the_index_on_a_new_version(self):
+        self._upsert(TEXTS)
+        old = main._VECTOR_PARTITIONS[("u1", 8)]
+        version = main._VECTOR_PARTITIONS.version
+
+        self._search("forgetting")
+
+        self.assertIsNone(old.lexical)
+        self.assertGreater(main._VECTOR_PARTITIONS.version, version)
+        self._assert_matches_rebuild(main._VECTOR_PARTITIONS[("u1", 8)])
+
+    def test_writes_during_the_build_are_caught_up(self):
+        self._upsert(TEXTS)
+        original = main._LexicalIndex.build
+
+        def build(records):
+            index = original(records)
+            main._delete_vector_records(["a", "b"])
+            self._upsert({"c": "sleep sleep", "f": "forgetting forgetting"})
+            return index
+
+        main._LexicalIndex.build = build
+        try:
+            results = self._search("forgetting sleep")
+        finally:
+            main._LexicalIndex.build = original
+
+        self._assert_matches_rebuild(main._VECTOR_PARTITIONS[("u1", 8)])
+        self.assertEqual({r["id"] for r in results}, {"c", "e", "f"})
+
+    def test_index_reads_text_from_the_segment_after_reload(self):
+        self._upsert(TEXTS)
+        main._persist_vector_store()
+        self._reload_store()
+        self.assertIsNone(main._VECTOR_STORE["a"].text)
+
+        results = self._search("forgetting curve")
+
+        self.assertEqual([r["id"] for r in results], [record_id for record_id, _ in _bm25("forgetting curve", TEXTS)])
+
+
+class TestSearchModes(AsyncVectorStoreTestCase):
+    _upsert = LexicalTestCase._upsert
+
+    async def asyncSetUp(self):
+        self.rng = np.random.default_rng(31)
+        self._original_embed = main._hf_embed_texts
+        self.embed_calls = 0
+        self._upsert(TEXTS)
+        self.query_vector = main._VECTOR_STORE["e"].embedding.tolist()
+
+        async def fake_embed(texts, config=None):
+            self.embed_calls += 1
+            return [self.query_vector for _ in texts]
+
+        main._hf_embed_texts = fake_embed
+
+    async def asyncTearDown(self):
+        main._hf_embed_texts = self._original_embed
+
+    async def test_lexical_mode_needs_no_embedding(self):
+        response = await main.search(main.SearchRequest(userId="u1", query="Ebbinghaus", mode="lexical"))
+
+        self.assertEqual([r["id"] for r in response["results"]], ["c"])
+        self.assertEqual(self.embed_calls, 0)
+
+    async def test_lexical_search_runs_off_the_event_loop(self):
+        original = main._search_lexical
+        threads = []
+
+        def recording_search(*args, **kwargs):
+            threads.append(threading.get_ident())
+            return original(*args, **kwargs)
+
+        main._search_lexical = recording_search
+        try:
+            for mode in ("lexical", "hybrid"):
+                await main.search(main.SearchRequest(userId="u1", query="curve", mode=mode))
+        finally:
+            main._search_lexical = original
+
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    async def test_hybrid_fuses_vector_and_lexical_ranks(self):
+        response = await main.search(main.SearchRequest(userId="u1", query="Ebbinghaus", mode="hybrid", limit=3))
+
+        semantic = main._search_vectors(self.query_vector, user_id="u1", types=None, limit=50)
+        vector_rank = {r["id"]: rank for rank, r in enumerate(semantic, start=1)}
+        ids = [r["id"] for r in response["results"]]
+        self.assertEqual(self.embed_calls, 1)
+        self.assertEqual(set(ids[:2]), {"c", "e"})
+        for result in response["results"]:
+            expected = 1 / (main.SEARCH_RRF_K + vector_rank[result["id"]]) if result["id"] in vector_rank else 0.0
+            if result["id"] == "c":
+                expected += 1 / (main.SEARCH_RRF_K + 1)
+            self.assertAlmostEqual(result["score"], expected)
+
+    async def test_lexical_modes_reject_paging_and_mmr(self):
+        for options in ({"paginate": True}, {"stream": True}, {"mmrLambda": 0.5}):
+            with self.subTest(options=options):
+                with self.assertRaises(main.HTTPException) as ctx:
+                    await main.search(main.SearchRequest(userId="u1", query="curve", mode="lexical", **options))
+                self.assertEqual(ctx.exception.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
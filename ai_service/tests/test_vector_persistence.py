@@ -0,0 +1,499 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import unittest
+
+import numpy as np
+
+from ai_service import main
+from ai_service.tests.test_vector_search import VectorStoreTestCase, _item
+
+
+class VectorPersistenceTestCase(VectorStoreTestCase):
+    def _wal_size(self):
+        path = main._vector_wal_path()
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class TestVectorSegment(VectorPersistenceTestCase):
+    def _write_legacy_json(self, path):
+        with open(path, "w", encoding="utf-8") as fh:
+            json.dump(
+                {
+                    "a": {
+                        "id": "a",
+                        "userId": "u1",
+                        "objectType": "article",
+                        "objectId": "obj-a",
+                        "text": "legacy text",
+                        "metadata": {"articleId": "a"},
+                        "embedding": [1.0, 0.0, 0.0],
+                        "updatedAtMs": 5,
+                    },
+                    "broken": {"id": "broken", "embedding": ["x"]},
+                },
+                fh,
+            )
+
+    def test_segment_round_trip_preserves_records(self):
+        main._upsert_vector_records(
+            [_item("a", text="naïve café", tags=["x", "y"]), _item("b", user_id="u2")],
+            [[0.5, 0.25, -1.0], [0.0, 1.0, 0.0, 2.0]],
+        )
+        main._persist_vector_store()
+
+        self._reload_store()
+        records = {r["id"]: r for r in main._get_vector_records(["a", "b"])}
+
+        self.assertEqual(records["a"]["document"], "naïve café")
+        self.assertEqual(records["a"]["metadata"], {"tags": ["x", "y"]})
+        self.assertEqual(records["a"]["embedding"], [0.5, 0.25, -1.0])
+        self.assertEqual(records["b"]["embedding"], [0.0, 1.0, 0.0, 2.0])
+        self.assertEqual(
+            [r["id"] for r in main._search_vectors([0.0, 1.0, 0.0, 0.0], user_id="u2", types=None, limit=3)],
+            ["b"],
+        )
+
+    def test_loaded_embeddings_are_views_into_the_mapping(self):
+        main._upsert_vector_records([_item("a")], [[1.0, 2.0]])
+        main._persist_vector_store()
+
+        self._reload_store()
+        embedding = main._VECTOR_STORE["a"]["embedding"]
+
+        self.assertFalse(embedding.flags.owndata)
+        self.assertFalse(embedding.flags.writeable)
+
+    def test_empty_store_round_trip(self):
+        main._upsert_vector_records([_item("a")], [[1.0, 2.0]])
+        main._delete_vector_records(["a"])
+        main._persist_vector_store()
+
+        self._reload_store()
+
+        self.assertEqual(main._VECTOR_STORE, {})
+
+    def test_legacy_json_at_store_path_is_converted_in_place(self):
+        self._write_legacy_json(main.VECTOR_STORE_PATH)
+
+        self._reload_store()
+
+        self.assertTrue(main._is_vector_segment(main.VECTOR_STORE_PATH))
+        self.assertEqual(list(main._VECTOR_STORE), ["a"])
+        self.assertEqual(main._VECTOR_STORE["a"]["updatedAtMs"], 5)
+        self.assertEqual(
+            [r["id"] for r in main._search_vectors([1.0, 0.0, 0.0], user_id="u1", types=None, limit=3)],
+            ["a"],
+        )
+        with open(f"{main.VECTOR_STORE_PATH}.bak", encoding="utf-8") as fh:
+            self.assertEqual(json.load(fh)["a"]["text"], "legacy text")
+
+    def test_legacy_json_sibling_is_converted(self):
+        legacy = os.path.join(self._tmpdir.name, "vectors.json")
+        self._write_legacy_json(legacy)
+
+        self._reload_store()
+
+        self.assertTrue(os.path.exists(main.VECTOR_STORE_PATH))
+        self.assertEqual(main._get_vector_records(["a"])[0]["document"], "legacy text")
+        self.assertTrue(np.allclose(main._VECTOR_STORE["a"]["embedding"], [1.0, 0.0, 0.0]))
+        self.assertTrue(os.path.exists(legacy))
+
+    def test_unverified_conversion_keeps_the_legacy_store(self):
+        self._write_legacy_json(main.VECTOR_STORE_PATH)
+        original = main._write_vector_segment
+        main._write_vector_segment = lambda path, records: original(path, records[:-1])
+        try:
+            with self.assertRaises(ValueError):
+                main._convert_json_vector_store(main.VECTOR_STORE_PATH, main.VECTOR_STORE_PATH)
+        finally:
+            main._write_vector_segment = original
+
+        self.assertFalse(main._is_vector_segment(main.VECTOR_STORE_PATH))
+        self.assertEqual(os.listdir(self._tmpdir.name), ["vectors.bin"])
+
+    def test_documents_stay_on_disk_after_reload(self):
+        main._upsert_vector_records(
+            [_item("a", text="first", colour="red"), _item("b", text="second", colour="blue")],
+            [[1.0, 0.0], [0.9, 0.1]],
+        )
+        main._persist_vector_store()
+
+        self._reload_store()
+        results = main._search_vectors(
+            [1.0, 0.0], user_id="u1", types=None, limit=5, filter_expr={"metadata.colour": "blue"}
+        )
+
+        self.assertNotIn("text", main._VECTOR_STORE["a"])
+        self.assertNotIn("metadata", main._VECTOR_STORE["a"])
+        self.assertEqual([(r["id"], r["document"]) for r in results], [("b", "second")])
+        self.assertEqual(results[0]["metadata"], {"colour": "blue"})
+
+    def test_boot_decodes_metadata_only_for_indexed_keys(self):
+        main._upsert_vector_records(
+            [_item("a", articleId="x", note="n"), _item("b", note="articleId")],
+            [[1.0, 0.0], [0.9, 0.1]],
+        )
+        main._persist_vector_store()
+        decoded = []
+        original = main.json.loads
+
+        def loads(raw, *args, **kwargs):
+            decoded.append(bytes(raw))
+            return original(raw, *args, **kwargs)
+
+        main.json.loads = loads
+        try:
+            self._reload_store()
+        finally:
+            main.json.loads = original
+
+        self.assertEqual(decoded[1:], [b'{"articleId":"x","note":"n"}'])
+        self.assertIsNone(main._VECTOR_STORE["a"].metadata)
+        results = main._search_vectors(
+            [0.9, 0.1], user_id="u1", types=None, limit=5, filter_expr={"metadata.articleId": "x"}
+        )
+        self.assertEqual([r["id"] for r in results], ["a"])
+
+    def test_compaction_remaps_records_onto_the_new_segment(self):
+        main._upsert_vector_records([_item("a", text="old"), _item("b")], [[1.0, 0.0], [0.0, 1.0]])
+        main._persist_vector_store()
+        self._reload_store()
+        previous = main._VECTOR_STORE["b"]["segment"]
+        main._upsert_vector_records([_item("a", text="new")], [[0.5, 0.5]])
+
+        main._persist_vector_store()
+
+        for record_id in ("a", "b"):
+            record = main._VECTOR_STORE[record_id]
+            self.assertIsNot(record["segment"], previous)
+            self.assertNotIn("text", record)
+        self.assertEqual([r["document"] for r in main._get_vector_records(["a", "b"])], ["new", "text for b"])
+
+    def test_version_one_segment_is_still_readable(self):
+        document = main._encode_vector_document(
+            {"id": "a", "userId": "u1", "objectType": "note", "objectId": "o", "subId": "",
+             "text": "v1 text", "metadata": {"k": 1}, "updatedAtMs": 3}
+        )
+        table = np.zeros(1, dtype=main._VECTOR_SEGMENT_TABLE_DTYPE_V1)
+        table["dim"], table["doc_length"] = 2, len(document)
+        table_offset = main._VECTOR_SEGMENT_HEADER_V1.size
+        vectors_offset = main._align64(table_offset + table.nbytes)
+        with open(main.VECTOR_STORE_PATH, "wb") as fh:
+            fh.write(main._VECTOR_SEGMENT_HEADER_V1.pack(
+                main._VECTOR_SEGMENT_MAGIC, 1, 0, 1, table_offset, vectors_offset, vectors_offset + 8
+            ))
+            fh.write(table.tobytes())
+            fh.seek(vectors_offset)
+            fh.write(np.array([0.0, 1.0], dtype="<f4").tobytes())
+            fh.write(document)
+
+        self._reload_store()
+
+        record = main._get_vector_records(["a"])[0]
+        self.assertEqual((record["document"], record["metadata"]), ("v1 text", {"k": 1}))
+        self.assertEqual(record["embedding"], [0.0, 1.0])
+
+
+
+class TestVectorWal(VectorPersistenceTestCase):
+    def test_writes_append_to_wal_without_rewriting_segment(self):
+        main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+        main._persist_vector_store()
+        segment_mtime = os.stat(main.VECTOR_STORE_PATH).st_mtime_ns
+
+        main._upsert_vector_records([_item("b")], [[0.0, 1.0]])
+        main._flush_vector_writes()
+        first = self._wal_size()
+        main._upsert_vector_records([_item("c")], [[1.0, 1.0]])
+        main._flush_vector_writes()
+
+        self.assertGreater(self._wal_size(), first)
+        self.assertEqual(os.stat(main.VECTOR_STORE_PATH).st_mtime_ns, segment_mtime)
+
+    def test_replay_applies_upserts_and_deletes_in_order(self):
+        main._upsert_vector_records([_item("a"), _item("b")], [[1.0, 0.0], [0.0, 1.0]])
+        main._persist_vector_store()
+        main._delete_vector_records(["a"])
+        main._upsert_vector_records([_item("b", text="rewritten"), _item("c")], [[1.0, 1.0], [1.0, 0.0]])
+
+        self._reload_store()
+
+        self.assertEqual(sorted(main._VECTOR_STORE), ["b", "c"])
+        self.assertEqual(main._VECTOR_STORE["b"]["text"], "rewritten")
+        self.assertEqual(
+            [r["id"] for r in main._search_vectors([1.0, 0.0], user_id="u1", types=None, limit=3)],
+            ["c", "b"],
+        )
+
+    def test_torn_tail_is_dropped(self):
+        main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+        main._upsert_vector_records([_item("b")], [[0.0, 1.0]])
+        main._shutdown_vector_persistence()
+        intact = self._wal_size()
+        with open(main._vector_wal_path(), "r+b") as fh:
+            fh.truncate(intact - 3)
+
+        self._reload_store()
+
+        self.assertEqual(list(main._VECTOR_STORE), ["a"])
+        self.assertLess(self._wal_size(), intact - 3)
+
+    def test_compaction_folds_wal_into_segment(self):
+        main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+        main._delete_vector_records(["a"])
+        main._upsert_vector_records([_item("b")], [[0.0, 1.0]])
+
+        main._compact_vector_store()
+
+        self.assertFalse(os.path.exists(main._vector_wal_path()))
+        self.assertFalse(os.path.exists(main._vector_wal_rotated_path()))
+        self._reload_store()
+        self.assertEqual(list(main._VECTOR_STORE), ["b"])
+
+    def test_writes_during_compaction_land_in_the_new_wal(self):
+        main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+        records = main._rotate_vector_wal()
+        main._upsert_vector_records([_item("b")], [[0.0, 1.0]])
+        main._write_vector_segment(main.VECTOR_STORE_PATH, records)
+
+        self._reload_store()
+
+        self.assertEqual(sorted(main._VECTOR_STORE), ["a", "b"])
+
+    def test_wal_over_threshold_triggers_background_compaction(self):
+        original = main.VECTOR_WAL_COMPACT_BYTES
+        main.VECTOR_WAL_COMPACT_BYTES = 1
+        try:
+            main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+            main._flush_vector_writes()
+            main._VECTOR_COMPACTION_THREAD.join(timeout=5)
+        finally:
+            main.VECTOR_WAL_COMPACT_BYTES = original
+
+        self.assertEqual(self._wal_size(), 0)
+        self.assertTrue(main._is_vector_segment(main.VECTOR_STORE_PATH))
+
+    def test_idle_worker_compacts_an_old_wal(self):
+        original = main.VECTOR_WAL_COMPACT_INTERVAL_S
+        main.VECTOR_WAL_COMPACT_INTERVAL_S = 0.2
+        try:
+            main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline and not os.path.exists(main.VECTOR_STORE_PATH):
+                time.sleep(0.02)
+            main._VECTOR_COMPACTION_THREAD.join(timeout=5)
+        finally:
+            main.VECTOR_WAL_COMPACT_INTERVAL_S = original
+
+        self.assertEqual(self._wal_size(), 0)
+        self._reload_store()
+        self.assertEqual(list(main._VECTOR_STORE), ["a"])
+
+    def test_interval_zero_disables_timed_compaction(self):
+        original = main.VECTOR_WAL_COMPACT_INTERVAL_S
+        main.VECTOR_WAL_COMPACT_INTERVAL_S = 0
+        try:
+            main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+            main._flush_vector_writes()
+
+            self.assertIsNone(main._VECTOR_BACKEND.compaction_due_in())
+            self.assertFalse(main._VECTOR_BACKEND.needs_compaction())
+        finally:
+            main.VECTOR_WAL_COMPACT_INTERVAL_S = original
+
+
+
+class TestVectorGroupCommit(VectorPersistenceTestCase):
+    def setUp(self):
+        super().setUp()
+        self._original_delay = main.VECTOR_PERSIST_MAX_DELAY_MS
+        self._original_max_ops = main.VECTOR_PERSIST_MAX_PENDING_OPS
+
+    def tearDown(self):
+        super().tearDown()
+        main.VECTOR_PERSIST_MAX_DELAY_MS = self._original_delay
+        main.VECTOR_PERSIST_MAX_PENDING_OPS = self._original_max_ops
+
+    def _wait_for_drain(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while main._vector_persistence_stats()["pending_ops"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_mutations_queue_instead_of_writing(self):
+        main.VECTOR_PERSIST_MAX_DELAY_MS = 60_000
+        main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+        main._upsert_vector_records([_item("b")], [[0.0, 1.0]])
+        main._delete_vector_records(["a"])
+
+        stats = main._vector_persistence_stats()
+        self.assertEqual(stats["pending_ops"], 3)
+        self.assertEqual(stats["backend"], "file")
+        self.assertFalse(os.path.exists(main._vector_wal_path()))
+
+        self.assertEqual(main._flush_vector_writes(), 3)
+        self.assertEqual(main._vector_persistence_stats()["last_flush_ops"], 3)
+
+    def test_worker_coalesces_within_max_delay(self):
+        main.VECTOR_PERSIST_MAX_DELAY_MS = 50
+        flushes = main._VECTOR_PERSIST_STATS["flushes"]
+        for i in range(5):
+            main._upsert_vector_records([_item(f"r{i}")], [[1.0, float(i)]])
+
+        self._wait_for_drain()
+
+        self.assertEqual(main._VECTOR_PERSIST_STATS["flushes"], flushes + 1)
+        self.assertEqual(main._VECTOR_PERSIST_STATS["last_flush_ops"], 5)
+
+    def test_max_pending_ops_flushes_before_the_delay(self):
+        main.VECTOR_PERSIST_MAX_DELAY_MS = 60_000
+        main.VECTOR_PERSIST_MAX_PENDING_OPS = 2
+        main._upsert_vector_records([_item("a"), _item("b")], [[1.0, 0.0], [0.0, 1.0]])
+
+        self._wait_for_drain()
+
+        self.assertEqual(main._vector_persistence_stats()["pending_ops"], 0)
+        self.assertGreater(self._wal_size(), 0)
+
+    def test_lifespan_shutdown_flushes_pending_writes(self):
+        main.VECTOR_PERSIST_MAX_DELAY_MS = 60_000
+
+        async def run_app():
+            async with main.lifespan(main.app):
+                main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+
+        asyncio.run(run_app())
+
+        self.assertFalse(main._vector_persistence_stats()["worker_alive"])
+        self._reload_store()
+        self.assertEqual(list(main._VECTOR_STORE), ["a"])
+
+
+
+class TestSQLiteVectorBackend(VectorPersistenceTestCase):
+    def setUp(self):
+        self._original_backend = main._VECTOR_BACKEND
+        super().setUp()
+        self._sqlite_path = os.path.join(self._tmpdir.name, "vectors.sqlite3")
+        main._VECTOR_BACKEND = main._SQLiteVectorBackend(self._sqlite_path)
+
+    def tearDown(self):
+        self._reset_store()
+        main._VECTOR_BACKEND = self._original_backend
+        super().tearDown()
+
+    def _reload_sqlite(self):
+        self._reset_store()
+        main._VECTOR_BACKEND = main._SQLiteVectorBackend(self._sqlite_path)
+        main._load_vector_store_if_needed()
+
+    def test_round_trip_keeps_documents_out_of_memory(self):
+        main._upsert_vector_records(
+            [_item("a", text="naïve café", tags=["x"]), _item("b", user_id="u2")],
+            [[0.5, 0.25, -1.0], [0.0, 1.0, 0.0]],
+        )
+
+        self._reload_sqlite()
+
+        self.assertNotIn("text", main._VECTOR_STORE["a"])
+        self.assertNotIn("metadata", main._VECTOR_STORE["a"])
+        records = {r["id"]: r for r in main._get_vector_records(["a", "b"])}
+        self.assertEqual(records["a"]["document"], "naïve café")
+        self.assertEqual(records["a"]["metadata"], {"tags": ["x"]})
+        self.assertEqual(records["a"]["embedding"], [0.5, 0.25, -1.0])
+        results = main._search_vectors([0.0, 1.0, 0.0], user_id="u2", types=None, limit=3)
+        self.assertEqual([(r["id"], r["document"]) for r in results], [("b", "text for b")])
+
+    def test_unflushed_records_serve_documents_from_memory(self):
+        original = main.VECTOR_PERSIST_MAX_DELAY_MS
+        main.VECTOR_PERSIST_MAX_DELAY_MS = 60_000
+        try:
+            main._upsert_vector_records([_item("a", text="pending")], [[1.0, 0.0]])
+            before = main._search_vectors([1.0, 0.0], user_id="u1", types=None, limit=1)
+            self.assertEqual(main._flush_vector_writes(), 1)
+        finally:
+            main.VECTOR_PERSIST_MAX_DELAY_MS = original
+
+        after = main._search_vectors([1.0, 0.0], user_id="u1", types=None, limit=1)
+        self.assertEqual(before[0]["document"], "pending")
+        self.assertNotIn("text", main._VECTOR_STORE["a"])
+        self.assertEqual(after[0]["document"], "pending")
+
+    def test_database_uses_wal_journal(self):
+        main._load_vector_store_if_needed()
+
+        conn = main._VECTOR_BACKEND._connection()
+
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+    def test_deletes_and_metadata_filters_after_reload(self):
+        main._upsert_vector_records(
+            [_item("a", title="Keep"), _item("b", title="Drop"), _item("c")],
+            [[1.0, 0.0], [0.9, 0.1], [0.8, 0.2]],
+        )
+        main._delete_vector_records(["b"])
+
+        self._reload_sqlite()
+
+        self.assertEqual(sorted(main._VECTOR_STORE), ["a", "c"])
+        results = main._search_vectors(
+            [1.0, 0.0], user_id="u1", types=None, limit=5, filter_expr={"metadata.title": {"$exists": True}}
+        )
+        self.assertEqual([r["id"] for r in results], ["a"])
+
+    def test_chunk_families_survive_reload(self):
+        main._upsert_vector_records(
+            [_item("a#chunk-0"), _item("a#chunk-1"), _item("b#chunk-0")],
+            [[1.0, 0.0], [0.9, 0.1], [0.8, 0.2]],
+            ["a", "a", None],
+        )
+
+        self._reload_sqlite()
+
+        self.assertEqual(main._VECTOR_STORE["a#chunk-1"].chunkOf, "a")
+        self.assertEqual(main._delete_vector_records(["a", "b"]), 2)
+        self.assertEqual(sorted(main._VECTOR_STORE), ["b#chunk-0"])
+
+    def test_database_without_chunk_column_is_migrated(self):
+        conn = sqlite3.connect(self._sqlite_path)
+        conn.execute(
+            "CREATE TABLE vectors (id TEXT PRIMARY KEY, userId TEXT NOT NULL, objectType TEXT NOT NULL, "
+            "objectId TEXT NOT NULL, subId TEXT NOT NULL DEFAULT '', text TEXT NOT NULL, metadata TEXT NOT NULL, "
+            "updatedAtMs INTEGER NOT NULL, embedding BLOB NOT NULL)"
+        )
+        conn.execute(
+            "INSERT INTO vectors VALUES ('a', 'u1', 'note', 'o', '', 'old', '{}', 1, ?)",
+            (np.asarray([1.0, 0.0], dtype="<f4").tobytes(),),
+        )
+        conn.commit()
+        conn.close()
+
+        self._reload_sqlite()
+
+        self.assertIsNone(main._VECTOR_STORE["a"].chunkOf)
+        self.assertEqual(main._get_vector_records(["a"])[0]["document"], "old")
+
+    def test_snapshot_reads_documents_back_from_the_database(self):
+        main._upsert_vector_records([_item("a", text="stored", k=1)], [[1.0, 0.0]])
+        self._reload_sqlite()
+
+        main._write_vector_segment(main.VECTOR_STORE_PATH, list(main._VECTOR_STORE.values()))
+
+        segment = main._VectorSegment(main.VECTOR_STORE_PATH)
+        self.assertEqual(segment.document(0), {"text": "stored", "metadata": {"k": 1}})
+
+    def test_empty_database_imports_the_file_store(self):
+        main._VECTOR_BACKEND = main._FileVectorBackend()
+        main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+        main._persist_vector_store()
+
+        self._reload_sqlite()
+
+        self.assertEqual(main._get_vector_records(["a"])[0]["document"], "text for a")
+        self.assertEqual(main._vector_persistence_stats()["backend"], "sqlite")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,1054 @@
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from ai_service import main
+
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = math.sqrt(sum(x * x for x in a))
+    norm_b = math.sqrt(sum(y * y for y in b))
+    if norm_a <= 0 or norm_b <= 0:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+
+def _item(record_id, user_id="u1", object_type="highlight", text=None, **metadata):
+    return main.EmbeddingUpsertItem(
+        id=record_id,
+        userId=user_id,
+        objectType=object_type,
+        objectId=f"obj-{record_id}",
+        text=text or f"text for {record_id}",
+        metadata=metadata,
+    )
+
+
+class VectorStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._original_path = main.VECTOR_STORE_PATH
+        main.VECTOR_STORE_PATH = os.path.join(self._tmpdir.name, "vectors.bin")
+        self._reset_store()
+
+    def tearDown(self):
+        main.VECTOR_STORE_PATH = self._original_path
+        self._reset_store()
+        self._tmpdir.cleanup()
+
+    def _reset_store(self):
+        main._shutdown_vector_persistence()
+        main._join_vector_builds()
+        if main._VECTOR_COMPACTION_THREAD is not None:
+            main._VECTOR_COMPACTION_THREAD.join()
+        with main._VECTOR_STORE_LOCK:
+            main._VECTOR_STORE = {}
+            main._VECTOR_DRAFT.clear()
+            main._publish_vector_partitions({})
+            main._VECTOR_STORE_LOADED = False
+            main._OBJECT_CODES.clear()
+            main._CHUNK_FAMILIES.clear()
+        with main._SEARCH_CURSORS_LOCK:
+            main._SEARCH_CURSORS.clear()
+        with main._CLUSTER_MODELS_LOCK:
+            main._CLUSTER_MODELS.clear()
+
+    def _reload_store(self):
+        self._reset_store()
+        main._load_vector_store_if_needed()
+
+
+class TestVectorSearch(VectorStoreTestCase):
+    def test_ranking_matches_bruteforce_cosine(self):
+        rng = random.Random(7)
+        vectors = {f"v{i}": [rng.uniform(-1, 1) for _ in range(16)] for i in range(200)}
+        ids = list(vectors)
+        main._upsert_vector_records([_item(i) for i in ids], [vectors[i] for i in ids])
+        query = [rng.uniform(-1, 1) for _ in range(16)]
+
+        results = main._search_vectors(query, user_id="u1", types=None, limit=10)
+
+        expected = sorted(
+            ((i, _cosine(query, v)) for i, v in vectors.items()),
+            key=lambda pair: pair[1],
+            reverse=True,
+        )
+        expected = [pair for pair in expected if pair[1] > 0][:10]
+        self.assertEqual([r["id"] for r in results], [pair[0] for pair in expected])
+        for result, (_, score) in zip(results, expected):
+            self.assertAlmostEqual(result["score"], score, places=5)
+
+    def test_filters_user_type_and_excluded_id(self):
+        main._upsert_vector_records(
+            [
+                _item("a", user_id="u1", object_type="Highlight"),
+                _item("b", user_id="u1", object_type="article"),
+                _item("c", user_id="u2", object_type="highlight"),
+                _item("d", user_id="u1", object_type="highlight"),
+            ],
+            [[1.0, 0.0], [1.0, 0.1], [1.0, 0.0], [0.9, 0.1]],
+        )
+
+        results = main._search_vectors(
+            [1.0, 0.0], user_id="u1", types=["highlight"], limit=5, exclude_id="d"
+        )
+
+        self.assertEqual([r["id"] for r in results], ["a"])
+        self.assertEqual(results[0]["document"], "text for a")
+
+    def test_non_positive_scores_are_dropped(self):
+        main._upsert_vector_records(
+            [_item("same"), _item("opposite"), _item("orthogonal")],
+            [[1.0, 0.0], [-1.0, 0.0], [0.0, 1.0]],
+        )
+
+        results = main._search_vectors([1.0, 0.0], user_id="u1", types=None, limit=5)
+
+        self.assertEqual([r["id"] for r in results], ["same"])
+
+    def test_delete_keeps_matrix_rows_consistent(self):
+        main._upsert_vector_records(
+            [_item("a"), _item("b"), _item("c")],
+            [[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]],
+        )
+
+        self.assertEqual(main._delete_vector_records(["a"]), 1)
+        results = main._search_vectors([0.0, 1.0], user_id="u1", types=None, limit=5)
+
+        self.assertEqual([r["id"] for r in results], ["b", "c"])
+
+    def test_reload_rebuilds_matrix_from_disk(self):
+        main._upsert_vector_records(
+            [_item("a"), _item("b")],
+            [[1.0, 0.0], [0.0, 1.0]],
+        )
+
+        self._reload_store()
+        results = main._search_vectors([0.0, 1.0], user_id="u1", types=None, limit=5)
+
+        self.assertEqual([r["id"] for r in results], ["b"])
+
+
+
+class TestVectorPartitions(VectorStoreTestCase):
+    def test_search_only_scans_the_callers_partition(self):
+        main._upsert_vector_records(
+            [_item("a", user_id="u1"), _item("b", user_id="u2"), _item("c", user_id="u2")],
+            [[1.0, 0.0], [1.0, 0.0], [0.5, 0.5]],
+        )
+
+        self.assertEqual(main._VECTOR_PARTITIONS[("u1", 2)].size, 1)
+        self.assertEqual(main._VECTOR_PARTITIONS[("u2", 2)].size, 2)
+        self.assertEqual(
+            [r["id"] for r in main._search_vectors([1.0, 0.0], user_id="u2", types=None, limit=5)],
+            ["b", "c"],
+        )
+        self.assertEqual(main._search_vectors([1.0, 0.0], user_id="nobody", types=None, limit=5), [])
+
+    def test_reassigned_record_moves_between_partitions(self):
+        main._upsert_vector_records([_item("a", user_id="u1")], [[1.0, 0.0]])
+        main._upsert_vector_records([_item("a", user_id="u2")], [[1.0, 0.0]])
+
+        self.assertNotIn(("u1", 2), main._VECTOR_PARTITIONS)
+        self.assertEqual(
+            [r["id"] for r in main._search_vectors([1.0, 0.0], user_id="u2", types=None, limit=5)],
+            ["a"],
+        )
+
+    def test_empty_user_merges_all_partitions(self):
+        main._upsert_vector_records(
+            [_item("a", user_id="u1"), _item("b", user_id="u2")],
+            [[0.6, 0.4], [1.0, 0.0]],
+        )
+
+        results = main._search_vectors([1.0, 0.0], user_id="", types=None, limit=5)
+
+        self.assertEqual([r["id"] for r in results], ["b", "a"])
+
+    def test_update_in_the_same_partition_keeps_its_row(self):
+        main._upsert_vector_records(
+            [_item("a", tags=["ml"]), _item("b"), _item("c", object_type="article")],
+            [[1.0, 0.0], [0.6, 0.4], [0.0, 1.0]],
+        )
+        row = main._VECTOR_PARTITIONS[("u1", 2)].rows["a"]
+
+        main._upsert_vector_records([_item("a", object_type="article", tags=["bio"])], [[0.0, 1.0]])
+
+        partition = main._VECTOR_PARTITIONS[("u1", 2)]
+        self.assertEqual(partition.size, 3)
+        self.assertEqual(partition.rows["a"], row)
+        results = main._search_vectors([0.0, 1.0], user_id="u1", types=["article"], limit=5)
+        self.assertEqual([r["id"] for r in results], ["a", "c"])
+        self.assertEqual(
+            main._search_vectors([1.0, 0.0], user_id="u1", types=None, limit=5, filter_expr={"metadata.tags": "ml"}),
+            [],
+        )
+
+
+class TestVectorSnapshots(VectorStoreTestCase):
+    def test_writes_publish_a_new_version_and_leave_the_old_one_intact(self):
+        main._upsert_vector_records(
+            [_item("a", articleId="x"), _item("b", articleId="x")], [[1.0, 0.0], [0.0, 1.0]]
+        )
+        before = main._VECTOR_PARTITIONS
+        old = before[("u1", 2)]
+
+        main._upsert_vector_records([_item("c", articleId="x")], [[0.7, 0.7]])
+        main._delete_vector_records(["a"])
+
+        self.assertGreater(main._VECTOR_PARTITIONS.version, before.version)
+        self.assertEqual(old.size, 2)
+        self.assertEqual(old.ids, ["a", "b"])
+        self.assertEqual(old.posting_rows("metadata.articleId", ["x"]).tolist(), [0, 1])
+        self.assertEqual([record_id for _, record_id in old.search(main._unit_vector([1.0, 0.0]), 5)], ["a"])
+        self.assertEqual(main._VECTOR_PARTITIONS[("u1", 2)].ids, ["c", "b"])
+
+    def test_search_does_not_wait_for_writers(self):
+        main._upsert_vector_records([_item("a")], [[1.0, 0.0]])
+        results = []
+        with main._VECTOR_STORE_LOCK:
+            reader = threading.Thread(
+                target=lambda: results.extend(
+                    main._search_vectors([1.0, 0.0], user_id="u1", types=None, limit=5)
+                )
+            )
+            reader.start()
+            reader.join(timeout=5)
+            self.assertFalse(reader.is_alive())
+        self.assertEqual([r["id"] for r in results], ["a"])
+
+    def test_concurrent_reads_see_whole_versions(self):
+        main._upsert_vector_records([_item(f"r{i}") for i in range(50)], [[1.0, i / 50] for i in range(50)])
+        errors = []
+        stop = threading.Event()
+
+        def read():
+            while not stop.is_set():
+                try:
+                    ids = [r["id"] for r in main._search_vectors([1.0, 0.0], user_id="u1", types=None, limit=50)]
+                    if len(ids) != len(set(ids)):
+                        errors.append(ids)
+                except Exception as exc:
+                    errors.append(exc)
+
+        readers = [threading.Thread(target=read) for _ in range(3)]
+        for thread in readers:
+            thread.start()
+        for round_ in range(30):
+            main._delete_vector_records([f"r{round_}"])
+            main._upsert_vector_records([_item(f"r{round_}")], [[1.0, round_ / 50]])
+        stop.set()
+        for thread in readers:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+
+class TestSearchBatch(VectorStoreTestCase):
+    def _load(self, count=300, dim=32):
+        rng = np.random.default_rng(13)
+        vectors = rng.standard_normal((count, dim))
+        main._upsert_vector_records(
+            [_item(f"v{i}", object_type="article" if i % 4 == 0 else "highlight") for i in range(count)],
+            [v.tolist() for v in vectors],
+        )
+        return rng.standard_normal((8, dim)).tolist()
+
+    def _assert_matches_single_queries(self, queries, **kwargs):
+        batched = main._search_vectors_batch(queries, user_id="u1", limit=7, **kwargs)
+
+        self.assertEqual(len(batched), len(queries))
+        for query, results in zip(queries, batched):
+            single = main._search_vectors(query, user_id="u1", limit=7, **kwargs)
+            self.assertEqual([r["id"] for r in results], [r["id"] for r in single])
+            for got, expected in zip(results, single):
+                self.assertAlmostEqual(got["score"], expected["score"], places=5)
+
+    def test_batch_matches_single_query_search(self):
+        queries = self._load()
+
+        self._assert_matches_single_queries(queries, types=None)
+        self._assert_matches_single_queries(queries, types=["article"])
+
+    def test_batch_matches_single_query_search_on_a_compressed_codec(self):
+        saved = main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS
+        main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS = "int8", 64
+        try:
+            queries = self._load()
+            main._join_vector_builds()
+            self.assertEqual(main._VECTOR_PARTITIONS[("u1", 32)].codec.name, "int8")
+            self._assert_matches_single_queries(queries, types=None)
+        finally:
+            main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS = saved
+
+    def test_zero_query_and_missing_user_return_empty_lists(self):
+        queries = self._load()
+
+        results = main._search_vectors_batch([[0.0] * 32, queries[0]], user_id="u1", types=None, limit=3)
+        self.assertEqual(results[0], [])
+        self.assertEqual(len(results[1]), 3)
+        self.assertEqual(
+            main._search_vectors_batch(queries[:2], user_id="nobody", types=None, limit=3), [[], []]
+        )
+
+    def test_rrf_rewards_results_shared_across_queries(self):
+        lists = [
+            [{"id": "a", "score": 0.9}, {"id": "b", "score": 0.8}, {"id": "c", "score": 0.7}],
+            [{"id": "b", "score": 0.95}, {"id": "c", "score": 0.5}],
+        ]
+
+        fused = main._rrf_fuse(lists, limit=2, k=60)
+
+        self.assertEqual([r["id"] for r in fused], ["b", "c"])
+        self.assertAlmostEqual(fused[0]["score"], 1 / 62 + 1 / 61)
+        self.assertEqual(fused[0]["id"], "b")
+
+
+class AsyncVectorStoreTestCase(unittest.IsolatedAsyncioTestCase):
+    setUp = VectorStoreTestCase.setUp
+    tearDown = VectorStoreTestCase.tearDown
+    _reset_store = VectorStoreTestCase._reset_store
+    _reload_store = VectorStoreTestCase._reload_store
+
+
+class TestSearchBatchEndpoint(AsyncVectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self._original_embed = main._hf_embed_texts
+        rng = np.random.default_rng(21)
+        self.vectors = {f"v{i}": rng.standard_normal(16).tolist() for i in range(40)}
+        main._upsert_vector_records([_item(i) for i in self.vectors], list(self.vectors.values()))
+        self.embed_calls = []
+
+        async def fake_embed(texts, config=None):
+            self.embed_calls.append(list(texts))
+            return [self.vectors[text] for text in texts]
+
+        main._hf_embed_texts = fake_embed
+
+    def tearDown(self):
+        main._hf_embed_texts = self._original_embed
+        super().tearDown()
+
+    async def test_queries_are_embedded_in_one_call(self):
+        req = main.SearchBatchRequest(userId="u1", queries=["v1", " v2 ", "v1", "", "v3"], limit=5, fuse=True)
+
+        response = await main.search_batch(req)
+
+        self.assertEqual(self.embed_calls, [["v1", "v2", "v3"]])
+        self.assertEqual([entry["query"] for entry in response["queries"]], ["v1", "v2", "v3"])
+        for entry in response["queries"]:
+            self.assertEqual(entry["results"][0]["id"], entry["query"])
+        self.assertEqual(len(response["fused"]), 5)
+        self.assertEqual({r["id"] for r in response["fused"][:3]}, {"v1", "v2", "v3"})
+
+    async def test_fused_list_is_optional_and_batch_size_is_capped(self):
+        response = await main.search_batch(main.SearchBatchRequest(userId="u1", queries=["v1"]))
+        self.assertNotIn("fused", response)
+
+        with self.assertRaises(main.HTTPException) as ctx:
+            await main.search_batch(
+                main.SearchBatchRequest(
+                    userId="u1", queries=[f"q{i}" for i in range(main.SEARCH_BATCH_MAX_QUERIES + 1)]
+                )
+            )
+        self.assertEqual(ctx.exception.status_code, 400)
+        with self.assertRaises(main.HTTPException):
+            await main.search_batch(main.SearchBatchRequest(userId="u1", queries=["  "]))
+
+
+class TestResultFields(AsyncVectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self._saved_embed = main._hf_embed_texts
+        self._saved_documents = main._with_documents
+        rng = np.random.default_rng(23)
+        self.vectors = {f"f{i}": rng.standard_normal(8).tolist() for i in range(20)}
+        items = [_item(i, text=f"a long document body for {i}", tag=i) for i in self.vectors]
+        main._upsert_vector_records(items, list(self.vectors.values()))
+        main._persist_vector_store()
+        self._reload_store()
+        self.document_reads = 0
+
+        async def fake_embed(texts, config=None):
+            return [self.vectors[text] for text in texts]
+
+        def counting_documents(records):
+            self.document_reads += 1
+            return self._saved_documents(records)
+
+        main._hf_embed_texts = fake_embed
+        main._with_documents = counting_documents
+
+    def tearDown(self):
+        main._hf_embed_texts = self._saved_embed
+        main._with_documents = self._saved_documents
+        super().tearDown()
+
+    async def test_ids_and_scores_only_skip_document_reads(self):
+        full = (await main.search(main.SearchRequest(userId="u1", query="f0", limit=5)))["results"]
+        self.assertEqual(self.document_reads, 1)
+
+        bare = (await main.search(main.SearchRequest(userId="u1", query="f0", limit=5, fields=[])))["results"]
+        similar = await main.similar(main.SimilarRequest(userId="u1", sourceId="f0", limit=5, fields=["id"]))
+
+        self.assertEqual(self.document_reads, 1)
+        self.assertEqual(bare, [{"id": r["id"], "score": r["score"]} for r in full])
+        self.assertEqual([set(r) for r in similar["results"]], [{"id", "score"}] * 5)
+
+    async def test_snippet_and_selected_fields(self):
+        request = main.SearchRequest(userId="u1", query="f3", limit=3, fields=["document", "objectId"], snippet=6)
+        results = (await main.search(request))["results"]
+
+        expected = {"id": "f3", "objectId": "obj-f3", "document": "a long", "score": results[0]["score"]}
+        self.assertEqual(results[0], expected)
+        page = await main.search(
+            main.SearchRequest(userId="u1", query="f3", limit=2, paginate=True, fields=["embedding", "metadata"])
+        )
+        self.assertEqual(page["results"][0]["metadata"], {"tag": "f3"})
+        self.assertEqual(len(page["results"][0]["embedding"]), 8)
+        self.assertNotIn("document", page["results"][0])
+
+    async def test_get_projects_and_drops_embeddings(self):
+        full = (await main.embed_get(main.EmbedGetRequest(ids=["f1"])))["results"][0]
+        request = main.EmbedGetRequest(ids=["f1", "nope"], fields=["objectId", "userId"])
+        slim = (await main.embed_get(request))["results"]
+
+        self.assertEqual(len(full["embedding"]), 8)
+        self.assertEqual(full["document"], "a long document body for f1")
+        self.assertEqual(slim, [{"id": "f1", "objectId": "obj-f1", "userId": "u1"}])
+        self.assertEqual(self.document_reads, 1)
+
+    async def test_unknown_fields_are_rejected(self):
+        for call in (
+            main.search(main.SearchRequest(userId="u1", query="f0", fields=["text"])),
+            main.similar(main.SimilarRequest(userId="u1", sourceId="f0", fields=["vector"])),
+            main.embed_get(main.EmbedGetRequest(ids=["f0"], fields=["bogus"])),
+        ):
+            with self.assertRaises(main.HTTPException) as ctx:
+                await call
+            self.assertEqual(ctx.exception.status_code, 400)
+
+
+class TestSimilarEndpoint(AsyncVectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vectors = {
+            "x": [1.0, 0.0, 0.0],
+            "y": [0.0, 1.0, 0.0],
+            "near-x": [0.9, 0.1, 0.3],
+            "near-y": [0.1, 0.9, 0.3],
+            "between": [0.7, 0.7, 0.1],
+            "far": [0.0, 0.1, 1.0],
+        }
+        main._upsert_vector_records([_item(i) for i in self.vectors], list(self.vectors.values()))
+        main._upsert_vector_records([_item("foreign", user_id="u2")], [[1.0, 1.0, 0.0]])
+
+    async def _similar(self, **kwargs):
+        return await main.similar(main.SimilarRequest(userId="u1", limit=10, **kwargs))
+
+    async def test_single_source_excludes_itself(self):
+        response = await self._similar(sourceId="x")
+
+        self.assertTrue(response["source_found"])
+        self.assertEqual(response["results"][0]["id"], "near-x")
+        self.assertNotIn("x", [r["id"] for r in response["results"]])
+
+    async def test_centroid_scans_the_mean_of_the_sources(self):
+        response = await self._similar(sourceIds=["x", "y"])
+
+        ids = [r["id"] for r in response["results"]]
+        self.assertEqual(response["sources_found"], ["x", "y"])
+        self.assertEqual(ids[0], "between")
+        self.assertFalse({"x", "y"} & set(ids))
+        self.assertAlmostEqual(
+            response["results"][0]["score"], _cosine([0.5, 0.5, 0.0], self.vectors["between"]), places=5
+        )
+
+    async def test_union_scores_each_record_by_its_best_source(self):
+        response = await self._similar(sourceIds=["x", "y"], mode="union")
+
+        expected = {
+            record_id: max(_cosine(self.vectors["x"], v), _cosine(self.vectors["y"], v))
+            for record_id, v in self.vectors.items()
+            if record_id not in ("x", "y")
+        }
+        expected = sorted((pair for pair in expected.items() if pair[1] > 0), key=lambda p: p[1], reverse=True)
+        self.assertEqual([r["id"] for r in response["results"]], [record_id for record_id, _ in expected])
+        for result, (_, score) in zip(response["results"], expected):
+            self.assertAlmostEqual(result["score"], score, places=5)
+
+    async def test_sources_of_other_users_are_ignored(self):
+        response = await self._similar(sourceIds=["foreign"])
+        self.assertEqual(response, {"results": [], "source_found": False, "sources_found": []})
+
+        response = await self._similar(sourceId="x", sourceIds=["foreign", "missing"], mode="union")
+        self.assertEqual(response["sources_found"], ["x"])
+        self.assertNotIn("foreign", [r["id"] for r in response["results"]])
+
+    async def test_sources_are_required_and_capped(self):
+        with self.assertRaises(main.HTTPException):
+            await self._similar(sourceIds=[" "])
+        with self.assertRaises(main.HTTPException) as ctx:
+            await self._similar(sourceIds=[f"s{i}" for i in range(main.SIMILAR_MAX_SOURCES + 1)])
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+class TestSearchCursor(AsyncVectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self._saved = {
+            name: getattr(main, name)
+            for name in ("_hf_embed_texts", "VECTOR_CODEC", "VECTOR_CODEC_MIN_ROWS", "VECTOR_RESCORE_FACTOR")
+        }
+        rng = np.random.default_rng(17)
+        self.vectors = {f"v{i}": rng.standard_normal(16).tolist() for i in range(300)}
+        self.queries = {"q": rng.standard_normal(16).tolist()}
+        self.embed_calls = 0
+
+        async def fake_embed(texts, config=None):
+            self.embed_calls += 1
+            return [self.queries[text] for text in texts]
+
+        main._hf_embed_texts = fake_embed
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(main, name, value)
+        main._SEARCH_CURSORS.clear()
+        super().tearDown()
+
+    def _load(self):
+        main._upsert_vector_records([_item(i) for i in self.vectors], list(self.vectors.values()))
+
+    def _expected(self, query):
+        ranked = sorted(
+            ((record_id, _cosine(query, vector)) for record_id, vector in self.vectors.items()),
+            key=lambda pair: (-pair[1], pair[0]),
+        )
+        return [record_id for record_id, score in ranked if score > 0]
+
+    async def _pages(self, **kwargs):
+        ids, versions = [], set()
+        response = await main.search(main.SearchRequest(userId="u1", query="q", limit=50, paginate=True, **kwargs))
+        while True:
+            ids.extend(r["id"] for r in response["results"])
+            versions.add(response["version"])
+            if response["next_cursor"] is None:
+                return ids, versions
+            response = await main.search(
+                main.SearchRequest(userId="u1", query="q", limit=50, cursor=response["next_cursor"], **kwargs)
+            )
+
+    async def test_pages_walk_the_whole_ranking_with_one_embedding(self):
+        self._load()
+
+        ids, versions = await self._pages()
+
+        self.assertEqual(ids, self._expected(self.queries["q"]))
+        self.assertGreater(len(ids), 50)
+        self.assertEqual(self.embed_calls, 1)
+        self.assertEqual(len(versions), 1)
+
+    async def test_lossy_codec_pages_are_rescored(self):
+        main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS, main.VECTOR_RESCORE_FACTOR = "int8", 64, None
+        self._load()
+        main._join_vector_builds()
+
+        ids, _ = await self._pages()
+
+        self.assertEqual(ids, self._expected(self.queries["q"]))
+
+    async def test_later_pages_read_the_snapshot_of_the_first(self):
+        self._load()
+        expected = self._expected(self.queries["q"])
+        first = await main.search(main.SearchRequest(userId="u1", query="q", limit=10, paginate=True))
+
+        main._upsert_vector_records([_item("new")], [self.queries["q"]])
+        main._delete_vector_records([expected[12]])
+        second = await main.search(main.SearchRequest(userId="u1", query="q", limit=10, cursor=first["next_cursor"]))
+
+        self.assertEqual(second["version"], first["version"])
+        self.assertEqual([r["id"] for r in second["results"]], expected[10:12] + expected[13:21])
+
+    async def test_expired_cursor_resumes_from_its_watermark(self):
+        self._load()
+        expected = self._expected(self.queries["q"])
+        first = await main.search(main.SearchRequest(userId="u1", query="q", limit=20, paginate=True))
+        main._SEARCH_CURSORS.clear()
+
+        second = await main.search(main.SearchRequest(userId="u1", query="q", limit=20, cursor=first["next_cursor"]))
+
+        self.assertEqual([r["id"] for r in second["results"]], expected[20:40])
+        self.assertEqual(self.embed_calls, 2)
+
+    async def test_cursor_is_bound_to_its_request(self):
+        self._load()
+        first = await main.search(main.SearchRequest(userId="u1", query="q", limit=5, paginate=True))
+
+        for req in (
+            main.SearchRequest(userId="u1", query="q", types=["article"], cursor=first["next_cursor"]),
+            main.SearchRequest(userId="u2", query="q", cursor=first["next_cursor"]),
+            main.SearchRequest(userId="u1", query="q", cursor="not-a-cursor"),
+        ):
+            with self.assertRaises(main.HTTPException) as ctx:
+                await main.search(req)
+            self.assertEqual(ctx.exception.status_code, 400)
+
+    async def test_mmr_cannot_be_paged(self):
+        self._load()
+
+        with self.assertRaises(main.HTTPException) as ctx:
+            await main.search(main.SearchRequest(userId="u1", query="q", mmrLambda=0.5, paginate=True))
+        self.assertEqual(ctx.exception.status_code, 400)
+
+    async def test_stream_emits_ndjson_past_the_page_cap(self):
+        self._load()
+
+        response = await main.search(main.SearchRequest(userId="u1", query="q", limit=120, stream=True))
+        body = b"".join([chunk if isinstance(chunk, bytes) else chunk.encode() async for chunk in response.body_iterator])
+
+        lines = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(response.media_type, "application/x-ndjson")
+        self.assertEqual([line["id"] for line in lines], self._expected(self.queries["q"])[:120])
+
+    async def test_similar_union_pages_match_the_union_ranking(self):
+        self._load()
+        expected = main._search_vectors_union(
+            [self.vectors["v1"], self.vectors["v2"]],
+            user_id="u1",
+            types=None,
+            limit=300,
+            exclude_ids=("v1", "v2"),
+        )
+        ids = []
+        req = main.SimilarRequest(userId="u1", sourceIds=["v1", "v2"], mode="union", limit=40, paginate=True)
+        while True:
+            response = await main.similar(req)
+            ids.extend(r["id"] for r in response["results"])
+            if response["next_cursor"] is None:
+                break
+            req = req.model_copy(update={"cursor": response["next_cursor"]})
+
+        self.assertEqual(ids, [r["id"] for r in expected])
+
+
+class TestSearchDiversity(VectorStoreTestCase):
+    def _load_random(self, count=200, dim=16, seed=23):
+        rng = np.random.default_rng(seed)
+        vectors = {f"v{i}": rng.standard_normal(dim).tolist() for i in range(count)}
+        main._upsert_vector_records([_item(i) for i in vectors], list(vectors.values()))
+        return vectors, rng.standard_normal(dim).tolist()
+
+    def test_min_score_is_a_floor_on_exact_scores(self):
+        for codec in ("float32", "int8"):
+            with self.subTest(codec=codec):
+                self._reset_store()
+                saved = main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS
+                main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS = codec, 64
+                try:
+                    vectors, query = self._load_random()
+                    main._join_vector_builds()
+                    results = main._search_vectors(query, user_id="u1", types=None, limit=50, min_score=0.3)
+                finally:
+                    main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS = saved
+
+                expected = sorted(
+                    (pair for pair in ((i, _cosine(query, v)) for i, v in vectors.items()) if pair[1] >= 0.3),
+                    key=lambda pair: pair[1],
+                    reverse=True,
+                )
+                self.assertEqual([r["id"] for r in results], [i for i, _ in expected][:50])
+
+    def test_mmr_spreads_results_across_near_duplicates(self):
+        vectors = {
+            "dup1": [1.0, 0.0, 0.0],
+            "dup2": [0.99, 0.01, 0.0],
+            "dup3": [0.98, 0.02, 0.0],
+            "side": [0.6, 0.0, 0.8],
+            "other": [0.6, 0.8, 0.0],
+        }
+        main._upsert_vector_records([_item(i) for i in vectors], list(vectors.values()))
+
+        plain = main._search_vectors([1.0, 0.0, 0.0], user_id="u1", types=None, limit=3)
+        relevance_only = main._search_vectors([1.0, 0.0, 0.0], user_id="u1", types=None, limit=3, mmr_lambda=1.0)
+        diverse = main._search_vectors([1.0, 0.0, 0.0], user_id="u1", types=None, limit=3, mmr_lambda=0.3)
+
+        self.assertEqual([r["id"] for r in plain], ["dup1", "dup2", "dup3"])
+        self.assertEqual([r["id"] for r in relevance_only], ["dup1", "dup2", "dup3"])
+        self.assertEqual([r["id"] for r in diverse], ["dup1", "side", "other"])
+        self.assertAlmostEqual(diverse[1]["score"], 0.6, places=5)
+
+    def test_mmr_matches_the_greedy_definition(self):
+        vectors, query = self._load_random()
+        candidates = main._search_vectors(query, user_id="u1", types=None, limit=10 * main.SEARCH_MMR_FETCH_FACTOR)
+
+        results = main._search_vectors(query, user_id="u1", types=None, limit=10, mmr_lambda=0.7)
+
+        picked = []
+        pool = [(r["id"], r["score"]) for r in candidates]
+        while len(picked) < 10:
+            def gain(pair):
+                closest = max((_cosine(vectors[pair[0]], vectors[p]) for p in picked), default=0.0)
+                return 0.7 * pair[1] - 0.3 * max(closest, 0.0)
+
+            best = max((pair for pair in pool if pair[0] not in picked), key=gain)
+            picked.append(best[0])
+        self.assertEqual([r["id"] for r in results], picked)
+
+
+class TestGroupedSearch(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(41)
+        self.vectors = {}
+        items = []
+        for n in range(40):
+            object_type = "article" if n % 2 else "highlight"
+            for chunk in range(1 + n % 4):
+                record_id = f"{object_type}-{n}-{chunk}"
+                self.vectors[record_id] = rng.standard_normal(16).tolist()
+                items.append(
+                    main.EmbeddingUpsertItem(
+                        id=record_id,
+                        userId="u1",
+                        objectType=object_type,
+                        objectId=f"obj-{n}",
+                        subId=str(chunk),
+                        text=f"text for {record_id}",
+                    )
+                )
+        main._upsert_vector_records(items, [self.vectors[item.id] for item in items])
+        self.query = rng.standard_normal(16).tolist()
+
+    def _reference(self, collapse, quotas=None, limit=12, min_score=0.0):
+        groups = {}
+        for record_id, vector in self.vectors.items():
+            score = _cosine(self.query, vector)
+            if score <= 0 or score < min_score:
+                continue
+            object_type, n, _ = record_id.split("-")
+            key = (object_type, n) if collapse else record_id
+            best, hits = groups.get(key, ((score, record_id), 0))
+            groups[key] = (max(best, (score, record_id)), hits + 1)
+        ranked = sorted(groups.values(), key=lambda group: group[0][0], reverse=True)
+        taken, out = {}, []
+        for (score, record_id), hits in ranked:
+            object_type = record_id.split("-")[0]
+            if quotas is not None:
+                if taken.get(object_type, 0) >= quotas.get(object_type, 0):
+                    continue
+                taken[object_type] = taken.get(object_type, 0) + 1
+            out.append((record_id, hits))
+        return out[:limit]
+
+    def _search(self, **kwargs):
+        return main._search_vectors(self.query, user_id="u1", types=None, limit=kwargs.pop("limit", 12), **kwargs)
+
+    def test_collapse_keeps_the_best_chunk_and_counts_hits(self):
+        results = self._search(collapse=True, min_score=0.1)
+
+        self.assertEqual([(r["id"], r["hits"]) for r in results], self._reference(True, min_score=0.1))
+        self.assertEqual(len({r["objectId"] for r in results}), len(results))
+
+    def test_quotas_cap_each_type_in_one_scan(self):
+        quotas = {"article": 3, "highlight": 5}
+
+        plain = self._search(quotas=quotas, limit=8)
+        collapsed = self._search(quotas=quotas, collapse=True, limit=8)
+
+        self.assertEqual([(r["id"], 1) for r in plain], self._reference(False, quotas, limit=8))
+        self.assertNotIn("hits", plain[0])
+        self.assertEqual([(r["id"], r["hits"]) for r in collapsed], self._reference(True, quotas, limit=8))
+        self.assertEqual(sum(r["objectType"] == "article" for r in collapsed), 3)
+
+    def test_quotas_hold_across_partitions(self):
+        rng = np.random.default_rng(5)
+        others = [
+            main.EmbeddingUpsertItem(id=f"u2-{i}", userId="u2", objectType="Article", objectId=f"o{i}", text="x")
+            for i in range(20)
+        ]
+        nearby = np.asarray(self.query) + 0.1 * rng.standard_normal((len(others), 16))
+        main._upsert_vector_records(others, nearby.tolist())
+
+        quotas = {"article": 2, "highlight": 4}
+        results = main._search_vectors(self.query, user_id="", types=None, limit=6, quotas=quotas)
+
+        self.assertEqual([r["id"] for r in results[:2]], ["u2-" + r["id"].split("-")[1] for r in results[:2]])
+        self.assertEqual(sum(r["objectType"].lower() == "article" for r in results), 2)
+        self.assertEqual(sum(r["objectType"] == "highlight" for r in results), 4)
+
+    def test_lossy_codec_returns_exact_scores(self):
+        saved = main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS
+        main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS = "int8", 16
+        try:
+            main._upsert_vector_records([_item("late")], [self.vectors["article-1-0"]])
+            main._join_vector_builds()
+            self.assertTrue(main._VECTOR_PARTITIONS[("u1", 16)].codec.lossy)
+            results = self._search(collapse=True)
+        finally:
+            main.VECTOR_CODEC, main.VECTOR_CODEC_MIN_ROWS = saved
+
+        for result in results:
+            vector = self.vectors.get(result["id"], self.vectors["article-1-0"])
+            self.assertAlmostEqual(result["score"], _cosine(self.query, vector), places=5)
+
+
+class TestGroupedSearchEndpoint(AsyncVectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self._original_embed = main._hf_embed_texts
+        rng = np.random.default_rng(43)
+        self.vectors = {f"v{i}": rng.standard_normal(16).tolist() for i in range(20)}
+        main._upsert_vector_records([_item(i) for i in self.vectors], list(self.vectors.values()))
+
+        async def fake_embed(texts, config=None):
+            return [self.vectors[text] for text in texts]
+
+        main._hf_embed_texts = fake_embed
+
+    def tearDown(self):
+        main._hf_embed_texts = self._original_embed
+        super().tearDown()
+
+    async def test_grouped_options_on_search(self):
+        response = await main.search(main.SearchRequest(userId="u1", query="v0", quotas={"Highlight": 3}, limit=10))
+        self.assertEqual([r["id"] for r in response["results"]][:1], ["v0"])
+        self.assertEqual(len(response["results"]), 3)
+
+        for options in (
+            {"collapse": True, "paginate": True},
+            {"collapse": True, "stream": True},
+            {"collapse": True, "mmrLambda": 0.5},
+            {"collapse": True, "mode": "lexical"},
+            {"quotas": {}},
+            {"quotas": {"highlight": 0}},
+        ):
+            with self.subTest(options=options):
+                with self.assertRaises(main.HTTPException) as ctx:
+                    await main.search(main.SearchRequest(userId="u1", query="v0", **options))
+                self.assertEqual(ctx.exception.status_code, 400)
+
+
+class TestVectorFilters(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        main._upsert_vector_records(
+            [
+                _item("h1", object_type="highlight", articleId="a1", tags=["ml", "memory"]),
+                _item("h2", object_type="highlight", articleId="a2", tags=["ml"], title="Two"),
+                _item("h3", object_type="highlight", articleId="a1", tags=[]),
+                _item("art", object_type="article", articleId="a1", title="Article"),
+            ],
+            [[1.0, 0.0], [0.9, 0.1], [0.8, 0.2], [0.7, 0.3]],
+        )
+
+    def _ids(self, filter_expr, **kwargs):
+        results = main._search_vectors(
+            [1.0, 0.0], user_id="u1", types=kwargs.pop("types", None), limit=10,
+            filter_expr=filter_expr, **kwargs,
+        )
+        return [r["id"] for r in results]
+
+    def test_indexed_metadata_equality_and_membership(self):
+        self.assertEqual(self._ids({"metadata.articleId": "a1"}), ["h1", "h3", "art"])
+        self.assertEqual(self._ids({"metadata.tags": "ml"}), ["h1", "h2"])
+        self.assertEqual(self._ids({"metadata.tags": {"$in": ["memory", "none"]}}), ["h1"])
+        self.assertEqual(self._ids({"metadata.articleId": {"$ne": "a1"}}), ["h2"])
+
+    def test_type_filter_combines_with_expression(self):
+        self.assertEqual(
+            self._ids({"metadata.articleId": "a1"}, types=["HIGHLIGHT"]), ["h1", "h3"]
+        )
+        self.assertEqual(self._ids({"objectType": "Article"}), ["art"])
+
+    def test_residual_and_or_predicates(self):
+        self.assertEqual(self._ids({"metadata.title": {"$exists": True}}), ["h2", "art"])
+        self.assertEqual(
+            self._ids({"$or": [{"metadata.title": "Two"}, {"objectType": "article"}]}),
+            ["h2", "art"],
+        )
+        self.assertEqual(
+            self._ids({"metadata.articleId": "a1", "objectId": {"$nin": ["obj-h1"]}}),
+            ["h3", "art"],
+        )
+
+    def test_updated_at_range_uses_column(self):
+        main._VECTOR_STORE["h2"].updatedAtMs = 10
+        main._index_vector_record(main._VECTOR_STORE["h2"])
+        self.assertEqual(self._ids({"updatedAtMs": {"$lte": 10}}), ["h2"])
+        self.assertEqual(self._ids({"updatedAtMs": {"$gt": 10}}), ["h1", "h3", "art"])
+
+    def test_filter_survives_delete_row_moves(self):
+        main._delete_vector_records(["h1"])
+        self.assertEqual(self._ids({"metadata.articleId": "a1"}), ["h3", "art"])
+        self.assertEqual(self._ids({"metadata.tags": "ml"}), ["h2"])
+
+    def test_exclude_id_inside_filtered_rows(self):
+        self.assertEqual(self._ids({"metadata.articleId": "a1"}, exclude_id="h3"), ["h1", "art"])
+        self.assertEqual(self._ids({"metadata.articleId": "a1"}, exclude_ids=("h1", "art", "h2")), ["h3"])
+
+    def test_invalid_filters_are_rejected(self):
+        for bad in ([1], {"userId": "u2"}, {"objectType": {"$regex": "x"}}, {"$or": []}):
+            with self.assertRaises(main.HTTPException) as ctx:
+                main._compile_vector_filter(bad)
+            self.assertEqual(ctx.exception.status_code, 400)
+
+    def test_non_scalar_operands_are_rejected_on_any_key(self):
+        for key in ("metadata.tags", "metadata.title"):
+            for operand in (["ml"], {"x": 1}, {"$in": [{"a": 1}]}, {"$ne": ["ml"]}, {"$nin": [["ml"]]}):
+                with self.subTest(key=key, operand=operand):
+                    with self.assertRaises(main.HTTPException) as ctx:
+                        self._ids({key: operand})
+                    self.assertEqual(ctx.exception.status_code, 400)
+        self.assertEqual(self._ids({"metadata.tags": {"$in": ["ml", None]}}), ["h1", "h2"])
+
+
+class TestVectorCodecs(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self._saved = {
+            name: getattr(main, name)
+            for name in ("VECTOR_CODEC", "VECTOR_CODEC_MIN_ROWS", "VECTOR_RESCORE_FACTOR")
+        }
+        main.VECTOR_CODEC_MIN_ROWS = 64
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(main, name, value)
+        super().tearDown()
+
+    def _load(self, codec, count=300, dim=32):
+        main.VECTOR_CODEC = codec
+        rng = np.random.default_rng(5)
+        vectors = rng.standard_normal((count, dim))
+        ids = [f"v{i}" for i in range(count)]
+        main._upsert_vector_records([_item(i) for i in ids], [v.tolist() for v in vectors])
+        main._join_vector_builds()
+        return main._VECTOR_PARTITIONS[("u1", dim)], vectors, rng.standard_normal((10, dim))
+
+    def test_codecs_shrink_the_scan_matrix(self):
+        expected = {
+            "float32": (np.float32, 32),
+            "float16": (np.float16, 32),
+            "int8": (np.uint8, 32),
+            "pq": (np.uint8, 4),
+            "sign": (np.uint8, 8),
+        }
+        for codec, (dtype, width) in expected.items():
+            with self.subTest(codec=codec):
+                self._reset_store()
+                partition, _, _ = self._load(codec)
+                self.assertEqual(partition.codec.name, codec)
+                self.assertEqual(partition.vectors.dtype, dtype)
+                self.assertEqual(partition.vectors.shape[1], width)
+
+    def test_small_partitions_stay_float32(self):
+        partition, _, _ = self._load("int8", count=20)
+
+        self.assertEqual(partition.codec.name, "float32")
+
+    def test_rescoring_returns_exact_scores(self):
+        for codec in ("float16", "int8", "pq", "sign"):
+            with self.subTest(codec=codec):
+                self._reset_store()
+                main.VECTOR_RESCORE_FACTOR = None
+                partition, vectors, queries = self._load(codec)
+                main.VECTOR_RESCORE_FACTOR = 1000
+                for query in queries:
+                    results = main._search_vectors(query.tolist(), user_id="u1", types=None, limit=5)
+                    expected = sorted(
+                        ((f"v{i}", _cosine(query, v)) for i, v in enumerate(vectors)),
+                        key=lambda pair: pair[1],
+                        reverse=True,
+                    )[:5]
+                    self.assertEqual([r["id"] for r in results], [pair[0] for pair in expected])
+                    for result, (_, score) in zip(results, expected):
+                        self.assertAlmostEqual(result["score"], score, places=5)
+
+    def test_compressed_scores_approximate_cosine(self):
+        main.VECTOR_RESCORE_FACTOR = 0
+        partition, vectors, queries = self._load("int8")
+        query = main._unit_vector(queries[0])
+
+        approx = partition.codec.scores(partition.vectors[: partition.size], query)
+        exact = main._unit_rows(np.asarray(vectors, dtype=np.float32)) @ query
+
+        self.assertLess(float(np.abs(approx - exact).max()), 0.02)
+
+    def test_sign_sketch_ranks_by_hamming_distance(self):
+        partition, _, queries = self._load("sign")
+        codec = partition.codec
+        query = main._unit_vector(queries[0])
+
+        scores = codec.scores(partition.vectors[: partition.size], query)
+
+        bits = np.unpackbits(partition.vectors[: partition.size], axis=1)[:, :32]
+        query_bits = query > codec.center
+        hamming = (bits.astype(bool) != query_bits).sum(axis=1)
+        self.assertTrue(np.allclose(scores, 1.0 - 2.0 * hamming / 32))
+
+    def test_sign_sketch_prefilter_survives_a_shared_offset(self):
+        main.VECTOR_CODEC = "sign"
+        rng = np.random.default_rng(11)
+        vectors = 5.0 + rng.standard_normal((400, 32))
+        main._upsert_vector_records([_item(f"v{i}") for i in range(400)], [v.tolist() for v in vectors])
+        main._join_vector_builds()
+        query = vectors[7] + 0.01 * rng.standard_normal(32)
+
+        results = main._search_vectors(query.tolist(), user_id="u1", types=None, limit=1)
+
+        self.assertEqual(results[0]["id"], "v7")
+
+    def test_codec_retrains_after_growth(self):
+        partition, _, _ = self._load("int8", count=100)
+        trained = partition.codec.trained_rows
+        main._upsert_vector_records(
+            [_item(f"w{i}") for i in range(4 * trained)],
+            np.random.default_rng(9).standard_normal((4 * trained, 32)).tolist(),
+        )
+        main._join_vector_builds()
+
+        partition = main._VECTOR_PARTITIONS[("u1", 32)]
+        self.assertGreaterEqual(partition.codec.trained_rows, 4 * trained)
+        decoded = partition.row_vectors(slice(0, partition.size))
+        error = np.abs(decoded - partition.full_precision(np.arange(partition.size)))
+        self.assertLess(float(error.mean()), 0.005)
+
+    def test_writes_during_codec_training_are_encoded_with_the_new_codec(self):
+        rng = np.random.default_rng(13)
+        original = main._VectorPartition.train_codec
+
+        def train_with_writes(partition, wanted):
+            main._delete_vector_records([f"v{i}" for i in range(0, 300, 4)])
+            main._upsert_vector_records(
+                [_item(f"v{i}") for i in range(1, 41)] + [_item(f"w{i}") for i in range(20)],
+                rng.standard_normal((60, 32)).tolist(),
+            )
+            return original(partition, wanted)
+
+        main._VectorPartition.train_codec = train_with_writes
+        try:
+            partition, _, _ = self._load("int8")
+        finally:
+            main._VectorPartition.train_codec = original
+
+        self.assertEqual((partition.codec.name, partition.size), ("int8", 255))
+        self.assertIsNone(partition.codec_touched)
+        expected = partition.codec.encode(partition.full_precision(np.arange(partition.size)))
+        self.assertTrue(np.array_equal(partition.vectors[: partition.size], expected))
+
+    def test_chunked_codecs_must_score_chunks(self):
+        with self.assertRaises(TypeError):
+            main._ChunkedCodec(8)
+
+
+if __name__ == "__main__":
+    unittest.main()
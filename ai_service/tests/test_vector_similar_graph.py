@@ -0,0 +1,170 @@
+import unittest
+
+import numpy as np
+
+from ai_service import main
+from ai_service.tests.test_vector_search import AsyncVectorStoreTestCase, _item
+
+
+class SimilarGraphTestCase(AsyncVectorStoreTestCase):
+    def setUp(self):
+        self._saved = {
+            name: getattr(main, name) for name in ("SIMILAR_GRAPH_K", "VECTOR_CODEC", "VECTOR_CODEC_MIN_ROWS")
+        }
+        main.SIMILAR_GRAPH_K = 12
+        super().setUp()
+        self.rng = np.random.default_rng(17)
+        self.ids = [f"r{i}" for i in range(60)]
+        self._upsert(self.ids)
+
+    def tearDown(self):
+        super().tearDown()
+        for name, value in self._saved.items():
+            setattr(main, name, value)
+
+    def _upsert(self, ids, **kwargs):
+        vectors = self.rng.standard_normal((len(ids), 12))
+        main._upsert_vector_records([_item(i, **kwargs) for i in ids], vectors.tolist())
+
+    def _partition(self):
+        return main._VECTOR_PARTITIONS[("u1", 12)]
+
+    def _scan(self, source_id, limit):
+        vector = main._VECTOR_STORE[source_id].embedding
+        return main._search_vectors(vector, user_id="u1", types=None, limit=limit, exclude_id=source_id)
+
+    async def _similar(self, source_id, **kwargs):
+        return (await main.similar(main.SimilarRequest(userId="u1", sourceId=source_id, **kwargs)))["results"]
+
+    def _assert_matches_scan(self, source_id, limit):
+        graph = self._partition().knn.neighbors(source_id, limit)
+        scan = self._scan(source_id, limit)
+        self.assertEqual([i for _, i in graph], [r["id"] for r in scan])
+        for (score, _), result in zip(graph, scan):
+            self.assertAlmostEqual(score, result["score"], places=5)
+
+
+class TestNeighborGraph(SimilarGraphTestCase):
+    async def test_similar_fills_then_reads_the_graph(self):
+        first = await self._similar("r0", limit=5)
+
+        graph = self._partition().knn
+        self.assertIn("r0", graph.lists)
+        self.assertEqual([r["id"] for r in first], [r["id"] for r in self._scan("r0", 5)])
+
+        calls = []
+        original = main._VectorPartition.search
+        main._VectorPartition.search = lambda *a, **kw: calls.append(a) or original(*a, **kw)
+        try:
+            second = await self._similar("r0", limit=5, minScore=first[2]["score"])
+        finally:
+            main._VectorPartition.search = original
+        self.assertEqual(calls, [])
+        self.assertEqual([r["id"] for r in second], [r["id"] for r in first[:3]])
+
+    async def test_lists_stay_exact_under_writes(self):
+        await self._check_writes(self.ids[:20])
+
+    async def test_few_lists_stay_exact_under_writes(self):
+        await self._check_writes(self.ids[10:14] + self.ids[40:42])
+
+    async def _check_writes(self, sources):
+        for source_id in sources:
+            await self._similar(source_id)
+
+        for step in range(6):
+            self._upsert([f"new{step}-{i}" for i in range(5)])
+            self._upsert([self.ids[20 + step], self.ids[step]])
+            main._delete_vector_records([self.ids[30 + step], self.ids[10 + step]])
+
+        partition = self._partition()
+        live = [i for i in sources if i in partition.rows]
+        self.assertTrue(any(i in partition.knn.lists for i in live))
+        for source_id in live:
+            entry = partition.knn.lists.get(source_id)
+            if entry is None:
+                continue
+            with self.subTest(source=source_id):
+                self._assert_matches_scan(source_id, len(entry[0]))
+        for record_id, sources in partition.knn.holders.items():
+            for source_id in sources:
+                if source_id in partition.knn.lists:
+                    self.assertIn(record_id, partition.knn.lists[source_id][0])
+
+    async def test_short_lists_are_refilled(self):
+        await self._similar("r0")
+        neighbors = self._partition().knn.lists["r0"][0]
+        main._delete_vector_records(list(neighbors[:3]))
+        self.assertEqual(len(self._partition().knn.lists["r0"][0]), 9)
+        self._assert_matches_scan("r0", 9)
+
+        results = await self._similar("r0", limit=12)
+
+        self.assertEqual([r["id"] for r in results], [r["id"] for r in self._scan("r0", 12)])
+        self.assertEqual(len(self._partition().knn.lists["r0"][0]), 12)
+        self.assertFalse(set(neighbors[:3]) & {r["id"] for r in results})
+
+    async def test_published_lists_are_untouched_by_later_writes(self):
+        await self._similar("r0")
+        old = self._partition()
+        before = old.knn.lists["r0"]
+
+        self._upsert(["r0"])
+        main._delete_vector_records(list(before[0][:2]))
+
+        self.assertIs(old.knn.lists["r0"], before)
+        self.assertTrue(all("r0" in old.knn.holders[i] for i in before[0]))
+        self.assertNotIn("r0", self._partition().knn.lists)
+        self.assertFalse(any("r0" in sources for sources in self._partition().knn.holders.values()))
+
+    async def test_fills_publish_a_new_version(self):
+        old = self._partition()
+
+        await self._similar("r0")
+
+        self.assertIsNone(old.knn)
+        self.assertIn("r0", self._partition().knn.lists)
+
+    async def test_fills_scan_exactly_past_the_ann_index(self):
+        saved = main.VECTOR_ANN_INDEX, main.VECTOR_ANN_MIN_ROWS
+        main.VECTOR_ANN_INDEX, main.VECTOR_ANN_MIN_ROWS = "hnsw", 1
+        original = main._VectorPartition._ann_rows
+        try:
+            self._upsert(["late"])
+            main._join_vector_builds()
+            self.assertTrue(self._partition().ann.ready)
+            main._VectorPartition._ann_rows = lambda partition, query, limit, rows: np.arange(4)
+            results = await self._similar("r0", limit=5)
+        finally:
+            main._VectorPartition._ann_rows = original
+            main.VECTOR_ANN_INDEX, main.VECTOR_ANN_MIN_ROWS = saved
+
+        ids = self.ids + ["late"]
+        vectors = np.stack([main._unit_vector(main._VECTOR_STORE[i].embedding) for i in ids])
+        order = np.argsort(-(vectors[1:] @ vectors[0]))[:5]
+        self.assertEqual([r["id"] for r in results], [ids[1:][pos] for pos in order])
+        self.assertEqual(len(self._partition().knn.lists["r0"][0]), main.SIMILAR_GRAPH_K)
+
+    async def test_filters_and_large_limits_scan(self):
+        await self._similar("r0", types=["highlight"])
+        await self._similar("r1", limit=20)
+        await self._similar("r2", filter={"objectType": "highlight"})
+
+        self.assertIsNone(self._partition().knn)
+
+    async def test_lossy_codec_drops_the_graph(self):
+        await self._similar("r0")
+        main.VECTOR_CODEC = "int8"
+        main.VECTOR_CODEC_MIN_ROWS = 1
+        self._upsert(["late"])
+        main._join_vector_builds()
+
+        self.assertTrue(self._partition().codec.lossy)
+        self.assertIsNone(self._partition().knn)
+        results = await self._similar("r0", limit=5)
+        self.assertEqual([r["id"] for r in results], [r["id"] for r in self._scan("r0", 5)])
+        self.assertIsNone(self._partition().knn)
+
+
+if __name__ == "__main__":
+    unittest.main()
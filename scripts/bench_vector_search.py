@@ -0,0 +1,924 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the ai_service in-process vector store.
+
+Runs entirely in memory against synthetic embeddings; no HF calls are made.
+
+    python scripts/bench_vector_search.py tenants
+    python scripts/bench_vector_search.py ann --corpus 20000
+    python scripts/bench_vector_search.py ann --index ivf --corpus 50000
+    python scripts/bench_vector_search.py codecs
+    python scripts/bench_vector_search.py store-memory
+    python scripts/bench_vector_search.py records
+    python scripts/bench_vector_search.py snapshots
+    python scripts/bench_vector_search.py batch
+    python scripts/bench_vector_search.py cursor
+    python scripts/bench_vector_search.py mmr
+    python scripts/bench_vector_search.py lexical
+    python scripts/bench_vector_search.py dedupe
+    python scripts/bench_vector_search.py cluster
+    python scripts/bench_vector_search.py similar-graph
+    python scripts/bench_vector_search.py grouped
+    python scripts/bench_vector_search.py chunks
+    python scripts/bench_vector_search.py fields
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault(
+    "AI_VECTOR_STORE_PATH",
+    os.path.join(tempfile.mkdtemp(prefix="bench_vectors_"), "vectors.bin"),
+)
+
+from ai_service import main as ai  # noqa: E402
+
+
+def _reset_store() -> None:
+    ai._join_vector_builds()
+    with ai._VECTOR_STORE_LOCK:
+        ai._VECTOR_STORE = {}
+        ai._VECTOR_DRAFT.clear()
+        ai._publish_vector_partitions({})
+        ai._CHUNK_FAMILIES.clear()
+        ai._VECTOR_STORE_LOADED = True
+
+
+def _add_tenant(user_id: str, count: int, dim: int, rng: np.random.Generator) -> None:
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    with ai._vector_write():
+        for i in range(count):
+            record_id = f"{user_id}:{i}"
+            record = ai._VectorRecord(
+                record_id,
+                user_id,
+                "highlight" if i % 3 else "article",
+                f"obj-{i}",
+                "",
+                0,
+                vectors[i],
+                text=f"synthetic record {i}",
+                metadata={},
+            )
+            ai._VECTOR_STORE[record_id] = record
+            ai._index_vector_record(record)
+
+
+def _time_search(user_id: str, dim: int, rng: np.random.Generator, repeats: int) -> float:
+    queries = rng.standard_normal((repeats, dim), dtype=np.float32)
+    start = time.perf_counter()
+    for query in queries:
+        ai._search_vectors(query.tolist(), user_id=user_id, types=None, limit=12)
+    return (time.perf_counter() - start) / repeats * 1000.0
+
+
+def bench_tenants(args: argparse.Namespace) -> None:
+    """Search latency for one tenant as unrelated tenants are added."""
+    rng = np.random.default_rng(args.seed)
+    _reset_store()
+    _add_tenant("caller", args.corpus, args.dim, rng)
+    added = 0
+    print(f"caller corpus={args.corpus} dim={args.dim}")
+    print(f"{'other tenants':>14} {'total vectors':>14} {'search ms':>10}")
+    for tenants in args.steps:
+        while added < tenants:
+            _add_tenant(f"tenant-{added}", args.corpus, args.dim, rng)
+            added += 1
+        ms = _time_search("caller", args.dim, rng, args.repeats)
+        print(f"{tenants:>14} {len(ai._VECTOR_STORE):>14} {ms:>10.3f}")
+
+
+def _clustered(count: int, dim: int, rng: np.random.Generator, clusters: int = 64) -> np.ndarray:
+    """Gaussian blobs around random centres; closer to real embeddings than iid noise."""
+    centres = rng.standard_normal((clusters, dim), dtype=np.float32)
+    labels = rng.integers(0, clusters, size=count)
+    return centres[labels] + 0.35 * rng.standard_normal((count, dim), dtype=np.float32)
+
+
+def _load_partition(user_id: str, vectors: np.ndarray) -> None:
+    with ai._VECTOR_STORE_LOCK:
+        for i, vector in enumerate(vectors):
+            record_id = f"{user_id}:{i}"
+            ai._VECTOR_STORE[record_id] = ai._VectorRecord(
+                record_id, user_id, "highlight", f"obj-{i}", "", 0, vector, text="", metadata={}
+            )
+        ai._rebuild_vector_partitions()
+    ai._join_vector_builds()
+
+
+def _run_queries(user_id: str, queries: np.ndarray, k: int):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        results.append([r["id"] for r in ai._search_vectors(query, user_id=user_id, types=None, limit=k)])
+    return results, (time.perf_counter() - start) / len(queries) * 1000.0
+
+
+def _recall(truth, found) -> float:
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return hits / max(sum(len(t) for t in truth), 1)
+
+
+def bench_ann(args: argparse.Namespace) -> None:
+    """Recall@k and latency of the ANN index against the exact scan."""
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered(args.corpus + args.repeats, args.dim, rng)
+    queries = vectors[args.corpus :]
+    _reset_store()
+    ai.VECTOR_ANN_INDEX = "none"
+    _load_partition("caller", vectors[: args.corpus])
+    truth, exact_ms = _run_queries("caller", queries, args.k)
+    print(f"corpus={args.corpus} dim={args.dim} k={args.k} queries={args.repeats}")
+    print(f"{'mode':>18} {'recall@k':>9} {'search ms':>10}")
+    print(f"{'exact':>18} {1.0:>9.3f} {exact_ms:>10.3f}")
+
+    ai.VECTOR_ANN_INDEX = args.index
+    ai.VECTOR_ANN_MIN_ROWS = 1
+    ai.VECTOR_HNSW_M = args.m
+    ai.VECTOR_HNSW_EF_CONSTRUCTION = args.ef_construction
+    start = time.perf_counter()
+    with ai._VECTOR_STORE_LOCK:
+        ai._rebuild_vector_partitions()
+    ai._join_vector_builds()
+    build_s = time.perf_counter() - start
+    if args.index == "hnsw":
+        print(f"hnsw M={args.m} ef_construction={args.ef_construction} build {build_s:.1f}s")
+        knob, values = "VECTOR_HNSW_EF_SEARCH", args.ef_search
+    else:
+        lists = len(ai._VECTOR_PARTITIONS[("caller", args.dim)].ann.lists)
+        print(f"ivf nlist={lists} build {build_s:.1f}s")
+        knob, values = "VECTOR_IVF_NPROBE", args.nprobe
+    for value in values:
+        setattr(ai, knob, value)
+        found, ms = _run_queries("caller", queries, args.k)
+        label = f"{args.index} {'ef' if args.index == 'hnsw' else 'nprobe'}={value}"
+        print(f"{label:>18} {_recall(truth, found):>9.3f} {ms:>10.3f}")
+
+
+def bench_codecs(args: argparse.Namespace) -> None:
+    """Matrix bytes per record, recall@k and latency for each storage codec."""
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered(args.corpus + args.repeats, args.dim, rng)
+    queries = vectors[args.corpus :]
+    ai.VECTOR_ANN_INDEX = "none"
+    ai.VECTOR_CODEC_MIN_ROWS = 1
+    print(f"corpus={args.corpus} dim={args.dim} k={args.k} queries={args.repeats}")
+    print(f"{'codec':>8} {'rescore':>8} {'bytes/rec':>10} {'build s':>8} {'recall@k':>9} {'search ms':>10}")
+    truth = None
+    for codec in args.codecs:
+        _reset_store()
+        ai.VECTOR_CODEC = codec
+        start = time.perf_counter()
+        _load_partition("caller", vectors[: args.corpus])
+        build_s = time.perf_counter() - start
+        partition = ai._VECTOR_PARTITIONS[("caller", args.dim)]
+        per_record = partition.vectors[: partition.size].nbytes / partition.size
+        for factor in ([0] if codec == "float32" else [0, *args.rescore]):
+            ai.VECTOR_RESCORE_FACTOR = factor
+            found, ms = _run_queries("caller", queries, args.k)
+            if truth is None:
+                truth = found
+            if factor is None:
+                factor = partition.codec.rescore_factor
+            print(
+                f"{codec:>8} {factor or '-':>8} {per_record:>10.0f} {build_s:>8.2f} "
+                f"{_recall(truth, found):>9.3f} {ms:>10.3f}"
+            )
+
+
+def bench_store_memory(args: argparse.Namespace) -> None:
+    """Python heap per record after boot, with documents lazy on disk vs resident."""
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered(args.corpus, args.dim, rng)
+    words = np.array(["vector", "store", "lazy", "offset", "column", "segment", "reader", "note"])
+    _reset_store()
+    with ai._VECTOR_STORE_LOCK:
+        for i, vector in enumerate(vectors):
+            record_id = f"caller:{i}"
+            ai._VECTOR_STORE[record_id] = ai._VectorRecord(
+                record_id,
+                "caller",
+                "highlight",
+                f"obj-{i}",
+                "",
+                i,
+                vector,
+                text=" ".join(rng.choice(words, size=args.words)),
+                metadata={"articleId": f"art-{i % 97}", "tags": ["a", "b"], "position": i},
+            )
+    ai._persist_vector_store()
+    print(f"corpus={args.corpus} dim={args.dim} words/text={args.words}")
+    print(f"{'documents':>10} {'heap MB':>9} {'bytes/rec':>10} {'get 12 ms':>10}")
+    for mode in ("lazy", "resident"):
+        with ai._VECTOR_STORE_LOCK:
+            ai._VECTOR_STORE = {}
+            ai._VECTOR_PARTITIONS.clear()
+            ai._VECTOR_STORE_LOADED = False
+        tracemalloc.start()
+        ai._load_vector_store_if_needed()
+        if mode == "resident":
+            with ai._VECTOR_STORE_LOCK:
+                ai._VECTOR_STORE = {r["id"]: r for r in ai._with_documents(list(ai._VECTOR_STORE.values()))}
+        heap = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        ids = [f"caller:{i}" for i in rng.integers(0, args.corpus, size=12)]
+        ai._get_vector_records(ids)
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            ai._get_vector_records(ids)
+        ms = (time.perf_counter() - start) / args.repeats * 1000.0
+        print(f"{mode:>10} {heap / 1e6:>9.1f} {heap / args.corpus:>10.0f} {ms:>10.3f}")
+
+
+def _traced_bytes(build) -> int:
+    tracemalloc.start()
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size
+
+
+def bench_records(args: argparse.Namespace) -> None:
+    """Heap per resident record: per-record dicts vs slotted records with interned strings."""
+    print(f"{'records':>9} {'dict B/rec':>11} {'slots B/rec':>12} {'saved':>7}")
+    for count in args.counts:
+        vectors = np.zeros((count, args.dim), dtype=np.float32)
+        documents = [
+            json.dumps(
+                {
+                    "id": f"rec-{i}",
+                    "userId": f"user-{i % args.tenants}",
+                    "objectType": "highlight" if i % 3 else "article",
+                    "objectId": f"obj-{i}",
+                    "subId": "",
+                    "updatedAtMs": 1700000000000 + i,
+                }
+            )
+            for i in range(count)
+        ]
+
+        def as_dicts():
+            store = {}
+            for i, doc in enumerate(documents):
+                record = json.loads(doc)
+                record.update(embedding=vectors[i], segment=None, segmentRow=i)
+                store[record["id"]] = record
+            return store
+
+        def as_slots():
+            store = {}
+            for i, doc in enumerate(documents):
+                record = ai._VectorRecord.from_document(json.loads(doc), vectors[i], segmentRow=i)
+                store[record.id] = record
+            return store
+
+        before = _traced_bytes(as_dicts) / count
+        after = _traced_bytes(as_slots) / count
+        print(f"{count:>9} {before:>11.0f} {after:>12.0f} {1 - after / before:>7.0%}")
+
+
+def bench_snapshots(args: argparse.Namespace) -> None:
+    """Search latency with and without a concurrent writer, and the cost of each kind of write."""
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered(args.corpus, args.dim, rng)
+    queries = _clustered(args.repeats, args.dim, rng)
+    ai.VECTOR_ANN_INDEX = "none"
+    _reset_store()
+    _load_partition("caller", vectors)
+
+    def item(record_id: str):
+        return ai.EmbeddingUpsertItem(id=record_id, userId="caller", objectType="note", objectId=record_id, text="w")
+    print(f"corpus={args.corpus} dim={args.dim} readers={args.readers}")
+    print(f"{'writer':>8} {'searches':>9} {'p50 ms':>8} {'p99 ms':>8} {'write ms':>9}")
+    for with_writer in (False, True):
+        latencies: list = []
+        write_ms: list = []
+        stop = threading.Event()
+
+        def read() -> None:
+            position = 0
+            while not stop.is_set():
+                started = time.perf_counter()
+                ai._search_vectors(queries[position % len(queries)], user_id="caller", types=None, limit=10)
+                latencies.append((time.perf_counter() - started) * 1000.0)
+                position += 1
+
+        readers = [threading.Thread(target=read) for _ in range(args.readers)]
+        for thread in readers:
+            thread.start()
+        deadline = time.perf_counter() + args.seconds
+        position = 0
+        while time.perf_counter() < deadline:
+            if with_writer:
+                started = time.perf_counter()
+                ai._upsert_vector_records([item(f"caller:w{position}")], [vectors[position % args.corpus]])
+                write_ms.append((time.perf_counter() - started) * 1000.0)
+                position += 1
+            else:
+                time.sleep(0.01)
+        stop.set()
+        for thread in readers:
+            thread.join()
+        p50, p99 = np.percentile(latencies, [50, 99])
+        writes = f"{np.mean(write_ms):>9.2f}" if write_ms else f"{'-':>9}"
+        print(f"{'on' if with_writer else 'off':>8} {len(latencies):>9} {p50:>8.2f} {p99:>8.2f} {writes}")
+
+    print(f"{'write':>8} {'ms':>8}")
+    for kind in ("append", "replace", "delete"):
+        started = time.perf_counter()
+        for i in range(args.writes):
+            if kind == "delete":
+                ai._delete_vector_records([f"caller:{i}"])
+            else:
+                record_id = f"caller:{kind}{i}" if kind == "append" else f"caller:{i}"
+                ai._upsert_vector_records([item(record_id)], [vectors[i]])
+        print(f"{kind:>8} {(time.perf_counter() - started) / args.writes * 1000.0:>8.2f}")
+
+
+def bench_batch(args: argparse.Namespace) -> None:
+    """Scoring a /search/batch request as one matrix product vs one scan per query."""
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered(args.corpus, args.dim, rng)
+    ai.VECTOR_ANN_INDEX = "none"
+    ai.VECTOR_CODEC_MIN_ROWS = 1
+    print(f"corpus={args.corpus} dim={args.dim} k={args.k}")
+    print(f"{'codec':>8} {'queries':>8} {'loop ms':>9} {'batch ms':>9} {'speedup':>8}")
+    for codec in args.codecs:
+        _reset_store()
+        ai.VECTOR_CODEC = codec
+        _load_partition("caller", vectors)
+        for count in args.queries:
+            queries = _clustered(count, args.dim, rng).tolist()
+            loop = batch = float("inf")
+            for _ in range(args.repeats):
+                started = time.perf_counter()
+                for query in queries:
+                    ai._search_vectors(query, user_id="caller", types=None, limit=args.k)
+                loop = min(loop, time.perf_counter() - started)
+                started = time.perf_counter()
+                ai._search_vectors_batch(queries, user_id="caller", types=None, limit=args.k)
+                batch = min(batch, time.perf_counter() - started)
+            print(f"{codec:>8} {count:>8} {loop * 1000:>9.2f} {batch * 1000:>9.2f} {loop / batch:>7.1f}x")
+
+
+async def _drain(chunks) -> None:
+    async for _ in chunks:
+        pass
+
+
+def bench_cursor(args: argparse.Namespace) -> None:
+    """Deep pages through a search cursor vs re-running the scan with a larger limit."""
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered(args.corpus, args.dim, rng)
+    queries = _clustered(args.repeats, args.dim, rng)
+    ai.VECTOR_ANN_INDEX = "none"
+    _reset_store()
+    _load_partition("caller", vectors)
+    print(f"corpus={args.corpus} dim={args.dim} page={args.page} pages={args.pages} queries={args.repeats}")
+    rescan = first = later = stream = 0.0
+    for query in queries:
+        started = time.perf_counter()
+        for page in range(1, args.pages + 1):
+            ai._search_vectors(query, user_id="caller", types=None, limit=page * args.page)[-args.page :]
+        rescan += time.perf_counter() - started
+        started = time.perf_counter()
+        cursor = ai._open_search_cursor(query[None], user_id="caller", types=None, filter_expr=None, fingerprint="")
+        response = ai._search_cursor_page(cursor, 0, args.page)
+        first += time.perf_counter() - started
+        started = time.perf_counter()
+        offset = args.page
+        for _ in range(args.pages - 1):
+            response = ai._search_cursor_page(cursor, offset, args.page)
+            offset += args.page
+        later += time.perf_counter() - started
+        started = time.perf_counter()
+        cursor = ai._open_search_cursor(query[None], user_id="caller", types=None, filter_expr=None, fingerprint="")
+        asyncio.run(_drain(ai._stream_search_cursor(cursor, 0, args.stream).body_iterator))
+        stream += time.perf_counter() - started
+    ai._SEARCH_CURSORS.clear()
+    count = len(queries)
+    print(f"{'re-scan per page':>28} {rescan / count / args.pages * 1000:>9.2f} ms/page")
+    print(f"{'cursor first page':>28} {first / count * 1000:>9.2f} ms")
+    print(f"{'cursor later pages':>28} {later / count / (args.pages - 1) * 1000:>9.2f} ms/page")
+    print(f"{f'stream {args.stream} results':>28} {stream / count * 1000:>9.2f} ms")
+
+
+def bench_mmr(args: argparse.Namespace) -> None:
+    """Search latency with MMR re-ranking, and the re-rank step alone vs a Python loop."""
+    rng = np.random.default_rng(args.seed)
+    vectors = _clustered(args.corpus, args.dim, rng)
+    queries = _clustered(args.repeats, args.dim, rng)
+    ai.VECTOR_ANN_INDEX = "none"
+    _reset_store()
+    _load_partition("caller", vectors)
+
+    def loop_mmr(hits, limit, mmr_lambda):
+        embeddings = {record_id: ai._unit_vector(ai._VECTOR_STORE[record_id].embedding) for _, record_id in hits}
+        picked: list = []
+        while len(picked) < min(limit, len(hits)):
+            best, best_gain = None, -np.inf
+            for score, record_id in hits:
+                if record_id in picked:
+                    continue
+                closest = max((float(embeddings[record_id] @ embeddings[p]) for p in picked), default=0.0)
+                gain = mmr_lambda * score - (1 - mmr_lambda) * max(closest, 0.0)
+                if gain > best_gain:
+                    best, best_gain = record_id, gain
+            picked.append(best)
+        return picked
+
+    print(f"corpus={args.corpus} dim={args.dim} fetch factor={ai.SEARCH_MMR_FETCH_FACTOR} queries={args.repeats}")
+    print(f"{'limit':>6} {'search ms':>10} {'+mmr ms':>9} {'rerank ms':>10} {'loop ms':>9}")
+    for limit in args.limits:
+        plain = mmr = rerank = loop = 0.0
+        for query in queries:
+            started = time.perf_counter()
+            ai._search_vectors(query, user_id="caller", types=None, limit=limit)
+            plain += time.perf_counter() - started
+            started = time.perf_counter()
+            ai._search_vectors(query, user_id="caller", types=None, limit=limit, mmr_lambda=0.7)
+            mmr += time.perf_counter() - started
+            partition = ai._VECTOR_PARTITIONS[("caller", args.dim)]
+            hits = partition.search(ai._unit_vector(query), limit * ai.SEARCH_MMR_FETCH_FACTOR)
+            started = time.perf_counter()
+            ai._mmr_rerank(hits, limit, 0.7)
+            rerank += time.perf_counter() - started
+            started = time.perf_counter()
+            loop_mmr(hits, limit, 0.7)
+            loop += time.perf_counter() - started
+        count = len(queries) / 1000.0
+        print(f"{limit:>6} {plain / count:>10.2f} {mmr / count:>9.2f} {rerank / count:>10.3f} {loop / count:>9.2f}")
+
+
+def bench_lexical(args: argparse.Namespace) -> None:
+    """BM25 index build and query latency next to the exact vector scan, and write cost with the index live."""
+    rng = np.random.default_rng(args.seed)
+    vocabulary = [f"w{i}" for i in range(args.vocabulary)]
+    weights = 1.0 / np.arange(1, args.vocabulary + 1)
+    weights /= weights.sum()
+    ai.VECTOR_ANN_INDEX = "none"
+
+    def texts(count):
+        words = rng.choice(vocabulary, size=(count, args.words), p=weights)
+        return [" ".join(row) for row in words]
+
+    def upsert_batch(prefix):
+        items = [
+            ai.EmbeddingUpsertItem(
+                id=f"{prefix}{i}", userId="caller", objectType="highlight", objectId=f"{prefix}{i}", text=text
+            )
+            for i, text in enumerate(texts(100))
+        ]
+        started = time.perf_counter()
+        ai._upsert_vector_records(items, _clustered(100, args.dim, rng).tolist())
+        return time.perf_counter() - started
+
+    print(f"dim={args.dim} vocabulary={args.vocabulary} words/doc={args.words} queries={args.repeats}")
+    print(f"{'corpus':>8} {'build ms':>9} {'lexical ms':>11} {'vector ms':>10} {'upsert x100 ms':>15} {'+index ms':>10}")
+    for corpus in args.corpus:
+        vectors = _clustered(corpus, args.dim, rng)
+        _reset_store()
+        with ai._VECTOR_STORE_LOCK:
+            for i, (vector, text) in enumerate(zip(vectors, texts(corpus))):
+                record_id = f"caller:{i}"
+                ai._VECTOR_STORE[record_id] = ai._VectorRecord(
+                    record_id, "caller", "highlight", f"obj-{i}", "", 0, vector, text=text, metadata={}
+                )
+            ai._rebuild_vector_partitions()
+        bare = upsert_batch("bare")
+        partition = ai._VECTOR_PARTITIONS[("caller", args.dim)]
+        started = time.perf_counter()
+        ai._lexical_partition(partition)
+        build = time.perf_counter() - started
+
+        queries = [" ".join(rng.choice(vocabulary[: args.vocabulary // 4], size=3)) for _ in range(args.repeats)]
+        query_vectors = _clustered(args.repeats, args.dim, rng)
+        lexical = vector = 0.0
+        for query, query_vector in zip(queries, query_vectors):
+            started = time.perf_counter()
+            ai._search_lexical(query, user_id="caller", types=None, limit=12)
+            lexical += time.perf_counter() - started
+            started = time.perf_counter()
+            ai._search_vectors(query_vector, user_id="caller", types=None, limit=12)
+            vector += time.perf_counter() - started
+
+        indexed = upsert_batch("late")
+        count = len(queries) / 1000.0
+        print(
+            f"{corpus:>8} {build * 1000:>9.1f} {lexical / count:>11.2f} {vector / count:>10.2f} {bare * 1000:>15.1f} {indexed * 1000:>10.1f}"
+        )
+
+
+def bench_dedupe(args: argparse.Namespace) -> None:
+    """/dedupe clustering time, blocked all pairs vs LSH, and LSH cluster recall.
+
+    Rows are loose topical blobs (neighbours around cosine 0.5) plus noisy copies
+    of a share of them; ``_clustered`` blobs are too tight to leave any gap below
+    a duplicate threshold."""
+    rng = np.random.default_rng(args.seed)
+    ai.VECTOR_ANN_INDEX = "none"
+    print(f"dim={args.dim} threshold={args.threshold} duplicates={args.duplicates:.0%} noise={args.noise}")
+    print(f"{'corpus':>8} {'exact ms':>10} {'lsh ms':>9} {'clusters':>9} {'lsh recall':>11}")
+    for corpus in args.corpus:
+        copies = int(corpus * args.duplicates)
+        centres = rng.standard_normal((64, args.dim), dtype=np.float32)
+        base = centres[rng.integers(0, 64, size=corpus - copies)]
+        base = base + rng.standard_normal(base.shape, dtype=np.float32)
+        near = base[:copies] + args.noise * rng.standard_normal((copies, args.dim), dtype=np.float32)
+        _reset_store()
+        _load_partition("caller", np.concatenate([base, near]))
+        timings = {}
+        found = {}
+        for method in ("exact", "lsh"):
+            started = time.perf_counter()
+            clusters, _, _ = ai._find_duplicates(
+                user_id="caller", types=None, filter_expr=None, threshold=args.threshold, method=method
+            )
+            timings[method] = time.perf_counter() - started
+            found[method] = {frozenset(cluster["ids"]) for cluster in clusters}
+        recall = len(found["exact"] & found["lsh"]) / max(1, len(found["exact"]))
+        print(
+            f"{corpus:>8} {timings['exact'] * 1000:>10.1f} {timings['lsh'] * 1000:>9.1f}"
+            f" {len(found['exact']):>9} {recall:>11.3f}"
+        )
+
+
+def bench_cluster(args: argparse.Namespace) -> None:
+    """/cluster latency: first fit, incremental update after writes and cached reads, vs full Lloyd k-means."""
+    rng = np.random.default_rng(args.seed)
+    ai.VECTOR_ANN_INDEX = "none"
+
+    def run():
+        started = time.perf_counter()
+        _, _, state = ai._cluster_records(user_id="caller", types=None, filter_expr=None, k=args.k, exemplars=3)
+        return time.perf_counter() - started, state
+
+    print(f"dim={args.dim} k={args.k} batch={ai.CLUSTER_BATCH_ROWS} writes={args.writes}")
+    print(f"{'corpus':>8} {'fit ms':>9} {'cached ms':>10} {'incr ms':>9} {'lloyd ms':>9}")
+    for corpus in args.corpus:
+        vectors = _clustered(corpus, args.dim, rng)
+        _reset_store()
+        ai._CLUSTER_MODELS.clear()
+        _load_partition("caller", vectors)
+        fit, _ = run()
+        cached, _ = run()
+        items = [
+            ai.EmbeddingUpsertItem(
+                id=f"late{i}", userId="caller", objectType="highlight", objectId=f"late{i}", text="x"
+            )
+            for i in range(args.writes)
+        ]
+        ai._upsert_vector_records(items, _clustered(args.writes, args.dim, rng).tolist())
+        incremental, state = run()
+        assert state == "incremental", state
+        started = time.perf_counter()
+        ai._kmeans(ai._unit_rows(vectors), args.k, rng)
+        lloyd = time.perf_counter() - started
+        print(
+            f"{corpus:>8} {fit * 1000:>9.1f} {cached * 1000:>10.2f} {incremental * 1000:>9.1f} {lloyd * 1000:>9.1f}"
+        )
+
+
+def bench_similar_graph(args: argparse.Namespace) -> None:
+    """/similar from the neighbour graph vs a scan, and what keeping the graph costs writes."""
+    rng = np.random.default_rng(args.seed)
+    ai.VECTOR_ANN_INDEX = "none"
+    limit = 12
+
+    def upsert_batch(prefix):
+        items = [
+            ai.EmbeddingUpsertItem(
+                id=f"{prefix}{i}", userId="caller", objectType="highlight", objectId=f"{prefix}{i}", text="x"
+            )
+            for i in range(args.writes)
+        ]
+        started = time.perf_counter()
+        ai._upsert_vector_records(items, _clustered(args.writes, args.dim, rng).tolist())
+        return time.perf_counter() - started
+
+    print(f"dim={args.dim} k={ai.SIMILAR_GRAPH_K} limit={limit} writes={args.writes}")
+    print(
+        f"{'corpus':>8} {'lists':>6} {'scan ms':>8} {'fill ms':>8} {'graph ms':>9}"
+        f" {'upsert ms':>10} {'+graph ms':>10} {'exact':>6}"
+    )
+    for corpus in args.corpus:
+        for lists in args.lists:
+            _reset_store()
+            _load_partition("caller", _clustered(corpus, args.dim, rng))
+            bare = upsert_batch("bare")
+            sources = [f"caller:{i}" for i in rng.choice(corpus, lists, replace=False)]
+            scan = fill = graph = 0.0
+            exact = 0
+            for source in sources:
+                vector = ai._VECTOR_STORE[source].embedding
+                started = time.perf_counter()
+                expected = ai._search_vectors(vector, user_id="caller", types=None, limit=limit, exclude_id=source)
+                scan += time.perf_counter() - started
+                started = time.perf_counter()
+                ai._similar_neighbors(source, "caller", limit, 0.0)
+                fill += time.perf_counter() - started
+                started = time.perf_counter()
+                found = ai._similar_neighbors(source, "caller", limit, 0.0)
+                graph += time.perf_counter() - started
+                exact += [r["id"] for r in found] == [r["id"] for r in expected]
+            indexed = upsert_batch("late")
+            count = len(sources) / 1000.0
+            print(
+                f"{corpus:>8} {lists:>6} {scan / count:>8.2f} {fill / count:>8.2f} {graph / count:>9.3f}"
+                f" {bare * 1000:>10.1f} {indexed * 1000:>10.1f} {exact / len(sources):>6.0%}"
+            )
+
+
+def bench_grouped(args: argparse.Namespace) -> None:
+    """Collapsed and per-type quota search in one pass vs over-fetching and grouping afterwards."""
+    rng = np.random.default_rng(args.seed)
+    ai.VECTOR_ANN_INDEX = "none"
+    limit = 12
+    quotas = {"article": 4, "highlight": 8}
+
+    def over_fetch(query, collapse, quota):
+        # What a client does without grouping: fetch more, group, and retry with a bigger page until full.
+        fetch = limit * 4
+        while True:
+            hits = ai._search_vectors(query, user_id="caller", types=None, limit=fetch)
+            seen, taken, kept = set(), {}, []
+            for hit in hits:
+                key = (hit["objectType"], hit["objectId"])
+                if collapse and key in seen:
+                    continue
+                seen.add(key)
+                if quota is not None:
+                    if taken.get(hit["objectType"], 0) >= quota.get(hit["objectType"], 0):
+                        continue
+                    taken[hit["objectType"]] = taken.get(hit["objectType"], 0) + 1
+                kept.append(hit["id"])
+            if len(kept) >= limit or len(hits) < fetch:
+                return kept[:limit], fetch
+            fetch *= 4
+
+    print(f"dim={args.dim} chunks per object={args.chunks} spread={args.spread} limit={limit} quotas={quotas}")
+    print(f"{'corpus':>8} {'grouping':>16} {'grouped ms':>11} {'over-fetch ms':>14} {'fetched':>8} {'same':>5}")
+    for corpus in args.corpus:
+        _reset_store()
+        objects = corpus // args.chunks
+        centres = _clustered(objects, args.dim, rng)
+        vectors = np.repeat(centres, args.chunks, axis=0)
+        vectors += args.spread * rng.standard_normal(vectors.shape, dtype=np.float32)
+        with ai._VECTOR_STORE_LOCK:
+            for i, vector in enumerate(vectors):
+                record_id = f"caller:{i}"
+                object_type = "article" if (i // args.chunks) % 8 == 0 else "highlight"
+                ai._VECTOR_STORE[record_id] = ai._VectorRecord(
+                    record_id, "caller", object_type, f"obj-{i // args.chunks}", "", 0, vector, text="", metadata={}
+                )
+            ai._rebuild_vector_partitions()
+        queries = vectors[rng.choice(len(vectors), args.repeats, replace=False)]
+        for name, collapse, quota in (
+            ("collapse", True, None),
+            ("quotas", False, quotas),
+            ("collapse+quotas", True, quotas),
+        ):
+            grouped = baseline = 0.0
+            fetched = same = 0
+            for query in queries:
+                started = time.perf_counter()
+                found = ai._search_vectors(
+                    query, user_id="caller", types=None, limit=limit, collapse=collapse, quotas=quota
+                )
+                grouped += time.perf_counter() - started
+                started = time.perf_counter()
+                expected, fetch = over_fetch(query, collapse, quota)
+                baseline += time.perf_counter() - started
+                fetched += fetch
+                same += sorted(r["id"] for r in found) == sorted(expected)
+            count = len(queries) / 1000.0
+            print(
+                f"{corpus:>8} {name:>16} {grouped / count:>11.2f} {baseline / count:>14.2f}"
+                f" {fetched // len(queries):>8} {same / len(queries):>5.0%}"
+            )
+
+
+def bench_chunks(args: argparse.Namespace) -> None:
+    """Search over chunked articles: per-chunk results vs parents scored by max and mean-of-top chunks."""
+    rng = np.random.default_rng(args.seed)
+    ai.VECTOR_ANN_INDEX = "none"
+    limit = 12
+    text = " ".join(f"w{i}" for i in range(args.words))
+    started = time.perf_counter()
+    for _ in range(100):
+        ai._chunk_text(text, ai.EMBED_CHUNK_WORDS, ai.EMBED_CHUNK_OVERLAP)
+    split = (time.perf_counter() - started) * 10.0
+    chunks = len(ai._chunk_text(text, ai.EMBED_CHUNK_WORDS, ai.EMBED_CHUNK_OVERLAP))
+
+    print(
+        f"dim={args.dim} words per article={args.words} chunk={ai.EMBED_CHUNK_WORDS}/{ai.EMBED_CHUNK_OVERLAP}"
+        f" -> {chunks} chunks, split {split:.3f} ms; mean of top {ai.SEARCH_CHUNK_MEAN_TOP}"
+    )
+    print(f"{'articles':>9} {'rows':>8} {'plain ms':>10} {'max ms':>8} {'mean ms':>8} {'delete 100 ms':>14}")
+    for articles in args.articles:
+        _reset_store()
+        vectors = np.repeat(_clustered(articles, args.dim, rng), chunks, axis=0)
+        vectors += 0.3 * rng.standard_normal(vectors.shape, dtype=np.float32)
+        with ai._VECTOR_STORE_LOCK:
+            for i, vector in enumerate(vectors):
+                record_id = f"a{i // chunks}{ai._CHUNK_ID_SEPARATOR}{i % chunks}"
+                ai._VECTOR_STORE[record_id] = ai._VectorRecord(
+                    record_id,
+                    "caller",
+                    "article",
+                    f"a{i // chunks}",
+                    str(i % chunks),
+                    0,
+                    vector,
+                    text="",
+                    metadata={},
+                    chunkOf=f"a{i // chunks}",
+                )
+            ai._rebuild_vector_partitions()
+            ai._rebuild_chunk_families()
+        queries = vectors[rng.choice(len(vectors), args.repeats, replace=False)]
+        timings = []
+        for options in ({}, {"chunk_score": "max"}, {"chunk_score": "mean"}):
+            started = time.perf_counter()
+            for query in queries:
+                ai._search_vectors(query, user_id="caller", types=None, limit=limit, **options)
+            timings.append((time.perf_counter() - started) / len(queries) * 1000.0)
+        started = time.perf_counter()
+        ai._delete_vector_records([f"a{i}" for i in range(100)])
+        deleted = (time.perf_counter() - started) * 1000.0
+        print(
+            f"{articles:>9} {len(vectors):>8} {timings[0]:>10.2f} {timings[1]:>8.2f} {timings[2]:>8.2f}"
+            f" {deleted:>14.1f}"
+        )
+
+
+def bench_fields(args: argparse.Namespace) -> None:
+    """Response size and build + JSON time of /search and /embed/get results by field projection."""
+    rng = np.random.default_rng(args.seed)
+    ai.VECTOR_ANN_INDEX = "none"
+    words = " ".join(f"word{i}" for i in range(args.words))
+    _reset_store()
+    with ai._VECTOR_STORE_LOCK:
+        for i, vector in enumerate(_clustered(args.corpus, args.dim, rng)):
+            ai._VECTOR_STORE[f"r{i}"] = ai._VectorRecord(
+                f"r{i}", "caller", "article", f"a{i}", "", i, vector, text=words, metadata={"tags": ["x"]}
+            )
+    # Documents are read back from the segment file, as they are after a restart.
+    ai._persist_vector_store()
+    with ai._VECTOR_STORE_LOCK:
+        ai._VECTOR_STORE = {}
+        ai._VECTOR_PARTITIONS.clear()
+        ai._VECTOR_STORE_LOADED = False
+    ai._load_vector_store_if_needed()
+    queries = _clustered(args.repeats, args.dim, rng)
+    ids = [f"r{i}" for i in rng.choice(args.corpus, 50, replace=False)]
+
+    def measure(run):
+        started = time.perf_counter()
+        size = 0
+        for query in queries:
+            size = len(json.dumps(run(query)))
+        return (time.perf_counter() - started) / len(queries) * 1000.0, size
+
+    search_views = (
+        ("full", ai._SEARCH_FIELDS),
+        ("snippet 200", ai._ResultFields.parse(None, 200, ai._SEARCH_FIELDS)),
+        ("ids + score", ai._ResultFields.parse([], None, ai._SEARCH_FIELDS)),
+    )
+    get_views = (
+        ("get, full", ai._GET_FIELDS),
+        ("get, no embedding", ai._ResultFields.parse(["objectId", "metadata", "document"], None, ai._GET_FIELDS)),
+        ("get, objectId only", ai._ResultFields.parse(["objectId"], None, ai._GET_FIELDS)),
+    )
+    print(f"corpus={args.corpus} dim={args.dim} words per document={args.words} limit=50")
+    print(f"{'fields':>20} {'ms':>8} {'bytes':>9}")
+    for name, fields in search_views:
+        ms, size = measure(lambda q: ai._search_vectors(q, user_id="caller", types=None, limit=50, fields=fields))
+        print(f"{name:>20} {ms:>8.2f} {size:>9}")
+    for name, fields in get_views:
+        ms, size = measure(lambda q: ai._get_vector_records(ids, fields))
+        print(f"{name:>20} {ms:>8.2f} {size:>9}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--repeats", type=int, default=50)
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    tenants = sub.add_parser("tenants", help=bench_tenants.__doc__)
+    tenants.add_argument("--corpus", type=int, default=2000)
+    tenants.add_argument("--steps", type=int, nargs="+", default=[0, 10, 50, 120])
+    tenants.set_defaults(func=bench_tenants)
+
+    ann = sub.add_parser("ann", help=bench_ann.__doc__)
+    ann.add_argument("--corpus", type=int, default=20000)
+    ann.add_argument("--index", choices=["hnsw", "ivf"], default="hnsw")
+    ann.add_argument("--k", type=int, default=10)
+    ann.add_argument("--m", type=int, default=16)
+    ann.add_argument("--ef-construction", type=int, default=100)
+    ann.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128, 256])
+    ann.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    ann.set_defaults(func=bench_ann)
+
+    codecs = sub.add_parser("codecs", help=bench_codecs.__doc__)
+    codecs.add_argument("--corpus", type=int, default=50000)
+    codecs.add_argument("--k", type=int, default=10)
+    codecs.add_argument("--rescore", type=int, nargs="+", default=[None], help="default: per-codec factor")
+    codecs.add_argument("--codecs", nargs="+", default=["float32", "float16", "int8", "pq", "sign"])
+    codecs.set_defaults(func=bench_codecs)
+
+    store_memory = sub.add_parser("store-memory", help=bench_store_memory.__doc__)
+    store_memory.add_argument("--corpus", type=int, default=50000)
+    store_memory.add_argument("--words", type=int, default=60)
+    store_memory.set_defaults(func=bench_store_memory)
+
+    records = sub.add_parser("records", help=bench_records.__doc__)
+    records.add_argument("--counts", type=int, nargs="+", default=[10000, 100000, 1000000])
+    records.add_argument("--tenants", type=int, default=200)
+    records.set_defaults(func=bench_records)
+
+    snapshots = sub.add_parser("snapshots", help=bench_snapshots.__doc__)
+    snapshots.add_argument("--corpus", type=int, default=20000)
+    snapshots.add_argument("--readers", type=int, default=2)
+    snapshots.add_argument("--seconds", type=float, default=3.0)
+    snapshots.add_argument("--writes", type=int, default=50)
+    snapshots.set_defaults(func=bench_snapshots)
+
+    batch = sub.add_parser("batch", help=bench_batch.__doc__)
+    batch.add_argument("--corpus", type=int, default=50000)
+    batch.add_argument("--queries", type=int, nargs="+", default=[8, 12])
+    batch.add_argument("--k", type=int, default=12)
+    batch.add_argument("--codecs", nargs="+", default=["float32", "int8"])
+    batch.set_defaults(func=bench_batch)
+
+    cursor = sub.add_parser("cursor", help=bench_cursor.__doc__)
+    cursor.add_argument("--corpus", type=int, default=100000)
+    cursor.add_argument("--page", type=int, default=50)
+    cursor.add_argument("--pages", type=int, default=20)
+    cursor.add_argument("--stream", type=int, default=10000)
+    cursor.set_defaults(func=bench_cursor)
+
+    mmr = sub.add_parser("mmr", help=bench_mmr.__doc__)
+    mmr.add_argument("--corpus", type=int, default=50000)
+    mmr.add_argument("--limits", type=int, nargs="+", default=[12, 50])
+    mmr.set_defaults(func=bench_mmr)
+
+    lexical = sub.add_parser("lexical", help=bench_lexical.__doc__)
+    lexical.add_argument("--corpus", type=int, nargs="+", default=[10000, 50000])
+    lexical.add_argument("--vocabulary", type=int, default=20000)
+    lexical.add_argument("--words", type=int, default=40)
+    lexical.set_defaults(func=bench_lexical)
+
+    dedupe = sub.add_parser("dedupe", help=bench_dedupe.__doc__)
+    dedupe.add_argument("--corpus", type=int, nargs="+", default=[1000, 10000, 50000])
+    dedupe.add_argument("--threshold", type=float, default=0.95)
+    dedupe.add_argument("--duplicates", type=float, default=0.1)
+    dedupe.add_argument("--noise", type=float, default=0.4)
+    dedupe.set_defaults(func=bench_dedupe)
+
+    cluster = sub.add_parser("cluster", help=bench_cluster.__doc__)
+    cluster.add_argument("--corpus", type=int, nargs="+", default=[10000, 50000])
+    cluster.add_argument("--k", type=int, default=32)
+    cluster.add_argument("--writes", type=int, default=100)
+    cluster.set_defaults(func=bench_cluster)
+
+    similar_graph = sub.add_parser("similar-graph", help=bench_similar_graph.__doc__)
+    similar_graph.add_argument("--corpus", type=int, nargs="+", default=[10000, 50000])
+    similar_graph.add_argument("--lists", type=int, nargs="+", default=[100, 1000])
+    similar_graph.add_argument("--writes", type=int, default=100)
+    similar_graph.set_defaults(func=bench_similar_graph)
+
+    grouped = sub.add_parser("grouped", help=bench_grouped.__doc__)
+    grouped.add_argument("--corpus", type=int, nargs="+", default=[10000, 50000])
+    grouped.add_argument("--chunks", type=int, default=16)
+    grouped.add_argument("--spread", type=float, default=0.1)
+    grouped.set_defaults(func=bench_grouped)
+
+    chunks = sub.add_parser("chunks", help=bench_chunks.__doc__)
+    chunks.add_argument("--articles", type=int, nargs="+", default=[1000, 5000])
+    chunks.add_argument("--words", type=int, default=1200)
+    chunks.set_defaults(func=bench_chunks)
+
+    fields = sub.add_parser("fields", help=bench_fields.__doc__)
+    fields.add_argument("--corpus", type=int, default=20000)
+    fields.add_argument("--words", type=int, default=300)
+    fields.set_defaults(func=bench_fields)
+
+    args = parser.parse_args()
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())